@@ -7,6 +7,7 @@ from sqlmodel import SQLModel
 from sqlalchemy import engine_from_config
 from sqlalchemy import pool
 from alembic import context  # pylint: disable=no-name-in-module
+import app.models  # pylint: disable=unused-import
 
 load_dotenv()
 
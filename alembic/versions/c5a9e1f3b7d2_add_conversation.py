@@ -0,0 +1,38 @@
+"""Add conversation table
+
+Revision ID: c5a9e1f3b7d2
+Revises: 8b4e6d0c2f31
+Create Date: 2026-10-18 14:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+import sqlmodel
+
+
+# revision identifiers, used by Alembic.
+revision = "c5a9e1f3b7d2"
+down_revision = "8b4e6d0c2f31"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "conversation",
+        sa.Column(
+            "thread_id", sqlmodel.sql.sqltypes.AutoString(length=64), nullable=False
+        ),
+        sa.Column("messages", sqlmodel.sql.sqltypes.AutoString(), nullable=False),
+        sa.Column("created_at", sa.DateTime(), nullable=False),
+        sa.Column("updated_at", sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint("thread_id"),
+    )
+    op.create_index(
+        op.f("ix_conversation_updated_at"), "conversation", ["updated_at"], unique=False
+    )
+
+
+def downgrade() -> None:
+    op.drop_index(op.f("ix_conversation_updated_at"), table_name="conversation")
+    op.drop_table("conversation")
@@ -0,0 +1,160 @@
+"""Helpers for processing many uploaded documents in one request."""
+
+import asyncio
+import io
+import os
+import posixpath
+import zipfile
+from dotenv import load_dotenv
+from fastapi import HTTPException, UploadFile
+from starlette.datastructures import Headers
+from app.executor import TaskLimitError, run_cpu
+from app.utils import DOCX_CONTENT_TYPE, upstream_error
+
+load_dotenv()
+
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "8"))
+BATCH_MAX_FILES = int(os.getenv("BATCH_MAX_FILES", "100"))
+# Limits on what a zip archive of documents may unpack to.
+BATCH_MAX_DOCUMENT_BYTES = int(os.getenv("BATCH_MAX_DOCUMENT_BYTES", str(20 * 1024**2)))
+BATCH_MAX_UNPACKED_BYTES = int(
+    os.getenv("BATCH_MAX_UNPACKED_BYTES", str(200 * 1024**2))
+)
+# Documents are compressed already, so a zipped one shrinks very little.
+ZIP_MAX_RATIO = 100
+ZIP_CONTENT_TYPES = {"application/zip", "application/x-zip-compressed"}
+
+
+def is_zip_upload(file: UploadFile) -> bool:
+    """Check if the uploaded file is a zip archive of documents."""
+    return file.content_type in ZIP_CONTENT_TYPES or file.filename.endswith(".zip")
+
+
+class ZipTooLargeError(ValueError):
+    """Raised when a zip archive unpacks to more than the limits allow."""
+
+
+def read_zip_entries(data: bytes, max_files: int) -> list:
+    """Return the names and contents of the .docx files in a zip archive.
+
+    The sizes in the archive are checked before anything is unpacked, so a
+    zip bomb is rejected without inflating it. Raises ZipTooLargeError for
+    an entry or archive over the limits, and ValueError for too many files.
+    """
+    with zipfile.ZipFile(io.BytesIO(data)) as archive:
+        entries = [
+            info
+            for info in archive.infolist()
+            if not info.is_dir()
+            and info.filename.endswith(".docx")
+            and not posixpath.basename(info.filename).startswith(("._", "~$"))
+        ]
+        if len(entries) > max_files:
+            raise ValueError("Too many files.")
+        for info in entries:
+            if info.file_size > BATCH_MAX_DOCUMENT_BYTES or info.file_size > (
+                ZIP_MAX_RATIO * max(info.compress_size, 1)
+            ):
+                raise ZipTooLargeError(posixpath.basename(info.filename))
+        if sum(info.file_size for info in entries) > BATCH_MAX_UNPACKED_BYTES:
+            raise ZipTooLargeError()
+        # A zip entry never reads past its recorded size.
+        return [
+            (posixpath.basename(info.filename), archive.read(info)) for info in entries
+        ]
+
+
+async def unpack_zip(file: UploadFile) -> list:
+    """Return the .docx files in an uploaded zip archive as uploads.
+
+    The archive is unpacked on the CPU executor.
+    """
+    await file.seek(0)
+    data = await file.read()
+    try:
+        entries = await run_cpu(read_zip_entries, data, BATCH_MAX_FILES)
+    except zipfile.BadZipFile as e:
+        raise HTTPException(
+            status_code=400, detail=f"{file.filename} is not a valid zip file."
+        ) from e
+    except (ZipTooLargeError, TaskLimitError) as e:
+        raise HTTPException(
+            status_code=413, detail=f"{file.filename} is too large to unpack."
+        ) from e
+    except ValueError as e:
+        raise too_many_files_error() from e
+    return [
+        UploadFile(
+            file=io.BytesIO(content),
+            filename=filename,
+            headers=Headers({"content-type": DOCX_CONTENT_TYPE}),
+        )
+        for filename, content in entries
+    ]
+
+
+def too_many_files_error() -> HTTPException:
+    """Return the error for a batch with too many documents."""
+    return HTTPException(
+        status_code=400,
+        detail=f"A batch can contain at most {BATCH_MAX_FILES} documents.",
+    )
+
+
+async def expand_uploads(files: list) -> list:
+    """Expand zip archives in the uploads into the documents they contain."""
+    documents = []
+    for file in files:
+        if is_zip_upload(file):
+            documents.extend(await unpack_zip(file))
+        else:
+            documents.append(file)
+    if not documents:
+        raise HTTPException(status_code=400, detail="No documents were uploaded.")
+    if len(documents) > BATCH_MAX_FILES:
+        raise too_many_files_error()
+    return documents
+
+
+def unique_names(files: list) -> list:
+    """Return a unique name for each file, numbering duplicates."""
+    return number_duplicates([file.filename for file in files])
+
+
+def number_duplicates(names: list) -> list:
+    """Number the repeated names in a list, as in ``skjal (2).docx``."""
+    unique = []
+    seen = set()
+    for name in names:
+        stem, extension = posixpath.splitext(name)
+        count = 1
+        while name in seen:
+            count += 1
+            name = f"{stem} ({count}){extension}"
+        seen.add(name)
+        unique.append(name)
+    return unique
+
+
+async def run_bounded(items: list, worker, limit: int = None) -> list:
+    """Run the worker on every item with at most ``limit`` running at once.
+
+    Returns a list with the result of each item, or the exception it raised.
+    """
+    semaphore = asyncio.Semaphore(limit or BATCH_CONCURRENCY)
+
+    async def run(item):
+        async with semaphore:
+            return await worker(item)
+
+    return await asyncio.gather(*(run(item) for item in items), return_exceptions=True)
+
+
+def error_detail(error: BaseException) -> str:
+    """Return the message to report for a document that failed."""
+    if isinstance(error, HTTPException):
+        return error.detail
+    upstream = upstream_error(error)
+    if upstream is not None:
+        return upstream.detail
+    return "An unexpected error occurred"
@@ -0,0 +1,232 @@
+"""Offline bulk processing of documents through the OpenAI Batch API.
+
+The Batch API is much cheaper than interactive calls and has far higher
+rate limits, at the cost of finishing within hours instead of seconds. It
+suits overnight reviews of large memo archives.
+
+Run with, for example::
+
+    python -m app.bulk --kind minnisblad-adstod --out results.json skjol/*.docx
+    python -m app.bulk --kind minnisblad --chapters inngangur samantekt \\
+        --out minnisblod skjol/*.docx
+"""
+
+import argparse
+import asyncio
+import json
+import os
+from pathlib import Path
+from app.batch import number_duplicates
+from app.chunking import merge_responses, split_text
+from app.docx_text import InvalidDocxError, read_docx_text
+from app.openai_client import client as default_client
+from app.utils import MAX_WORDS, MIN_WORDS, build_chat_request
+
+BATCH_ENDPOINT = "/v1/chat/completions"
+BATCH_COMPLETION_WINDOW = "24h"
+BATCH_TERMINAL_STATES = {"completed", "failed", "expired", "cancelled"}
+BATCH_POLL_INITIAL_INTERVAL = float(os.getenv("BATCH_POLL_INITIAL_INTERVAL", "5"))
+BATCH_POLL_MAX_INTERVAL = float(os.getenv("BATCH_POLL_MAX_INTERVAL", "300"))
+
+
+class BatchError(RuntimeError):
+    """Raised when a batch does not complete."""
+
+
+def build_batch_file(texts: dict, response_format: dict) -> bytes:
+    """Build the JSONL input file with one chat request per document."""
+    lines = [
+        json.dumps(
+            {
+                "custom_id": name,
+                "method": "POST",
+                "url": BATCH_ENDPOINT,
+                "body": build_chat_request(text, response_format),
+            },
+            ensure_ascii=False,
+        )
+        for name, text in texts.items()
+    ]
+    return ("\n".join(lines) + "\n").encode("utf-8")
+
+
+async def submit_batch(data: bytes, client=default_client):
+    """Upload the input file and create the batch."""
+    input_file = await client.files.create(
+        file=("batch.jsonl", data, "application/jsonl"), purpose="batch"
+    )
+    return await client.batches.create(
+        input_file_id=input_file.id,
+        endpoint=BATCH_ENDPOINT,
+        completion_window=BATCH_COMPLETION_WINDOW,
+    )
+
+
+async def wait_for_batch(batch, client=default_client):
+    """Poll the batch with a growing interval until it reaches a final state."""
+    interval = BATCH_POLL_INITIAL_INTERVAL
+    while batch.status not in BATCH_TERMINAL_STATES:
+        await asyncio.sleep(interval)
+        interval = min(interval * 2, BATCH_POLL_MAX_INTERVAL)
+        batch = await client.batches.retrieve(batch.id)
+    if batch.status != "completed":
+        raise BatchError(f"The batch {batch.id} ended as {batch.status}.")
+    return batch
+
+
+def parse_completion(body: dict) -> dict:
+    """Parse the JSON reply of a chat completion, or report why it can't be used.
+
+    Unlike interactive calls, a reply cut off at max_tokens is not retried,
+    so it fails only its own request instead of the whole batch.
+    """
+    choice = body["choices"][0]
+    if choice.get("finish_reason") == "length":
+        return {"error": "The response was cut off at the output token limit."}
+    try:
+        return {"result": json.loads(choice["message"]["content"])}
+    except ValueError:
+        return {"error": "The response is not valid JSON."}
+
+
+def parse_batch_output(data: str) -> dict:
+    """Map each custom_id in a batch output or error file to its result."""
+    results = {}
+    for line in data.splitlines():
+        if not line.strip():
+            continue
+        record = json.loads(line)
+        response = record.get("response") or {}
+        if response.get("status_code") == 200:
+            results[record["custom_id"]] = parse_completion(response["body"])
+        else:
+            error = record.get("error") or response.get("body", {}).get("error") or {}
+            results[record["custom_id"]] = {
+                "error": error.get("message", "The request failed.")
+            }
+    return results
+
+
+async def fetch_batch_results(batch, client=default_client) -> dict:
+    """Download the output and error files of a completed batch."""
+    results = {}
+    for file_id in (batch.output_file_id, batch.error_file_id):
+        if file_id:
+            content = await client.files.content(file_id)
+            results.update(parse_batch_output(content.text))
+    return results
+
+
+def read_documents(paths: list) -> tuple:
+    """Read the documents, returning their texts and the files that were rejected.
+
+    Documents are named by their file name, with duplicates numbered.
+    """
+    texts = {}
+    errors = {}
+    for path, name in zip(paths, number_duplicates([Path(path).name for path in paths])):
+        try:
+            with open(path, "rb") as file:
+                document = read_docx_text(file, max_words=MAX_WORDS)
+        except (OSError, InvalidDocxError) as e:
+            errors[name] = {"error": str(e)}
+            continue
+        if document.truncated or document.word_count < MIN_WORDS:
+            errors[name] = {
+                "error": f"The document must contain between {MIN_WORDS} and {MAX_WORDS} words."
+            }
+        else:
+            texts[name] = document.text
+    return texts, errors
+
+
+def split_documents(texts: dict) -> tuple:
+    """Split long documents into chunks with their own custom_ids.
+
+    Returns the chunks by custom_id and the custom_ids of each document.
+    """
+    chunks = {}
+    parts = {}
+    for name, text in texts.items():
+        document_chunks = split_text(text)
+        if len(document_chunks) == 1:
+            parts[name] = [name]
+        else:
+            parts[name] = [f"{name}#{i}" for i in range(1, len(document_chunks) + 1)]
+        chunks.update(zip(parts[name], document_chunks))
+    return chunks, parts
+
+
+def merge_document_results(responses: dict, parts: dict) -> dict:
+    """Merge the chunk results of each document, or report its first error."""
+    results = {}
+    for name, custom_ids in parts.items():
+        chunk_results = [
+            responses.get(custom_id, {"error": "The batch has no result for it."})
+            for custom_id in custom_ids
+        ]
+        errors = [result["error"] for result in chunk_results if "error" in result]
+        if errors:
+            results[name] = {"error": errors[0]}
+        else:
+            results[name] = {
+                "result": merge_responses([result["result"] for result in chunk_results])
+            }
+    return results
+
+
+async def run_bulk(paths: list, response_format: dict, client=default_client) -> dict:
+    """Review the documents in one batch and return the result for each.
+
+    Long documents are sent as several requests in the batch and their
+    responses merged, like in send_text_to_openai.
+    """
+    texts, results = read_documents(paths)
+    if texts:
+        chunks, parts = split_documents(texts)
+        batch = await submit_batch(build_batch_file(chunks, response_format), client)
+        batch = await wait_for_batch(batch, client)
+        responses = await fetch_batch_results(batch, client)
+        results.update(merge_document_results(responses, parts))
+    return results
+
+
+def main():
+    """Run a bulk review from the command line."""
+    # Imported here so the routes are only loaded when running from the CLI.
+    # pylint: disable=import-outside-toplevel
+    from app.routes.minnisblad import create_docx_from_json, create_response_format
+    from app.routes.minnisblad_adstod import create_minnisblad_adstod_response_format
+
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n", maxsplit=1)[0])
+    parser.add_argument("paths", nargs="+", help="The .docx files to process.")
+    parser.add_argument(
+        "--kind", choices=["minnisblad", "minnisblad-adstod"], default="minnisblad-adstod"
+    )
+    parser.add_argument("--chapters", nargs="*", default=[])
+    parser.add_argument(
+        "--out", required=True, help="JSON file for reviews, folder for memos."
+    )
+    args = parser.parse_args()
+
+    if args.kind == "minnisblad":
+        response_format = create_response_format(args.chapters)
+    else:
+        response_format = create_minnisblad_adstod_response_format()
+    results = asyncio.run(run_bulk(args.paths, response_format))
+
+    if args.kind == "minnisblad":
+        out = Path(args.out)
+        out.mkdir(parents=True, exist_ok=True)
+        for name, result in results.items():
+            if "result" in result:
+                document = create_docx_from_json(result["result"], args.chapters)
+                (out / f"Frodi_minnisblad_{name}").write_bytes(document)
+        results = {name: r for name, r in results.items() if "error" in r}
+        args.out = out / "errors.json"
+    with open(args.out, "w", encoding="utf-8") as file:
+        json.dump(results, file, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
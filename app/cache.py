@@ -0,0 +1,201 @@
+"""Response cache for LLM calls.
+
+Responses are keyed on a hash of everything that determines them: the
+extracted text, the system prompt, the response format, the model and the
+sampling parameters. The cache has a bounded in-memory LRU tier with a TTL
+and an optional persistent tier stored through SQLModel. Expired rows of the
+persistent tier are deleted on write, at most every CACHE_SWEEP_INTERVAL
+seconds, so rows that are never read again don't pile up.
+"""
+
+import hashlib
+import json
+import os
+import time
+from collections import OrderedDict
+from datetime import timedelta
+from dotenv import load_dotenv
+from fastapi.concurrency import run_in_threadpool
+from sqlmodel import delete
+from app.database import get_session
+from app.models import CachedResponse, utcnow
+from app.response_format import canonical_json
+
+load_dotenv()
+
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", "256"))
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", "86400"))
+RESPONSE_CACHE_PERSIST = os.getenv("RESPONSE_CACHE_PERSIST", "false").lower() == "true"
+CACHE_SWEEP_INTERVAL = float(os.getenv("CACHE_SWEEP_INTERVAL", "3600"))
+
+
+def make_cache_key(*parts) -> str:
+    """Hash the JSON-serializable parts of a request into a cache key."""
+    return hashlib.sha256(canonical_json(parts).encode("utf-8")).hexdigest()
+
+
+class LRUCache:
+    """A bounded in-memory LRU cache where entries expire after a TTL."""
+
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key):
+        """Return the cached value or None if it is missing or expired."""
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            del self._entries[key]
+            self.expirations += 1
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def peek(self, key):
+        """Return the cached value or None, without counting or refreshing it."""
+        entry = self._entries.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            return None
+        return entry[1]
+
+    def set(self, key, value):
+        """Store a value, evicting the least recently used entries if full."""
+        self._entries[key] = (time.monotonic() + self.ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def values(self) -> list:
+        """Return the stored values, including ones that have expired."""
+        return [value for _, value in self._entries.values()]
+
+    def clear(self):
+        """Remove all entries and reset the statistics."""
+        self._entries.clear()
+        self.hits = self.misses = self.evictions = self.expirations = 0
+
+    def stats(self) -> dict:
+        """Return the cache statistics."""
+        return {
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
+
+
+class ResponseCache:
+    """Two-tier cache for LLM responses.
+
+    Values are the raw JSON strings returned by the model, so a hit is
+    decoded into a fresh dict and callers can't change the cached copy.
+    """
+
+    def __init__(self, max_size: int, ttl: float, persist: bool = False):
+        self.memory = LRUCache(max_size, ttl)
+        self.persist = persist
+        self.persistent_hits = 0
+        self.persistent_misses = 0
+        self.persistent_writes = 0
+        self.persistent_expired = 0
+        self.last_sweep = None
+
+    async def get(self, key: str):
+        """Return the cached response for the key, or None on a miss."""
+        content = self.memory.get(key)
+        if content is None and self.persist:
+            content = await run_in_threadpool(self._load, key)
+            if content is None:
+                self.persistent_misses += 1
+            else:
+                self.persistent_hits += 1
+                self.memory.set(key, content)
+        return None if content is None else json.loads(content)
+
+    async def set(self, key: str, content: str):
+        """Cache the raw JSON content of a response."""
+        self.memory.set(key, content)
+        if self.persist:
+            await run_in_threadpool(self._store, key, content)
+            self.persistent_writes += 1
+            await self.sweep()
+
+    async def sweep(self, force: bool = False):
+        """Delete the expired rows of the persistent tier.
+
+        Unless forced, this is done at most every CACHE_SWEEP_INTERVAL seconds.
+        """
+        now = time.monotonic()
+        if not force and self.last_sweep is not None:
+            if now - self.last_sweep < CACHE_SWEEP_INTERVAL:
+                return
+        self.last_sweep = now
+        cutoff = utcnow() - timedelta(seconds=self.memory.ttl)
+        self.persistent_expired += await run_in_threadpool(self._sweep, cutoff)
+
+    def _load(self, key: str):
+        with get_session() as session:
+            cached = session.get(CachedResponse, key)
+            if cached is None:
+                return None
+            if cached.created_at < utcnow() - timedelta(seconds=self.memory.ttl):
+                session.delete(cached)
+                session.commit()
+                return None
+            return cached.response
+
+    def _store(self, key: str, content: str):
+        with get_session() as session:
+            session.merge(CachedResponse(key=key, response=content))
+            session.commit()
+
+    @staticmethod
+    def _sweep(cutoff) -> int:
+        with get_session() as session:
+            deleted = session.exec(
+                delete(CachedResponse).where(CachedResponse.created_at < cutoff)
+            ).rowcount
+            session.commit()
+            return deleted
+
+    def clear(self):
+        """Clear the in-memory tier and reset the statistics."""
+        self.memory.clear()
+        self.persistent_hits = self.persistent_misses = self.persistent_writes = 0
+        self.persistent_expired = 0
+
+    def stats(self) -> dict:
+        """Return the statistics for both tiers."""
+        return {
+            "memory": self.memory.stats(),
+            "persistent": {
+                "enabled": self.persist,
+                "hits": self.persistent_hits,
+                "misses": self.persistent_misses,
+                "writes": self.persistent_writes,
+                "expired": self.persistent_expired,
+            },
+        }
+
+
+response_cache = ResponseCache(
+    RESPONSE_CACHE_SIZE, RESPONSE_CACHE_TTL, persist=RESPONSE_CACHE_PERSIST
+)
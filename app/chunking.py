@@ -0,0 +1,135 @@
+"""Splitting long documents into chunks and merging the per-chunk responses.
+
+A document that does not fit in one request is split on paragraph
+boundaries into chunks that each fit a token budget. The chunks are sent
+concurrently and their responses merged into one, so a long document takes
+about as long as a single chunk.
+"""
+
+import os
+import re
+from dotenv import load_dotenv
+from app.tokens import count_tokens, measure_tokens
+
+load_dotenv()
+
+CHUNK_TOKENS = int(os.getenv("CHUNK_TOKENS", "10000"))
+# Fields that describe the whole response rather than a part of the document,
+# so they are taken from the first chunk only.
+KEEP_FIRST_KEYS = {"titill", "name", "type"}
+
+SENTENCE_END = re.compile(r"(?<=[.!?])\s+")
+HEADING_MAX_WORDS = 12
+
+
+def is_heading(paragraph: str) -> bool:
+    """Guess whether a paragraph is a heading: short and not a sentence."""
+    paragraph = paragraph.strip()
+    return (
+        bool(paragraph)
+        and len(paragraph.split()) <= HEADING_MAX_WORDS
+        and not paragraph.endswith((".", "!", "?"))
+    )
+
+
+def split_paragraph(paragraph: str, max_tokens: int) -> list:
+    """Split a paragraph that is over the budget on sentences, then on words.
+
+    Returns the pieces with their token counts.
+    """
+    pieces = []
+    for sentence in SENTENCE_END.split(paragraph):
+        size = measure_tokens(sentence)
+        if size <= max_tokens:
+            pieces.append((sentence, size))
+            continue
+        # The words are counted one at a time, with the space before them,
+        # rather than the whole piece again for each word.
+        words = []
+        size = 0
+        for word in sentence.split():
+            word_size = measure_tokens(" " + word)
+            if words and size + word_size > max_tokens:
+                pieces.append((" ".join(words), size))
+                words = []
+                size = 0
+            words.append(word)
+            size += word_size
+        pieces.append((" ".join(words), size))
+    return pieces
+
+
+def pack_pieces(pieces: list, max_tokens: int, separator: str) -> list:
+    """Pack consecutive pieces into as few groups as fit the budget.
+
+    The pieces come with their token counts, and the count of a group is
+    their sum with a separator after each.
+    """
+    separator_size = measure_tokens(separator)
+    groups = []
+    current = []
+    size = 0
+    for piece, piece_size in pieces:
+        piece_size += separator_size
+        if current and size + piece_size > max_tokens:
+            groups.append((current, size))
+            current = []
+            size = 0
+        current.append(piece)
+        size += piece_size
+    groups.append((current, size))
+    return groups
+
+
+def split_text(text: str, max_tokens: int = None) -> list:
+    """Split a text into chunks of about ``max_tokens`` tokens at most.
+
+    Chunks end on paragraph boundaries, and a heading is moved to the next
+    chunk rather than being left at the end of one. Paragraphs that are too
+    long on their own are split on sentences. Each piece is counted once and
+    the counts are added up, rather than counting the chunks as they grow.
+    """
+    max_tokens = max_tokens or CHUNK_TOKENS
+    if count_tokens(text) <= max_tokens:
+        return [text]
+    pieces = []
+    for paragraph in text.split("\n"):
+        size = measure_tokens(paragraph)
+        if size > max_tokens:
+            sentences = split_paragraph(paragraph, max_tokens)
+            pieces.extend(
+                (" ".join(group), group_size)
+                for group, group_size in pack_pieces(sentences, max_tokens, " ")
+            )
+        else:
+            pieces.append((paragraph, size))
+    groups = [group for group, _ in pack_pieces(pieces, max_tokens, "\n")]
+    for previous, group in zip(groups, groups[1:]):
+        if len(previous) > 1 and is_heading(previous[-1]):
+            group.insert(0, previous.pop())
+    return ["\n".join(group) for group in groups]
+
+
+def merge_responses(responses: list):
+    """Merge the responses for the chunks of a document into one.
+
+    Objects are merged key by key, lists are joined and text is joined by
+    paragraph with repeated feedback dropped. Fields in KEEP_FIRST_KEYS come
+    from the first chunk.
+    """
+    first = responses[0]
+    if isinstance(first, dict):
+        merged = {}
+        for key, value in first.items():
+            values = [r[key] for r in responses if isinstance(r, dict) and key in r]
+            merged[key] = value if key in KEEP_FIRST_KEYS else merge_responses(values)
+        return merged
+    if isinstance(first, list):
+        return [item for response in responses for item in response]
+    if isinstance(first, str):
+        parts = []
+        for response in responses:
+            if response.strip() and response.strip() not in parts:
+                parts.append(response.strip())
+        return "\n\n".join(parts)
+    return first
@@ -0,0 +1,62 @@
+"""Citation rewriting for assistant replies.
+
+The assistant cites its file search results with markers like
+``【4:0†skjal.pdf】``. These are replaced with short numeric references and a
+"Sources" footer listing the files is added at the end of the reply.
+"""
+
+import re
+
+# A complete citation marker; the file name follows the first dagger.
+CITATION_PATTERN = re.compile(r"【([^【】\n]*)】")
+
+# Unterminated markers longer than this are passed through as plain text.
+MAX_MARKER_LENGTH = 512
+
+
+class CitationRewriter:
+    """Rewrite citation markers in a reply that arrives in chunks.
+
+    Each chunk is scanned once. A marker that is split across chunks is held
+    back until its closing bracket arrives, and sources are numbered in the
+    order they are first seen.
+    """
+
+    def __init__(self):
+        self.sources = {}
+        self._pending = ""
+
+    def _replace(self, match) -> str:
+        marker = match.group(1)
+        if "†" not in marker:
+            return match.group(0)
+        file_name = marker.split("†", 1)[1]
+        index = self.sources.setdefault(file_name, len(self.sources) + 1)
+        return f"【{index}】"
+
+    def feed(self, chunk: str) -> str:
+        """Rewrite the next chunk and return the text that is ready to send."""
+        if not self._pending and "【" not in chunk:
+            return chunk
+        text = self._pending + chunk
+        self._pending = ""
+        cut = text.rfind("【")
+        if cut != -1:
+            tail = text[cut:]
+            if (
+                "】" not in tail
+                and "\n" not in tail
+                and len(tail) <= MAX_MARKER_LENGTH
+            ):
+                text, self._pending = text[:cut], tail
+        return CITATION_PATTERN.sub(self._replace, text)
+
+    def finish(self) -> str:
+        """Return any held back text followed by the sources footer."""
+        text, self._pending = self._pending, ""
+        if self.sources:
+            sources_list = "\n".join(
+                f"{index}: {file}" for file, index in self.sources.items()
+            )
+            text = f"{text}\n\nSources:\n{sources_list}"
+        return text
@@ -0,0 +1,127 @@
+"""Server-side store of assistant conversations.
+
+The most recent messages of each thread are kept in a bounded in-memory LRU
+with a TTL, and optionally stored through SQLModel. Reloading the page can
+then show the conversation without listing the thread from OpenAI.
+"""
+
+import json
+import os
+from datetime import timedelta
+from dotenv import load_dotenv
+from fastapi.concurrency import run_in_threadpool
+from sqlmodel import delete
+from app.cache import ResponseCache
+from app.database import get_session
+from app.metrics import CONVERSATION_CHARACTERS, CONVERSATIONS_STORED
+from app.models import Conversation, utcnow
+
+load_dotenv()
+
+CONVERSATION_CACHE_SIZE = int(os.getenv("CONVERSATION_CACHE_SIZE", "1000"))
+CONVERSATION_TTL = float(os.getenv("CONVERSATION_TTL", "604800"))
+CONVERSATION_MAX_MESSAGES = int(os.getenv("CONVERSATION_MAX_MESSAGES", "20"))
+CONVERSATION_PERSIST = os.getenv("CONVERSATION_PERSIST", "false").lower() == "true"
+
+
+class ConversationStore(ResponseCache):
+    """Two-tier store of the most recent messages per thread.
+
+    Messages are dicts with a ``role`` and a ``text``. Like cached responses
+    they are stored as JSON strings, so callers always get a fresh list, and
+    the memory they use is capped at CONVERSATION_CACHE_SIZE threads of at
+    most CONVERSATION_MAX_MESSAGES messages each. That memory is exported as
+    gauges whenever the store is read or written.
+    """
+
+    def __init__(
+        self, max_size: int, ttl: float, max_messages: int, persist: bool = False
+    ):
+        super().__init__(max_size, ttl, persist=persist)
+        self.max_messages = max_messages
+
+    async def get(self, key: str):
+        """Return the stored messages of a thread, or None if it is not stored."""
+        try:
+            return await super().get(key)
+        finally:
+            self.record_memory()
+
+    async def set(self, key: str, content: list):
+        """Store the messages of a thread, keeping only the most recent."""
+        try:
+            await super().set(
+                key, json.dumps(content[-self.max_messages :], ensure_ascii=False)
+            )
+        finally:
+            self.record_memory()
+
+    def characters(self) -> int:
+        """Return the characters of the messages kept in memory."""
+        return sum(map(len, self.memory.values()))
+
+    def record_memory(self):
+        """Export the threads and characters kept in memory as gauges."""
+        CONVERSATIONS_STORED.set(len(self.memory))
+        CONVERSATION_CHARACTERS.set(self.characters())
+
+    async def add(self, thread_id: str, *messages: dict) -> bool:
+        """Add messages to the end of a stored thread.
+
+        A thread that is not stored, for example after a restart, is left
+        alone rather than stored with only the new messages, and is listed
+        from OpenAI when it is next read. Returns whether it was stored.
+        """
+        content = self.memory.peek(thread_id)
+        if content is None and self.persist:
+            content = await run_in_threadpool(self._load, thread_id)
+        if content is None:
+            return False
+        await self.set(thread_id, json.loads(content) + list(messages))
+        return True
+
+    def _load(self, key: str):
+        with get_session() as session:
+            conversation = session.get(Conversation, key)
+            if conversation is None:
+                return None
+            if conversation.updated_at < utcnow() - timedelta(seconds=self.memory.ttl):
+                session.delete(conversation)
+                session.commit()
+                return None
+            return conversation.messages
+
+    @staticmethod
+    def _sweep(cutoff) -> int:
+        with get_session() as session:
+            deleted = session.exec(
+                delete(Conversation).where(Conversation.updated_at < cutoff)
+            ).rowcount
+            session.commit()
+            return deleted
+
+    def _store(self, key: str, content: str):
+        with get_session() as session:
+            conversation = session.get(Conversation, key)
+            if conversation is None:
+                conversation = Conversation(thread_id=key, messages=content)
+            else:
+                conversation.messages = content
+                conversation.updated_at = utcnow()
+            session.add(conversation)
+            session.commit()
+
+    def stats(self) -> dict:
+        """Return the statistics for both tiers and the memory in use."""
+        stats = super().stats()
+        stats["memory"]["max_messages"] = self.max_messages
+        stats["memory"]["characters"] = self.characters()
+        return stats
+
+
+conversation_store = ConversationStore(
+    CONVERSATION_CACHE_SIZE,
+    CONVERSATION_TTL,
+    CONVERSATION_MAX_MESSAGES,
+    persist=CONVERSATION_PERSIST,
+)
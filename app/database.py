@@ -0,0 +1,36 @@
+"""Database connection for the app."""
+
+import os
+from functools import lru_cache
+from dotenv import load_dotenv
+from sqlmodel import Session, create_engine
+
+load_dotenv()
+
+
+def get_database_url() -> str:
+    """Return the database URL, built from the Postgres settings by default."""
+    database_url = os.getenv("DATABASE_URL")
+    if database_url:
+        return database_url
+    return (
+        f"postgresql://{os.getenv('POSTGRES_USER')}:{os.getenv('POSTGRES_PASSWORD')}"
+        f"@{os.getenv('POSTGRES_SERVER')}:{os.getenv('POSTGRES_PORT')}"
+        f"/{os.getenv('POSTGRES_DB')}"
+    )
+
+
+def database_configured() -> bool:
+    """Check if a database is set, with DATABASE_URL or the Postgres settings."""
+    return bool(os.getenv("DATABASE_URL") or os.getenv("POSTGRES_SERVER"))
+
+
+@lru_cache(maxsize=1)
+def get_engine():
+    """Create the database engine the first time it is needed."""
+    return create_engine(get_database_url(), pool_pre_ping=True)
+
+
+def get_session() -> Session:
+    """Open a new database session."""
+    return Session(get_engine())
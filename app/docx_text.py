@@ -0,0 +1,145 @@
+"""Streaming text extraction from .docx files.
+
+The main document part is read straight out of the zip archive with an
+incremental XML parser, so the python-docx object model is never built and
+parsing stops as soon as a word limit is exceeded. The text matches what
+``Document(file).paragraphs`` would return.
+"""
+
+import posixpath
+import zipfile
+from typing import NamedTuple
+from lxml.etree import (  # pylint: disable=no-name-in-module
+    XMLSyntaxError,
+    fromstring,
+    iterparse,
+)
+
+W_NS = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+RELS_NS = "{http://schemas.openxmlformats.org/package/2006/relationships}"
+OFFICE_DOCUMENT_REL = (
+    "http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument"
+)
+DEFAULT_DOCUMENT_PART = "word/document.xml"
+
+# Upper bound on the uncompressed size of the document part, to bound the
+# work spent on hostile uploads such as zip bombs.
+MAX_DOCUMENT_PART_BYTES = 64 * 1024 * 1024
+
+BODY = W_NS + "body"
+PARAGRAPH = W_NS + "p"
+RUN = W_NS + "r"
+HYPERLINK = W_NS + "hyperlink"
+BREAK = W_NS + "br"
+TEXT = W_NS + "t"
+# Text equivalents of the run inner-content elements, as in python-docx.
+RUN_CONTENT = {
+    W_NS + "cr": "\n",
+    W_NS + "noBreakHyphen": "-",
+    W_NS + "ptab": "\t",
+    W_NS + "tab": "\t",
+}
+
+
+class InvalidDocxError(ValueError):
+    """Raised when a file is not a readable .docx document."""
+
+
+class DocxTooLargeError(InvalidDocxError):
+    """Raised when a part of a .docx document is over the size limit."""
+
+
+class DocxText(NamedTuple):
+    """The text of a document and its word count.
+
+    When ``truncated`` is true the word limit was exceeded, parsing stopped
+    early and ``text`` and ``word_count`` only cover the start of the document.
+    """
+
+    text: str
+    word_count: int
+    truncated: bool
+
+
+class _LimitedReader:  # pylint: disable=too-few-public-methods
+    """File wrapper that fails once more than ``limit`` bytes are read."""
+
+    def __init__(self, file, limit: int):
+        self._file = file
+        self._remaining = limit
+
+    def read(self, size: int = -1) -> bytes:
+        """Read from the wrapped file, enforcing the size limit."""
+        data = self._file.read(size)
+        self._remaining -= len(data)
+        if self._remaining < 0:
+            raise DocxTooLargeError("The document is too large.")
+        return data
+
+
+def _document_part_name(archive: zipfile.ZipFile) -> str:
+    """Find the main document part through the package relationships."""
+    try:
+        rels = fromstring(archive.read("_rels/.rels"))
+    except (KeyError, XMLSyntaxError):
+        return DEFAULT_DOCUMENT_PART
+    for rel in rels.iter(RELS_NS + "Relationship"):
+        if rel.get("Type") == OFFICE_DOCUMENT_REL:
+            return posixpath.normpath(rel.get("Target", "").lstrip("/"))
+    return DEFAULT_DOCUMENT_PART
+
+
+def _paragraph_text(paragraph) -> str:
+    """Return the text of a body paragraph element."""
+    parts = []
+    for child in paragraph:
+        if child.tag == RUN:
+            runs = (child,)
+        elif child.tag == HYPERLINK:
+            runs = child.iterchildren(RUN)
+        else:
+            continue
+        for run in runs:
+            for element in run:
+                if element.tag == TEXT:
+                    parts.append(element.text or "")
+                elif element.tag == BREAK:
+                    if element.get(W_NS + "type", "textWrapping") == "textWrapping":
+                        parts.append("\n")
+                elif element.tag in RUN_CONTENT:
+                    parts.append(RUN_CONTENT[element.tag])
+    return "".join(parts)
+
+
+def read_docx_text(file, max_words: int = None) -> DocxText:
+    """Extract the paragraph text and word count of a .docx file in one pass.
+
+    Parsing stops as soon as the word count goes over ``max_words``.
+    """
+    paragraphs = []
+    word_count = 0
+    try:
+        with zipfile.ZipFile(file) as archive:
+            with archive.open(_document_part_name(archive)) as part:
+                source = _LimitedReader(part, MAX_DOCUMENT_PART_BYTES)
+                depth = 0
+                for event, element in iterparse(
+                    source, events=("start", "end"), resolve_entities=False
+                ):
+                    if event == "start":
+                        depth += 1
+                        continue
+                    depth -= 1
+                    # Only paragraphs directly in the body, as in python-docx.
+                    if depth != 2 or element.getparent().tag != BODY:
+                        continue
+                    if element.tag == PARAGRAPH:
+                        text = _paragraph_text(element)
+                        paragraphs.append(text)
+                        word_count += len(text.split())
+                    element.getparent().remove(element)
+                    if max_words is not None and word_count > max_words:
+                        return DocxText("\n".join(paragraphs), word_count, True)
+    except (zipfile.BadZipFile, KeyError, XMLSyntaxError, EOFError) as e:
+        raise InvalidDocxError("The file is not a valid .docx document.") from e
+    return DocxText("\n".join(paragraphs), word_count, False)
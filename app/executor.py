@@ -0,0 +1,166 @@
+"""Executor for the CPU-bound docx work.
+
+Parsing uploads and rendering memos with python-docx and lxml would hold the
+event loop for as long as they take, so they are run with ``run_cpu``
+instead. With CPU_EXECUTOR=thread, the default, they run on a thread pool,
+which keeps the loop free to serve other requests. With CPU_EXECUTOR=process
+they run in a pool of warm worker processes, with python-docx and the memo
+template already loaded, which spreads the work across cores. Each worker
+process has a memory limit, and a task that runs over CPU_TASK_TIMEOUT is
+interrupted. A thread can't be interrupted, so in thread mode a task that
+times out is only abandoned, and the memory limit does not apply. The
+limits use Unix signals and resource limits, so on Windows the worker
+processes have neither, and a task that times out is only abandoned there
+too.
+"""
+
+import asyncio
+import logging
+import multiprocessing
+import os
+import signal
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from dotenv import load_dotenv
+from fastapi.concurrency import run_in_threadpool
+from app.memo import CHAPTERS, get_renderer
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+load_dotenv()
+
+CPU_EXECUTOR = os.getenv("CPU_EXECUTOR", "thread")
+CPU_WORKERS = int(os.getenv("CPU_WORKERS", str(min(4, os.cpu_count() or 1))))
+CPU_TASK_TIMEOUT = float(os.getenv("CPU_TASK_TIMEOUT", "30"))
+CPU_WORKER_MEMORY_MB = int(os.getenv("CPU_WORKER_MEMORY_MB", "1024"))
+# Worker processes are replaced after this many tasks, to return memory.
+CPU_WORKER_MAX_TASKS = int(os.getenv("CPU_WORKER_MAX_TASKS", "500"))
+# How much longer to wait for a worker that is stuck where it can't be
+# interrupted, such as inside lxml, before giving up on it.
+TIMEOUT_GRACE = 5
+WORKER_LIMITS = resource is not None and hasattr(signal, "setitimer")
+
+logger = logging.getLogger(__name__)
+
+
+class TaskLimitError(RuntimeError):
+    """Raised when a task runs over its time or memory limit."""
+
+
+def _interrupt(signum, frame):
+    raise TimeoutError("The task was interrupted.")
+
+
+def init_worker(memory_mb: int):
+    """Limit the memory of a worker process and load python-docx in it."""
+    if WORKER_LIMITS:
+        if memory_mb:
+            limit = memory_mb * 1024 * 1024
+            resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+        signal.signal(signal.SIGALRM, _interrupt)
+    get_renderer(frozenset(chapter.key for chapter in CHAPTERS))
+
+
+def run_limited(function, args: tuple, timeout: float):
+    """Run a task in a worker process, interrupting it after ``timeout`` seconds."""
+    if WORKER_LIMITS:
+        signal.setitimer(signal.ITIMER_REAL, timeout)
+    try:
+        return function(*args)
+    except TimeoutError as e:
+        raise TaskLimitError(f"The task took longer than {timeout:g} seconds.") from e
+    except MemoryError as e:
+        raise TaskLimitError("The task ran out of memory.") from e
+    finally:
+        if WORKER_LIMITS:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+
+
+class CPUExecutor:
+    """A thread or process pool for CPU-bound tasks, with per-task limits."""
+
+    def __init__(  # pylint: disable=too-many-arguments
+        self,
+        kind: str = CPU_EXECUTOR,
+        workers: int = CPU_WORKERS,
+        timeout: float = CPU_TASK_TIMEOUT,
+        memory_mb: int = CPU_WORKER_MEMORY_MB,
+        max_tasks: int = CPU_WORKER_MAX_TASKS,
+    ):
+        if kind not in ("thread", "process"):
+            raise ValueError(f"Unknown executor kind: {kind}")
+        self.kind = kind
+        self.workers = workers
+        self.timeout = timeout
+        self.memory_mb = memory_mb
+        self.max_tasks = max_tasks
+        self._pool = None
+
+    @property
+    def pool(self):
+        """The pool, created on first use."""
+        if self._pool is None:
+            if self.kind == "process":
+                if not WORKER_LIMITS:
+                    logger.warning(
+                        "The memory and time limits of the CPU workers are off on this platform"
+                    )
+                self._pool = ProcessPoolExecutor(
+                    self.workers,
+                    mp_context=multiprocessing.get_context("spawn"),
+                    initializer=init_worker,
+                    initargs=(self.memory_mb,),
+                    max_tasks_per_child=self.max_tasks or None,
+                )
+            else:
+                self._pool = ThreadPoolExecutor(self.workers, thread_name_prefix="cpu")
+        return self._pool
+
+    async def run(self, function, *args):
+        """Run ``function(*args)`` on the pool and return its result.
+
+        In process mode the function and its arguments must be picklable.
+        Raises TaskLimitError if the task runs over its limits.
+        """
+        loop = asyncio.get_running_loop()
+        pool = self.pool
+        if self.kind == "process":
+            future = loop.run_in_executor(pool, run_limited, function, args, self.timeout)
+            wait = self.timeout + TIMEOUT_GRACE
+        else:
+            future = loop.run_in_executor(pool, function, *args)
+            wait = self.timeout
+        try:
+            return await asyncio.wait_for(future, wait)
+        except asyncio.TimeoutError as e:
+            raise TaskLimitError(
+                f"The task took longer than {self.timeout:g} seconds."
+            ) from e
+        except BrokenProcessPool as e:
+            # A worker was killed, most likely for using too much memory. All
+            # the tasks on the pool fail, and only the first replaces it.
+            if self._pool is pool:
+                self._pool = None
+                pool.shutdown(wait=False)
+            raise TaskLimitError("The worker running the task died.") from e
+
+    async def start(self):
+        """Start the workers now rather than on the first upload."""
+        await asyncio.gather(*(self.run(os.getpid) for _ in range(self.workers)))
+
+    async def stop(self):
+        """Stop the workers."""
+        if self._pool is not None:
+            pool, self._pool = self._pool, None
+            await run_in_threadpool(pool.shutdown, cancel_futures=True)
+
+
+cpu_executor = CPUExecutor()
+
+
+async def run_cpu(function, *args):
+    """Run a CPU-bound function on the shared executor."""
+    return await cpu_executor.run(function, *args)
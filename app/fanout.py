@@ -0,0 +1,136 @@
+"""Generation of memos one chapter at a time.
+
+A whole memo in one structured output call takes as long as generating all
+of it in sequence. In fan-out mode an outline call first plans the title and
+the chapters, and then every chapter and every selected section is written
+by its own small call, all at the same time. The sections don't depend on
+the outline, so they are started together with it. The parts are put back
+together into the same JSON as a single call returns, so the memo is
+rendered the same way.
+"""
+
+import asyncio
+import os
+from dotenv import load_dotenv
+from app.memo import CHAPTERS, DEFAULT_TITLE, KAFLAR_KEY, TITLE_KEY
+from app.response_format import ResponseFormat
+from app.tracing import span
+from app.utils import send_text_to_openai
+
+load_dotenv()
+
+MEMO_FANOUT = os.getenv("MEMO_FANOUT", "false").lower() == "true"
+# The most chapters the outline may plan, to bound the calls per memo.
+MEMO_FANOUT_MAX_CHAPTERS = int(os.getenv("MEMO_FANOUT_MAX_CHAPTERS", "8"))
+
+
+def string_object(properties: dict) -> dict:
+    """Build a strict object schema of string properties and their descriptions."""
+    return {
+        "type": "object",
+        "properties": {
+            key: {"type": "string", "description": description}
+            for key, description in properties.items()
+        },
+        "required": list(properties),
+        "additionalProperties": False,
+    }
+
+
+def string_format(name: str, properties: dict) -> ResponseFormat:
+    """Build a strict response format with the given string properties."""
+    return ResponseFormat(
+        {
+            "type": "json_schema",
+            "json_schema": {
+                "name": name,
+                "strict": True,
+                "schema": string_object(properties),
+            },
+        }
+    )
+
+
+OUTLINE_FORMAT = ResponseFormat(
+    {
+        "type": "json_schema",
+        "json_schema": {
+            "name": "minnisblad_efnisyfirlit",
+            "strict": True,
+            "schema": {
+                "type": "object",
+                "properties": {
+                    TITLE_KEY: {
+                        "type": "string",
+                        "description": "Titill minnisblaðsins.",
+                    },
+                    KAFLAR_KEY: {
+                        "type": "array",
+                        "description": (
+                            "Kaflar minnisblaðsins í réttri röð, "
+                            f"í mesta lagi {MEMO_FANOUT_MAX_CHAPTERS}."
+                        ),
+                        "items": string_object(
+                            {
+                                "chapter_title": "Titill kafla.",
+                                "lysing": "Stutt lýsing á efni kaflans.",
+                            }
+                        ),
+                    },
+                },
+                "required": [TITLE_KEY, KAFLAR_KEY],
+                "additionalProperties": False,
+            },
+        },
+    }
+)
+
+
+def chapter_format(plan: dict) -> ResponseFormat:
+    """Build the response format for writing one planned chapter."""
+    return string_format(
+        "minnisblad_kafli",
+        {
+            "content": (
+                f"Innihald kaflans „{plan.get('chapter_title', '')}“ í "
+                f"minnisblaðinu. {plan.get('lysing', '')}"
+            )
+        },
+    )
+
+
+def section_format(chapter) -> ResponseFormat:
+    """Build the response format for writing one selected section."""
+    return string_format(f"minnisblad_{chapter.key}", {chapter.key: chapter.description})
+
+
+async def write_chapters(text: str) -> tuple:
+    """Plan the memo, then write all its chapters concurrently."""
+    with span("memo_outline"):
+        outline = await send_text_to_openai(text, OUTLINE_FORMAT)
+    plans = outline.get(KAFLAR_KEY, [])[:MEMO_FANOUT_MAX_CHAPTERS]
+    contents = await asyncio.gather(
+        *(send_text_to_openai(text, chapter_format(plan)) for plan in plans)
+    )
+    chapters = [
+        {"chapter_title": plan.get("chapter_title", ""), "content": content.get("content", "")}
+        for plan, content in zip(plans, contents)
+    ]
+    return outline.get(TITLE_KEY, DEFAULT_TITLE), chapters
+
+
+async def generate_memo_fanout(text: str, selected_chapters: list) -> dict:
+    """Generate a memo with one call per chapter and section.
+
+    Returns the same JSON as a single call with the full response format.
+    """
+    sections = [chapter for chapter in CHAPTERS if chapter.key in selected_chapters]
+    with span("memo_fanout", sections=len(sections)):
+        (title, chapters), *written = await asyncio.gather(
+            write_chapters(text),
+            *(send_text_to_openai(text, section_format(chapter)) for chapter in sections),
+        )
+    memo = {TITLE_KEY: title, KAFLAR_KEY: chapters}
+    for chapter, section in zip(sections, written):
+        memo[chapter.key] = section.get(chapter.key, "")
+    return memo
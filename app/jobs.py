@@ -0,0 +1,234 @@
+"""Background job queue for long-running uploads.
+
+Jobs are stored through SQLModel so they survive a restart. Each process
+runs a pool of asyncio workers that take job ids from an in-memory queue and
+also poll the database, so jobs queued by another process are picked up too.
+Each poll also queues again the running jobs whose lease has run out, which
+were left behind by a crashed worker. A running job renews its lease every
+JOB_HEARTBEAT seconds, so a long job is not taken for a dead one. A job is
+claimed with a conditional update, so only one worker ever runs it, and its
+result is only stored while the claim still holds. Finished jobs, with
+their text and results, are deleted JOB_RETENTION seconds after they end.
+"""
+
+import asyncio
+import logging
+import os
+import uuid
+from datetime import timedelta
+from dotenv import load_dotenv
+from fastapi.concurrency import run_in_threadpool
+from sqlmodel import delete, select, update
+from app.batch import error_detail
+from app.database import database_configured, get_session
+from app.models import Job, utcnow
+
+load_dotenv()
+
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "2"))
+JOB_POLL_INTERVAL = float(os.getenv("JOB_POLL_INTERVAL", "5"))
+# A running job that has not been updated for this long is assumed to belong
+# to a worker that died, and is queued again.
+JOB_LEASE = float(os.getenv("JOB_LEASE", "600"))
+JOB_HEARTBEAT = JOB_LEASE / 4
+# The time a job has for its upstream calls, shorter than the lease.
+JOB_DEADLINE = float(os.getenv("JOB_DEADLINE", str(JOB_LEASE * 0.8)))
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+JOB_RETENTION = float(os.getenv("JOB_RETENTION", "604800"))
+
+logger = logging.getLogger(__name__)
+
+
+def requeue_stale(session):
+    """Queue again the running jobs whose lease has run out.
+
+    Jobs that have been interrupted JOB_MAX_ATTEMPTS times are failed instead.
+    """
+    lease_start = utcnow() - timedelta(seconds=JOB_LEASE)
+    stale = (Job.status == "running", Job.updated_at < lease_start)
+    session.exec(
+        update(Job)
+        .where(*stale, Job.attempts >= JOB_MAX_ATTEMPTS)
+        .values(status="failed", error="The job was interrupted too many times.")
+    )
+    session.exec(update(Job).where(*stale).values(status="queued"))
+
+
+def purge_finished(session):
+    """Delete the jobs that ended more than JOB_RETENTION seconds ago."""
+    session.exec(
+        delete(Job).where(
+            Job.status.in_(("completed", "failed")),
+            Job.updated_at < utcnow() - timedelta(seconds=JOB_RETENTION),
+        )
+    )
+
+
+def _claimed(job: Job) -> tuple:
+    """Return the conditions under which a job is still held by its claim."""
+    return (Job.id == job.id, Job.status == "running", Job.attempts == job.attempts)
+
+
+class JobQueue:
+    """Queue of jobs stored in the database and drained by async workers.
+
+    ``handlers`` maps a job kind to a coroutine function that takes the job
+    and returns the fields to store on it when it completes.
+    """
+
+    def __init__(self, handlers: dict):
+        self.handlers = handlers
+        self._queue = None
+        self._workers = []
+
+    async def submit(self, kind: str, text: str, **fields) -> Job:
+        """Store a new job and queue it for the workers."""
+        job = Job(id=uuid.uuid4().hex, kind=kind, text=text, **fields)
+        job = await run_in_threadpool(self._insert, job)
+        if self._queue is not None:
+            self._queue.put_nowait(job.id)
+        return job
+
+    async def get(self, job_id: str):
+        """Return the job with the given id, or None if there is none."""
+        return await run_in_threadpool(self._load, job_id)
+
+    async def start(self, workers: int = JOB_WORKERS):
+        """Start the workers after queueing the jobs left from a previous run.
+
+        Nothing is started when no database is configured.
+        """
+        if not database_configured():
+            logger.info("No database is configured, so the job workers are not started")
+            return
+        self._queue = asyncio.Queue()
+        try:
+            for job_id in await run_in_threadpool(self._recover):
+                self._queue.put_nowait(job_id)
+        except Exception:  # pylint: disable=broad-except
+            logger.exception("Could not recover queued jobs")
+        self._workers = [asyncio.create_task(self._work()) for _ in range(workers)]
+
+    async def stop(self):
+        """Stop the workers. Jobs they were running are picked up on restart."""
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        self._queue = None
+
+    async def _next_job_id(self):
+        try:
+            return await asyncio.wait_for(self._queue.get(), timeout=JOB_POLL_INTERVAL)
+        except asyncio.TimeoutError:
+            return await run_in_threadpool(self._find_queued)
+
+    async def _work(self):
+        while True:
+            try:
+                job_id = await self._next_job_id()
+                if job_id is None:
+                    continue
+                job = await run_in_threadpool(self._claim, job_id)
+                if job is not None:
+                    await self._run(job)
+            except Exception:  # pylint: disable=broad-except
+                logger.exception("Job worker failed")
+
+    async def _run(self, job: Job):
+        heartbeat = asyncio.create_task(self._heartbeat(job))
+        try:
+            fields = await self.handlers[job.kind](job)
+            status = "completed"
+        except Exception as e:  # pylint: disable=broad-except
+            logger.exception("Job %s failed", job.id)
+            status, fields = "failed", {"error": error_detail(e)}
+        finally:
+            heartbeat.cancel()
+        await run_in_threadpool(self._finish, job, status, fields)
+
+    async def _heartbeat(self, job: Job):
+        """Renew the lease of a running job until it ends or the lease is lost."""
+        while True:
+            await asyncio.sleep(JOB_HEARTBEAT)
+            try:
+                renewed = await run_in_threadpool(self._renew, job)
+            except Exception:  # pylint: disable=broad-except
+                logger.exception("Could not renew the lease of job %s", job.id)
+                continue
+            if not renewed:
+                logger.warning("Job %s lost its lease", job.id)
+                return
+
+    @staticmethod
+    def _insert(job: Job) -> Job:
+        with get_session() as session:
+            session.add(job)
+            session.commit()
+            session.refresh(job)
+            return job
+
+    @staticmethod
+    def _load(job_id: str):
+        with get_session() as session:
+            return session.get(Job, job_id)
+
+    @staticmethod
+    def _claim(job_id: str):
+        """Mark a queued job as running, unless another worker got it first."""
+        with get_session() as session:
+            claimed = session.exec(
+                update(Job)
+                .where(Job.id == job_id, Job.status == "queued")
+                .values(status="running", attempts=Job.attempts + 1, updated_at=utcnow())
+            ).rowcount
+            session.commit()
+            return session.get(Job, job_id) if claimed else None
+
+    @staticmethod
+    def _find_queued():
+        """Requeue stale jobs, purge old ones and return the oldest queued job id."""
+        with get_session() as session:
+            requeue_stale(session)
+            purge_finished(session)
+            session.commit()
+            return session.exec(
+                select(Job.id)
+                .where(Job.status == "queued")
+                .order_by(Job.created_at)
+                .limit(1)
+            ).first()
+
+    @staticmethod
+    def _renew(job: Job) -> bool:
+        """Renew the lease of a job, unless it has been taken from this worker."""
+        with get_session() as session:
+            renewed = session.exec(
+                update(Job).where(*_claimed(job)).values(updated_at=utcnow())
+            ).rowcount
+            session.commit()
+            return bool(renewed)
+
+    @staticmethod
+    def _finish(job: Job, status: str, fields: dict):
+        """Store the outcome of a job, unless it has been taken from this worker."""
+        with get_session() as session:
+            session.exec(
+                update(Job)
+                .where(*_claimed(job))
+                .values(status=status, updated_at=utcnow(), **fields)
+            )
+            session.commit()
+
+    @staticmethod
+    def _recover() -> list:
+        """Queue stale running jobs again and return the ids of queued jobs."""
+        with get_session() as session:
+            requeue_stale(session)
+            purge_finished(session)
+            session.commit()
+            return list(
+                session.exec(
+                    select(Job.id).where(Job.status == "queued").order_by(Job.created_at)
+                )
+            )
@@ -1,5 +1,6 @@
 """This is the main run file."""
 
+from contextlib import asynccontextmanager
 import uvicorn
 from dotenv import load_dotenv
 from fastapi import FastAPI
@@ -9,14 +10,42 @@ from app.routes.minnisblad import router as minnisblad_router
 from app.routes.minnisblad_adstod import router as minnisblad_adstod_router
 from app.routes.index import router as index_router
 from app.routes.adstod import router as adstod_router
+from app.routes.cache import router as cache_router
+from app.routes.jobs import router as jobs_router, job_queue
+from app.routes.metrics import router as metrics_router
+from app.jobs import JOB_WORKERS
+from app.executor import cpu_executor
+from app.metrics import MetricsMiddleware, mark_process_dead
+from app.openai_client import close_client
+from app import tracing
 
 load_dotenv()
 
-app = FastAPI()
+
+@asynccontextmanager
+async def lifespan(_: FastAPI):
+    """Start the CPU executor and job workers, and release them on shutdown."""
+    await cpu_executor.start()
+    if JOB_WORKERS:
+        await job_queue.start(JOB_WORKERS)
+    yield
+    await job_queue.stop()
+    await cpu_executor.stop()
+    await close_client()
+    mark_process_dead()
+    tracing.trace_sink.close()
+
+
+app = FastAPI(lifespan=lifespan)
+app.add_middleware(MetricsMiddleware)
+app.add_middleware(tracing.TracingMiddleware)
 app.include_router(minnisblad_router)
 app.include_router(index_router)
 app.include_router(minnisblad_adstod_router)
 app.include_router(adstod_router)
+app.include_router(cache_router)
+app.include_router(jobs_router)
+app.include_router(metrics_router)
 
 # serve static files
 app.mount(
@@ -0,0 +1,129 @@
+"""Rendering of generated memos (minnisblöð) to Word documents.
+
+The chapter table below drives both the response format sent to the model
+and the layout of the generated document. The base template is parsed once
+at startup and cloned for each document, and a renderer is compiled once for
+each chapter selection.
+"""
+
+import copy
+import os
+from functools import lru_cache
+from io import BytesIO
+from typing import NamedTuple
+from docx import Document
+from docx.shared import Cm, Pt, RGBColor
+from dotenv import load_dotenv
+
+load_dotenv()
+
+MINNISBLAD_TEMPLATE = os.getenv("MINNISBLAD_TEMPLATE")
+
+TITLE_KEY = "titill"
+DEFAULT_TITLE = "Titill Ekki Tiltækur"
+KAFLAR_KEY = "kaflar"
+
+
+class Chapter(NamedTuple):
+    """An optional memo chapter the user can select."""
+
+    key: str
+    heading: str
+    description: str
+    before_kaflar: bool
+
+
+CHAPTERS = (
+    Chapter("inngangur", "Inngangur", "Inngangur minnisblaðsins.", True),
+    Chapter("markmid", "Markmið", "Markmið minnisblaðsins.", True),
+    Chapter("aaetlun", "Áætlun", "Áætlun minnisblaðsins.", True),
+    Chapter("samantekt", "Samantekt", "Samantekt minnisblaðsins.", False),
+)
+CHAPTERS_BY_KEY = {chapter.key: chapter for chapter in CHAPTERS}
+
+HOUSE_FONT = "Calibri"
+HOUSE_COLOR = RGBColor(0x1F, 0x3A, 0x5F)
+
+
+def apply_house_styles(doc):
+    """Apply our fonts, heading colours and margins to a document."""
+    normal = doc.styles["Normal"]
+    normal.font.name = HOUSE_FONT
+    normal.font.size = Pt(11)
+    normal.paragraph_format.space_after = Pt(6)
+    for style_name, size in (("Heading 1", 16), ("Heading 2", 13)):
+        heading = doc.styles[style_name]
+        heading.font.name = HOUSE_FONT
+        heading.font.size = Pt(size)
+        heading.font.bold = True
+        heading.font.color.rgb = HOUSE_COLOR
+    for section in doc.sections:
+        section.top_margin = section.bottom_margin = Cm(2.5)
+        section.left_margin = section.right_margin = Cm(2.5)
+    doc.core_properties.author = "Fróði"
+
+
+def load_template():
+    """Load the base template and apply the house styles."""
+    doc = Document(MINNISBLAD_TEMPLATE)
+    apply_house_styles(doc)
+    return doc
+
+
+# The template is kept as a package rather than a Document, since cloning
+# the package also clones every element the document proxies point into.
+TEMPLATE_PACKAGE = load_template().part.package
+
+
+def new_document():
+    """Return a fresh document cloned from the template."""
+    return copy.deepcopy(TEMPLATE_PACKAGE).main_document_part.document
+
+
+class MemoRenderer:  # pylint: disable=too-few-public-methods
+    """Renders memos with a fixed chapter selection.
+
+    The order of the sections is worked out once when the renderer is built,
+    so rendering only clones the template and adds the paragraphs.
+    """
+
+    def __init__(self, chapter_keys: frozenset):
+        chapters = [chapter for chapter in CHAPTERS if chapter.key in chapter_keys]
+        self.before = [(c.key, c.heading) for c in chapters if c.before_kaflar]
+        self.after = [(c.key, c.heading) for c in chapters if not c.before_kaflar]
+
+    def render(self, response_json: dict) -> bytes:
+        """Render the response to a .docx file and return its bytes."""
+        doc = new_document()
+        doc.add_heading(response_json.get(TITLE_KEY, DEFAULT_TITLE), level=1)
+        for key, heading in self.before:
+            if key in response_json:
+                doc.add_heading(heading, level=2)
+                doc.add_paragraph(response_json[key])
+        for chapter in response_json.get(KAFLAR_KEY, ()):
+            doc.add_heading(chapter["chapter_title"], level=2)
+            doc.add_paragraph(chapter["content"])
+        for key, heading in self.after:
+            if key in response_json:
+                doc.add_heading(heading, level=2)
+                doc.add_paragraph(response_json[key])
+        buffer = BytesIO()
+        doc.save(buffer)
+        return buffer.getvalue()
+
+
+@lru_cache(maxsize=2 ** len(CHAPTERS))
+def get_renderer(chapter_keys: frozenset) -> MemoRenderer:
+    """Return the compiled renderer for a chapter selection."""
+    return MemoRenderer(chapter_keys)
+
+
+def render_memo(response_json: dict, selected_chapters: list = None) -> bytes:
+    """Render a memo response to a Word document.
+
+    When no chapter selection is given it is taken from the chapters present
+    in the response.
+    """
+    if selected_chapters is None:
+        selected_chapters = [key for key in CHAPTERS_BY_KEY if key in response_json]
+    return get_renderer(frozenset(selected_chapters)).render(response_json)
@@ -0,0 +1,207 @@
+"""Prometheus metrics for requests, processing stages and upstream usage.
+
+Requests are measured by a plain ASGI middleware, and the stages of a
+request, such as the docx parse or the LLM call, are timed with ``stage``.
+Routes are labelled with their path template so the number of series stays
+small. When ``PROMETHEUS_MULTIPROC_DIR`` is set, every uvicorn worker writes
+its metrics there and ``/metrics`` adds them up.
+"""
+
+import os
+import time
+from contextlib import contextmanager
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+from app.tracing import route_label, span
+
+# Stages run from milliseconds (parsing) to minutes (LLM calls and runs).
+STAGE_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+REQUESTS = Counter(
+    "http_requests_total", "HTTP requests handled.", ["method", "route", "status"]
+)
+REQUEST_DURATION = Histogram(
+    "http_request_duration_seconds",
+    "Time to handle an HTTP request, including writing the response.",
+    ["method", "route"],
+    buckets=STAGE_BUCKETS,
+)
+REQUESTS_IN_PROGRESS = Gauge(
+    "http_requests_in_progress",
+    "HTTP requests being handled.",
+    ["method"],
+    multiprocess_mode="livesum",
+)
+STAGE_DURATION = Histogram(
+    "stage_duration_seconds",
+    "Time spent in each stage of handling a request.",
+    ["stage"],
+    buckets=STAGE_BUCKETS,
+)
+STAGES_IN_PROGRESS = Gauge(
+    "stage_in_progress",
+    "Stages running right now, such as LLM calls in flight.",
+    ["stage"],
+    multiprocess_mode="livesum",
+)
+LLM_TOKENS = Counter(
+    "llm_tokens_total", "Tokens used by upstream LLM calls.", ["model", "kind"]
+)
+LLM_CALL_DURATION = Histogram(
+    "llm_call_duration_seconds",
+    "Time of each LLM call by model and route.",
+    ["model", "route"],
+    buckets=STAGE_BUCKETS,
+)
+LLM_ESCALATIONS = Counter(
+    "llm_escalations_total",
+    "LLM calls made again with the large model after invalid output.",
+    ["route"],
+)
+LLM_TRUNCATED = Counter(
+    "llm_truncated_total", "LLM responses cut off at their output budget."
+)
+UPSTREAM_RETRIES = Counter(
+    "upstream_retries_total", "Upstream requests that were retried.", ["reason"]
+)
+UPSTREAM_DEADLINES_EXCEEDED = Counter(
+    "upstream_deadline_exceeded_total",
+    "Upstream calls cancelled at the deadline of their request.",
+    ["operation"],
+)
+HEDGED_REQUESTS = Counter(
+    "upstream_hedged_requests_total",
+    "Upstream calls that were hedged, by which call answered first.",
+    ["operation", "winner"],
+)
+CIRCUIT_STATE = Gauge(
+    "upstream_circuit_state",
+    "State of the circuit breaker: 0 closed, 1 half open, 2 open.",
+    multiprocess_mode="max",
+)
+CONVERSATIONS_STORED = Gauge(
+    "conversation_store_threads",
+    "Threads kept in memory by the conversation store.",
+    multiprocess_mode="livesum",
+)
+CONVERSATION_CHARACTERS = Gauge(
+    "conversation_store_characters",
+    "Characters of the messages kept in memory by the conversation store.",
+    multiprocess_mode="livesum",
+)
+CIRCUIT_REJECTED = Counter(
+    "upstream_circuit_rejected_total", "Upstream calls rejected by an open circuit."
+)
+
+
+@contextmanager
+def stage(name: str):
+    """Time a stage of handling a request, and trace it as a span."""
+    STAGES_IN_PROGRESS.labels(name).inc()
+    start = time.perf_counter()
+    try:
+        with span(name) as item:
+            yield item
+    finally:
+        STAGE_DURATION.labels(name).observe(time.perf_counter() - start)
+        STAGES_IN_PROGRESS.labels(name).dec()
+
+
+@contextmanager
+def llm_call(model: str, route: str):
+    """Time an LLM call as the llm_call stage, and by its model and route."""
+    start = time.perf_counter()
+    try:
+        with stage("llm_call") as item:
+            if item is not None:
+                item.attributes.update(model=model, route=route)
+            yield item
+    finally:
+        LLM_CALL_DURATION.labels(model, route).observe(time.perf_counter() - start)
+
+
+def record_usage(model: str, usage):
+    """Count the tokens reported in the usage of a completion or run."""
+    if usage is None:
+        return
+    LLM_TOKENS.labels(model, "prompt").inc(usage.prompt_tokens or 0)
+    LLM_TOKENS.labels(model, "completion").inc(usage.completion_tokens or 0)
+
+
+class MetricsMiddleware:  # pylint: disable=too-few-public-methods
+    """ASGI middleware that measures every HTTP request.
+
+    Besides the total duration it records two stages: ``upload_read``, until
+    the whole request body has been received, and ``response_write``, from
+    the start of the response until its last byte has been sent.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        start = time.perf_counter()
+        method = scope["method"]
+        status = 500
+        response_started = start
+        body_seen = False
+
+        async def timed_receive():
+            nonlocal body_seen
+            message = await receive()
+            if message["type"] == "http.request":
+                body_seen = body_seen or bool(message.get("body"))
+                if body_seen and not message.get("more_body"):
+                    STAGE_DURATION.labels("upload_read").observe(
+                        time.perf_counter() - start
+                    )
+            return message
+
+        async def timed_send(message):
+            nonlocal status, response_started
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                response_started = time.perf_counter()
+            await send(message)
+            if message["type"] == "http.response.body" and not message.get(
+                "more_body"
+            ):
+                STAGE_DURATION.labels("response_write").observe(
+                    time.perf_counter() - response_started
+                )
+
+        REQUESTS_IN_PROGRESS.labels(method).inc()
+        try:
+            await self.app(scope, timed_receive, timed_send)
+        finally:
+            REQUESTS_IN_PROGRESS.labels(method).dec()
+            route = route_label(scope)
+            REQUESTS.labels(method, route, str(status)).inc()
+            REQUEST_DURATION.labels(method, route).observe(time.perf_counter() - start)
+
+
+def mark_process_dead():
+    """Drop the live gauges of this worker when it shuts down."""
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        multiprocess.mark_process_dead(os.getpid())
+
+
+def render_metrics() -> tuple:
+    """Return the metrics in the Prometheus text format and its content type."""
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
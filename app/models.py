@@ -0,0 +1,46 @@
+"""Database models for the app."""
+
+from datetime import datetime, timezone
+from typing import Optional
+from sqlmodel import Field, SQLModel
+
+
+def utcnow() -> datetime:
+    """Return the current UTC time as a naive datetime, as stored in the database."""
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+class CachedResponse(SQLModel, table=True):
+    """A cached LLM response, keyed on a hash of the request."""
+
+    __tablename__ = "cached_response"
+
+    key: str = Field(primary_key=True, max_length=64)
+    response: str
+    created_at: datetime = Field(default_factory=utcnow, index=True)
+
+
+class Job(SQLModel, table=True):
+    """A queued upload that is processed in the background."""
+
+    id: str = Field(primary_key=True, max_length=32)
+    kind: str = Field(max_length=32)
+    status: str = Field(default="queued", max_length=16, index=True)
+    text: str
+    chapters: Optional[str] = None
+    filename: Optional[str] = None
+    result: Optional[str] = None
+    document: Optional[bytes] = None
+    error: Optional[str] = None
+    attempts: int = 0
+    created_at: datetime = Field(default_factory=utcnow)
+    updated_at: datetime = Field(default_factory=utcnow)
+
+
+class Conversation(SQLModel, table=True):
+    """The most recent messages of an assistant thread."""
+
+    thread_id: str = Field(primary_key=True, max_length=64)
+    messages: str
+    created_at: datetime = Field(default_factory=utcnow)
+    updated_at: datetime = Field(default_factory=utcnow, index=True)
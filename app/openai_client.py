@@ -0,0 +1,56 @@
+"""Shared OpenAI client for the app.
+
+A single ``AsyncOpenAI`` instance is created per process so that every route
+reuses the same HTTP connection pool instead of opening new connections for
+each request. The pool is configured through environment variables. All
+requests go through the shared rate limiter, which also does the retries.
+"""
+
+import os
+import httpx
+from dotenv import load_dotenv
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient
+from app.rate_limit import RateLimitedTransport, rate_limiter
+
+load_dotenv()
+
+OPENAI_MAX_CONNECTIONS = int(os.getenv("OPENAI_MAX_CONNECTIONS", "100"))
+OPENAI_MAX_KEEPALIVE_CONNECTIONS = int(
+    os.getenv("OPENAI_MAX_KEEPALIVE_CONNECTIONS", "20")
+)
+OPENAI_KEEPALIVE_EXPIRY = float(os.getenv("OPENAI_KEEPALIVE_EXPIRY", "30"))
+OPENAI_CONNECT_TIMEOUT = float(os.getenv("OPENAI_CONNECT_TIMEOUT", "5"))
+OPENAI_TIMEOUT = float(os.getenv("OPENAI_TIMEOUT", "120"))
+
+
+def create_http_client() -> httpx.AsyncClient:
+    """Create the rate limited HTTP client with the configured connection pool."""
+    transport = httpx.AsyncHTTPTransport(
+        limits=httpx.Limits(
+            max_connections=OPENAI_MAX_CONNECTIONS,
+            max_keepalive_connections=OPENAI_MAX_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=OPENAI_KEEPALIVE_EXPIRY,
+        )
+    )
+    return DefaultAsyncHttpxClient(
+        transport=RateLimitedTransport(transport, rate_limiter),
+        timeout=httpx.Timeout(OPENAI_TIMEOUT, connect=OPENAI_CONNECT_TIMEOUT),
+    )
+
+
+def create_client() -> AsyncOpenAI:
+    """Create the async OpenAI client on top of the shared connection pool."""
+    return AsyncOpenAI(
+        api_key=os.getenv("OPENAI_API_KEY"),
+        http_client=create_http_client(),
+        # Retries are made by the rate limited transport.
+        max_retries=0,
+    )
+
+
+client = create_client()
+
+
+async def close_client():
+    """Close the shared client and release the pooled connections."""
+    await client.close()
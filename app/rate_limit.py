@@ -0,0 +1,245 @@
+"""Rate limiting and retries for all outbound OpenAI traffic.
+
+Every request made through the shared client passes through
+RateLimitedTransport. It takes a slot from a requests-per-minute and a
+tokens-per-minute token bucket before sending, so bursts queue up instead of
+being rejected with 429s. The buckets adapt to the ``x-ratelimit-*`` headers
+of each response, and rejected or failed requests are retried with jittered
+exponential backoff. A request waits and retries until the deadline of the
+request it serves runs out, or for OPENAI_RETRY_DEADLINE when it has none.
+"""
+
+import asyncio
+import json
+import os
+import random
+import time
+import httpx
+from dotenv import load_dotenv
+from app.metrics import UPSTREAM_RETRIES
+from app.tokens import count_prompt_tokens
+from app.upstream import QueueTimeout, current_deadline
+
+load_dotenv()
+
+OPENAI_REQUESTS_PER_MINUTE = float(os.getenv("OPENAI_REQUESTS_PER_MINUTE", "500"))
+OPENAI_TOKENS_PER_MINUTE = float(os.getenv("OPENAI_TOKENS_PER_MINUTE", "30000"))
+# The share of the quota the limiter aims for, to stay just under it.
+OPENAI_RATE_HEADROOM = float(os.getenv("OPENAI_RATE_HEADROOM", "0.9"))
+OPENAI_RETRY_DEADLINE = float(os.getenv("OPENAI_RETRY_DEADLINE", "60"))
+RETRY_INITIAL_BACKOFF = 0.5
+RETRY_MAX_BACKOFF = 20
+RETRY_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504}
+
+
+class RateLimitTimeout(httpx.TimeoutException, QueueTimeout):
+    """Raised when a request can't be sent within the retry deadline."""
+
+
+def retry_after(headers: httpx.Headers):
+    """Return the wait in seconds asked for by the provider, if any."""
+    for name, scale in (("retry-after-ms", 0.001), ("retry-after", 1)):
+        try:
+            return float(headers[name]) * scale
+        except (KeyError, ValueError):
+            continue
+    return None
+
+
+class TokenBucket:
+    """A token bucket that refills continuously up to its capacity.
+
+    The level may go below zero: a request that takes more than is left
+    reserves its share of the refill and waits until it has arrived. This
+    keeps waiting requests in the order they came in without a lock.
+    """
+
+    def __init__(self, per_minute: float):
+        self.capacity = per_minute
+        self.level = per_minute
+        self.updated = time.monotonic()
+
+    @property
+    def rate(self) -> float:
+        """The refill rate per second."""
+        return self.capacity / 60
+
+    def refill(self, now: float):
+        """Add what has been refilled since the last update."""
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, amount: float, now: float) -> float:
+        """Return how long taking ``amount`` would have to wait."""
+        self.refill(now)
+        missing = min(amount, self.capacity) - self.level
+        return max(0.0, missing / self.rate) if self.rate else 0.0
+
+    def take(self, amount: float):
+        """Take ``amount``, reserving future refill if there is not enough."""
+        self.level -= min(amount, self.capacity)
+
+    def adapt(self, limit, remaining, headroom: float):
+        """Follow the limit and remaining count reported by the provider."""
+        if limit:
+            self.capacity = limit * headroom
+            self.level = min(self.level, self.capacity)
+        if remaining is not None:
+            reserve = (limit or self.capacity / headroom) * (1 - headroom)
+            self.level = min(self.level, remaining - reserve)
+
+
+class RateLimiter:
+    """Requests-per-minute and tokens-per-minute limits shared by all requests."""
+
+    def __init__(
+        self,
+        requests_per_minute: float = OPENAI_REQUESTS_PER_MINUTE,
+        tokens_per_minute: float = OPENAI_TOKENS_PER_MINUTE,
+        headroom: float = OPENAI_RATE_HEADROOM,
+    ):
+        self.headroom = headroom
+        self.requests = TokenBucket(requests_per_minute * headroom)
+        self.tokens = TokenBucket(tokens_per_minute * headroom)
+        self.paused_until = 0.0
+        self.waiting = 0
+        self.throttled = 0
+        self.retries = 0
+
+    async def acquire(self, tokens: int, deadline: float):
+        """Wait for a request slot and ``tokens`` tokens, in arrival order."""
+        now = time.monotonic()
+        delay = max(
+            self.paused_until - now,
+            self.requests.delay(1, now),
+            self.tokens.delay(tokens, now),
+        )
+        if now + delay > deadline:
+            raise RateLimitTimeout("The rate limit queue is longer than the deadline.")
+        self.requests.take(1)
+        self.tokens.take(tokens)
+        if delay > 0:
+            self.waiting += 1
+            try:
+                await asyncio.sleep(delay)
+            finally:
+                self.waiting -= 1
+
+    def update(self, headers: httpx.Headers):
+        """Adapt the buckets to the rate limit headers of a response."""
+        for bucket, kind in ((self.requests, "requests"), (self.tokens, "tokens")):
+            limit = headers.get(f"x-ratelimit-limit-{kind}")
+            remaining = headers.get(f"x-ratelimit-remaining-{kind}")
+            if limit or remaining:
+                bucket.refill(time.monotonic())
+                bucket.adapt(
+                    float(limit) if limit else None,
+                    float(remaining) if remaining else None,
+                    self.headroom,
+                )
+
+    def pause(self, seconds: float):
+        """Hold back every request for a while, after a 429."""
+        self.throttled += 1
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def stats(self) -> dict:
+        """Return the current limits, levels and counters."""
+        return {
+            "requests_per_minute": self.requests.capacity,
+            "tokens_per_minute": self.tokens.capacity,
+            "requests_available": self.requests.level,
+            "tokens_available": self.tokens.level,
+            "waiting": self.waiting,
+            "throttled": self.throttled,
+            "retries": self.retries,
+        }
+
+
+def request_tokens(request: httpx.Request) -> int:
+    """Estimate the tokens a request counts against the quota.
+
+    Like the provider, this counts the prompt and the completion limit.
+    Requests other than completions are only counted as requests.
+    """
+    if request.method != "POST" or not isinstance(request.stream, httpx.ByteStream):
+        return 0
+    try:
+        body = json.loads(request.content)
+    except ValueError:
+        return 0
+    if not isinstance(body, dict) or "messages" not in body:
+        return 0
+    completion = body.get("max_completion_tokens") or body.get("max_tokens") or 0
+    prompt = count_prompt_tokens(body["messages"], body.get("response_format"))
+    return prompt + completion
+
+
+def retry_delay(response, attempt: int) -> float:
+    """Return how long to wait before a retry.
+
+    The backoff doubles with each attempt and is fully jittered, so clients
+    that failed together don't retry together. A longer wait asked for by
+    the provider takes precedence.
+    """
+    delay = random.uniform(0, min(RETRY_MAX_BACKOFF, RETRY_INITIAL_BACKOFF * 2**attempt))
+    hinted = retry_after(response.headers) if response is not None else None
+    return delay if hinted is None else max(delay, hinted)
+
+
+class RateLimitedTransport(httpx.AsyncBaseTransport):
+    """An httpx transport that rate limits and retries the requests it sends."""
+
+    def __init__(
+        self,
+        transport: httpx.AsyncBaseTransport,
+        limiter: RateLimiter,
+        deadline: float = None,
+    ):
+        self.transport = transport
+        self.limiter = limiter
+        self.deadline = deadline
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        deadline = self.retry_deadline()
+        tokens = request_tokens(request)
+        attempt = 0
+        while True:
+            await self.limiter.acquire(tokens, deadline)
+            try:
+                response = await self.transport.handle_async_request(request)
+            except (httpx.ConnectError, httpx.RemoteProtocolError):
+                delay = retry_delay(None, attempt)
+                if time.monotonic() + delay > deadline:
+                    raise
+                UPSTREAM_RETRIES.labels("connection").inc()
+                await asyncio.sleep(delay)
+            else:
+                self.limiter.update(response.headers)
+                if response.status_code not in RETRY_STATUS_CODES:
+                    return response
+                delay = retry_delay(response, attempt)
+                if time.monotonic() + delay > deadline:
+                    return response
+                await response.aclose()
+                UPSTREAM_RETRIES.labels(str(response.status_code)).inc()
+                if response.status_code == 429:
+                    # Every request waits, not just this one.
+                    self.limiter.pause(delay)
+                else:
+                    await asyncio.sleep(delay)
+            self.limiter.retries += 1
+            attempt += 1
+
+    def retry_deadline(self) -> float:
+        """Return the time by which the request must be sent."""
+        request = current_deadline.get()
+        if self.deadline is None and request is not None:
+            return request.end
+        return time.monotonic() + (self.deadline or OPENAI_RETRY_DEADLINE)
+
+    async def aclose(self):
+        await self.transport.aclose()
+
+
+rate_limiter = RateLimiter()
@@ -0,0 +1,81 @@
+"""Immutable response formats for structured LLM output.
+
+Response formats are built once and shared between requests, so they are
+frozen to stop one request from changing the schema another one sends. Each
+one carries a stable hash of its canonical JSON that is used as a cache key.
+"""
+
+import hashlib
+import json
+
+
+def _readonly(self, *args, **kwargs):
+    raise TypeError(f"{type(self).__name__} is read-only.")
+
+
+class FrozenDict(dict):
+    """A dict that can't be changed after it is created.
+
+    It is still a dict, so it serializes to JSON like any other.
+    """
+
+    __setitem__ = __delitem__ = _readonly
+    clear = pop = popitem = setdefault = update = _readonly
+    __ior__ = _readonly
+
+    def __reduce__(self):
+        return (type(self), (dict(self),))
+
+
+def freeze(value):
+    """Recursively turn dicts into FrozenDicts and lists into tuples."""
+    if isinstance(value, dict):
+        return FrozenDict((key, freeze(item)) for key, item in value.items())
+    if isinstance(value, (list, tuple)):
+        return tuple(freeze(item) for item in value)
+    return value
+
+
+def canonical_json(value) -> str:
+    """Serialize a value to JSON with a stable key order."""
+    return json.dumps(value, sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+
+
+class ResponseFormat(FrozenDict):
+    """A frozen response format with a precomputed stable hash."""
+
+    def __init__(self, value: dict):
+        super().__init__(freeze(value))
+        self.digest = hashlib.sha256(canonical_json(self).encode("utf-8")).hexdigest()
+
+
+def check_instance(value, schema: dict):
+    """Raise ValueError if a value doesn't have the types and keys of a schema.
+
+    Only the parts of JSON schema used by our response formats are checked.
+    """
+    kind = schema.get("type")
+    if kind == "object":
+        if not isinstance(value, dict):
+            raise ValueError("Expected an object.")
+        for key in schema.get("required", ()):
+            if key not in value:
+                raise ValueError(f"Missing the required field {key}.")
+        for key, item in schema.get("properties", {}).items():
+            if key in value:
+                check_instance(value[key], item)
+    elif kind == "array":
+        if not isinstance(value, list):
+            raise ValueError("Expected an array.")
+        for item in value:
+            check_instance(item, schema.get("items", {}))
+    elif kind == "string" and not isinstance(value, str):
+        raise ValueError("Expected a string.")
+
+
+def check_response(content: str, response_format: dict):
+    """Raise ValueError if a response is not valid JSON that fits its format."""
+    value = json.loads(content)
+    schema = (response_format.get("json_schema") or {}).get("schema")
+    if schema:
+        check_instance(value, schema)
@@ -1,27 +1,62 @@
 """Routes for the adstod page."""
 
+import asyncio
+import json
+import logging
 import os
-import re
+from functools import partial
+import anyio
 from dotenv import load_dotenv
-from openai import OpenAI
-from fastapi import APIRouter, Request
+from fastapi import APIRouter, Depends, Request
 from fastapi.templating import Jinja2Templates
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse
+from openai import APITimeoutError, NotFoundError, OpenAIError, RateLimitError
 from pydantic import BaseModel
+from app.citations import CitationRewriter
+from app.conversations import conversation_store
+from app.metrics import record_usage, stage
+from app.openai_client import client
+from app.upstream import (
+    DEADLINE_ADSTOD,
+    CircuitOpenError,
+    DeadlineExceeded,
+    call_upstream,
+    deadline,
+    within_deadline,
+)
+from app.utils import get_token, upstream_error
 
 templates = Jinja2Templates(directory="app/templates")
 
 router = APIRouter()
 
-load_dotenv()
+logger = logging.getLogger(__name__)
 
-openai_api_key = os.getenv("OPENAI_API_KEY")
+load_dotenv()
 
-# Set the OpenAI API key globally
-OpenAI.api_key = openai_api_key
-client = OpenAI()
+ASSISTANT_ID = "asst_rCMbGb73QwhMEvViv4laIoqD"
+ASSISTANT_INSTRUCTIONS = "Notandinn heytir Stefnir Húni Kristjánsson"
 
-chat_history = {}
+RUN_TERMINAL_STATES = {
+    "requires_action",
+    "cancelled",
+    "completed",
+    "failed",
+    "expired",
+    "incomplete",
+}
+RUN_FAILED_EVENTS = {
+    "thread.run.requires_action",
+    "thread.run.cancelled",
+    "thread.run.failed",
+    "thread.run.expired",
+    "thread.run.incomplete",
+    "error",
+}
+RUN_POLL_INITIAL_INTERVAL = float(os.getenv("RUN_POLL_INITIAL_INTERVAL", "0.25"))
+RUN_POLL_MAX_INTERVAL = float(os.getenv("RUN_POLL_MAX_INTERVAL", "2"))
+RUN_POLL_BACKOFF = 1.5
+STREAM_CLEANUP_TIMEOUT = 10
 
 
 class UserMessage(BaseModel):
@@ -33,38 +68,8 @@ class UserMessage(BaseModel):
 
 def process_message(the_message):
     """Process the message content to replace references and prepare the modified message."""
-    # Find content inside 【 】 and handle duplicates
-    pattern = r"【.*?†(.*?)】"
-    matches = re.findall(pattern, the_message)
-
-    file_map = {}
-    current_index = 1
-
-    # Create a mapping for files with unique numeric indices
-    for file in matches:
-        if file not in file_map:
-            file_map[file] = current_index
-            current_index += 1
-
-    # Replace references with indices
-    def replace_files_with_indices(match):
-        file_name = match.group(1)
-        return f"【{file_map[file_name]}】"
-
-    text_with_indices = re.sub(
-        r"【.*?†(.*?)】", replace_files_with_indices, the_message
-    )
-
-    # Prepare sources list
-    sources_list = "\n".join([f"{index}: {file}" for file, index in file_map.items()])
-
-    # If there are no sources, don't add the sources list
-    if not sources_list:
-        modified_message = text_with_indices
-    else:
-        modified_message = f"{text_with_indices}\n\nSources:\n{sources_list}"
-
-    return modified_message
+    rewriter = CitationRewriter()
+    return rewriter.feed(the_message) + rewriter.finish()
 
 
 @router.get("/adstod")
@@ -73,29 +78,148 @@ async def adstod(request: Request):
     return templates.TemplateResponse("adstod.html", {"request": request})
 
 
-@router.post("/adstod/start")
-async def adstod_post(user_message: UserMessage):
-    """Starts a thread for the assistant AI."""
-    thread_id = user_message.thread_id
-    # Start by checking if the thread_id is None or empty
-    if not thread_id:
-        thread = client.beta.threads.create()
-        thread_id = thread.id
+async def start_run(thread_id: str, message: str, stream: bool = False):
+    """Add the user message and start a run in a single request.
 
-    client.beta.threads.messages.create(
+    A new thread is created together with its first run when there is no
+    thread_id yet. With stream=True the run events are returned as an
+    async stream instead of the created run.
+    """
+    if not thread_id:
+        return await client.beta.threads.create_and_run(
+            assistant_id=ASSISTANT_ID,
+            instructions=ASSISTANT_INSTRUCTIONS,
+            thread={"messages": [{"role": "user", "content": message}]},
+            stream=stream,
+        )
+    return await client.beta.threads.runs.create(
         thread_id=thread_id,
-        role="user",
-        content=user_message.message,
+        assistant_id=ASSISTANT_ID,
+        instructions=ASSISTANT_INSTRUCTIONS,
+        additional_messages=[{"role": "user", "content": message}],
+        stream=stream,
     )
-    run = client.beta.threads.runs.create_and_poll(
-        thread_id=thread_id,
-        assistant_id="asst_rCMbGb73QwhMEvViv4laIoqD",
-        instructions="Notandinn heytir Stefnir Húni Kristjánsson",
+
+
+async def wait_for_run(run):
+    """Poll the run until it reaches a terminal state.
+
+    The poll interval starts short, since most runs finish within a few
+    seconds, and backs off towards RUN_POLL_MAX_INTERVAL for longer runs.
+    Waiting is done with asyncio.sleep so a pending run holds no thread.
+    """
+    interval = RUN_POLL_INITIAL_INTERVAL
+    with stage("assistant_poll"):
+        while run.status not in RUN_TERMINAL_STATES:
+            await asyncio.sleep(interval)
+            interval = min(interval * RUN_POLL_BACKOFF, RUN_POLL_MAX_INTERVAL)
+            run = await client.beta.threads.runs.retrieve(
+                run_id=run.id, thread_id=run.thread_id
+            )
+    record_run_usage(run)
+    return run
+
+
+def record_run_usage(run):
+    """Count the tokens used by a finished run."""
+    record_usage(getattr(run, "model", None) or "assistant", getattr(run, "usage", None))
+
+
+async def fetch_run_reply(run) -> str:
+    """Fetch only the newest message written by the run."""
+    messages = await client.beta.threads.messages.list(
+        thread_id=run.thread_id, run_id=run.id, order="desc", limit=1
+    )
+    return messages.data[0].content[0].text.value
+
+
+async def cancel_run(run):
+    """Cancel a run that was given up on, so its thread takes new messages."""
+    try:
+        await client.beta.threads.runs.cancel(run_id=run.id, thread_id=run.thread_id)
+    except OpenAIError:
+        logger.warning("Could not cancel run %s", run.id, exc_info=True)
+
+
+async def run_assistant(thread_id: str, message: str):
+    """Run the assistant on a message and return the run and its reply.
+
+    The reply is None when the run did not complete. A run that is given up
+    on, at the deadline or when the client goes away, is cancelled.
+    """
+    run = await start_run(thread_id, message)
+    try:
+        run = await wait_for_run(run)
+    except asyncio.CancelledError:
+        await cancel_run(run)
+        raise
+    if run.status != "completed":
+        return run, None
+    return run, await fetch_run_reply(run)
+
+
+async def remember_turn(thread_id: str, message: str, reply: str, new: bool):
+    """Add a question and the assistant reply to the conversation store.
+
+    A new thread is stored with its first turn, and the turn of an existing
+    thread is only added if the thread is stored.
+    """
+    messages = [{"role": "user", "text": message}, {"role": "assistant", "text": reply}]
+    if new:
+        await conversation_store.set(thread_id, messages)
+    else:
+        await conversation_store.add(thread_id, *messages)
+
+
+async def fetch_thread_messages(thread_id: str):
+    """List the most recent messages of a thread from OpenAI, oldest first.
+
+    Returns None for a thread that this assistant has not answered in, so
+    other threads of the account are not shown.
+    """
+    messages = await client.beta.threads.messages.list(
+        thread_id=thread_id, order="desc", limit=conversation_store.max_messages
     )
-    if run.status == "completed":
-        messages = client.beta.threads.messages.list(thread_id=thread_id)
-        the_message = messages.data[0].content[0].text.value
+    assistants = {
+        message.assistant_id for message in messages.data if message.role == "assistant"
+    }
+    if assistants != {ASSISTANT_ID}:
+        return None
+    history = []
+    for message in reversed(messages.data):
+        text = "".join(
+            block.text.value for block in message.content if block.type == "text"
+        )
+        if message.role == "assistant":
+            text = process_message(text)
+        history.append({"role": message.role, "text": text})
+    return history
+
+
+@router.post("/adstod/start")
+async def adstod_post(user_message: UserMessage):
+    """Starts a thread for the assistant AI."""
+    try:
+        with deadline(DEADLINE_ADSTOD):
+            run, the_message = await call_upstream(
+                partial(run_assistant, user_message.thread_id, user_message.message),
+                "assistant_run",
+            )
+    except (RateLimitError, APITimeoutError, CircuitOpenError, DeadlineExceeded) as e:
+        error = upstream_error(e)
+        return JSONResponse(
+            content={"error": error.detail},
+            status_code=error.status_code,
+            headers=error.headers,
+        )
+    if the_message is not None:
         modified_message = process_message(the_message)
+        await remember_turn(
+            run.thread_id,
+            user_message.message,
+            modified_message,
+            new=not user_message.thread_id,
+        )
     else:
         return JSONResponse(
             content={"error": "The assistant did not complete the request."},
@@ -104,6 +228,136 @@ async def adstod_post(user_message: UserMessage):
     return JSONResponse(
         content={
             "message": modified_message,
-            "thread_id": thread_id,
+            "thread_id": run.thread_id,
         }
     )
+
+
+def format_sse(event: str, data: dict) -> str:
+    """Format a single Server-Sent Event."""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+def delta_text(event) -> str:
+    """Return the text added by a message delta event."""
+    return "".join(
+        block.text.value
+        for block in event.data.delta.content or []
+        if block.type == "text" and block.text and block.text.value
+    )
+
+
+async def end_stream(events, run):
+    """Close the event stream, and cancel the run if it was given up on.
+
+    Closing gives the connection back to the pool, however the stream ended.
+    It is shielded from the cancellation of a response whose client went
+    away, for at most STREAM_CLEANUP_TIMEOUT seconds.
+    """
+    with anyio.move_on_after(STREAM_CLEANUP_TIMEOUT, shield=True):
+        if events is not None:
+            await events.close()
+        if run is not None:
+            await cancel_run(run)
+
+
+async def stream_run_events(user_message: UserMessage):
+    """Relay the assistant run to the browser as Server-Sent Events.
+
+    Text deltas are sent as they arrive, with citations rewritten on the
+    fly. The sources footer is sent as the last delta before ``done``. The
+    stream is given up when the next event doesn't come by the deadline, and
+    the upstream stream is closed when the relay ends for any reason. A run
+    that is given up on before it finishes is cancelled.
+    """
+    error = "The assistant did not complete the request."
+    events = None
+    run = None
+    with stage("assistant_run"), deadline(DEADLINE_ADSTOD):
+        try:
+            events = await call_upstream(
+                partial(
+                    start_run, user_message.thread_id, user_message.message, stream=True
+                ),
+                "assistant_run",
+            )
+            rewriter = CitationRewriter()
+            thread_id = user_message.thread_id
+            reply = []
+            iterator = aiter(events)
+            while True:
+                try:
+                    event = await within_deadline(anext(iterator), "assistant_run")
+                except StopAsyncIteration:
+                    break
+                if event.event == "thread.run.created":
+                    run = event.data
+                    thread_id = run.thread_id
+                    yield format_sse("thread", {"thread_id": thread_id})
+                elif event.event == "thread.message.delta":
+                    text = rewriter.feed(delta_text(event))
+                    if text:
+                        reply.append(text)
+                        yield format_sse("delta", {"text": text})
+                elif event.event == "thread.run.completed":
+                    run = None
+                    record_run_usage(event.data)
+                    text = rewriter.finish()
+                    if text:
+                        reply.append(text)
+                        yield format_sse("delta", {"text": text})
+                    await remember_turn(
+                        thread_id,
+                        user_message.message,
+                        "".join(reply),
+                        new=not user_message.thread_id,
+                    )
+                    yield format_sse("done", {})
+                    return
+                elif event.event in RUN_FAILED_EVENTS:
+                    run = None
+                    break
+        except (CircuitOpenError, DeadlineExceeded) as e:
+            error = upstream_error(e).detail
+        except Exception:  # pylint: disable=broad-except
+            logger.exception("Streaming the assistant run failed")
+        finally:
+            await end_stream(events, run)
+        yield format_sse("error", {"error": error})
+
+
+@router.post("/adstod/stream")
+async def adstod_stream(user_message: UserMessage):
+    """Stream the assistant reply as Server-Sent Events."""
+    return StreamingResponse(
+        stream_run_events(user_message),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@router.get("/adstod/threads/{thread_id}")
+async def adstod_thread(thread_id: str):
+    """Return the recent messages of a thread, to show them after a reload.
+
+    They come from the conversation store, and only a thread that is not in
+    it is listed from OpenAI, if this assistant answered in it.
+    """
+    messages = await conversation_store.get(thread_id)
+    if messages is None:
+        try:
+            messages = await fetch_thread_messages(thread_id)
+        except NotFoundError:
+            messages = None
+        if messages is None:
+            return JSONResponse(
+                content={"error": "The conversation was not found."}, status_code=404
+            )
+        await conversation_store.set(thread_id, messages)
+    return {"thread_id": thread_id, "messages": messages}
+
+
+@router.get("/adstod/stats")
+async def adstod_stats(_: str = Depends(get_token)):
+    """Return the size and hit statistics of the conversation store."""
+    return conversation_store.stats()
@@ -0,0 +1,13 @@
+"""Routes for the response cache."""
+
+from fastapi import APIRouter, Depends
+from app.cache import response_cache
+from app.utils import get_token
+
+router = APIRouter()
+
+
+@router.get("/cache/stats")
+async def cache_stats(_: str = Depends(get_token)):
+    """Return the hit, miss and eviction statistics of the response cache."""
+    return response_cache.stats()
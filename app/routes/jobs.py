@@ -0,0 +1,131 @@
+"""Routes for submitting uploads as background jobs and fetching the results."""
+
+import json
+from fastapi import (
+    APIRouter,
+    File,
+    UploadFile,
+    Form,
+    Depends,
+    HTTPException,
+)
+from fastapi.responses import JSONResponse, Response
+from app.database import database_configured
+from app.jobs import JOB_DEADLINE, JobQueue
+from app.models import Job
+from app.routes.minnisblad import (
+    build_docx,
+    generate_memo,
+    parse_chapters,
+)
+from app.routes.minnisblad_adstod import create_minnisblad_adstod_response_format
+from app.upstream import deadline
+from app.utils import (
+    DOCX_CONTENT_TYPE,
+    get_token,
+    process_uploaded_file,
+    send_text_to_openai,
+)
+
+
+def require_database():
+    """Raise a 503 when there is no database to keep the jobs in."""
+    if not database_configured():
+        raise HTTPException(
+            status_code=503, detail="Jobs are not available, as no database is configured."
+        )
+
+
+router = APIRouter(dependencies=[Depends(require_database)])
+
+
+async def run_minnisblad_job(job: Job) -> dict:
+    """Generate the memo for a queued minnisblad upload."""
+    selected_chapters = json.loads(job.chapters)
+    with deadline(JOB_DEADLINE):
+        openai_response = await generate_memo(job.text, selected_chapters)
+    return {"document": await build_docx(openai_response, selected_chapters)}
+
+
+async def run_minnisblad_adstod_job(job: Job) -> dict:
+    """Review a queued minnisblad-adstod upload."""
+    respond_format = create_minnisblad_adstod_response_format()
+    with deadline(JOB_DEADLINE):
+        openai_response = await send_text_to_openai(job.text, respond_format)
+    return {"result": json.dumps(openai_response, ensure_ascii=False)}
+
+
+job_queue = JobQueue(
+    {
+        "minnisblad": run_minnisblad_job,
+        "minnisblad_adstod": run_minnisblad_adstod_job,
+    }
+)
+
+
+def job_status(job: Job) -> dict:
+    """Return the public status of a job."""
+    status = {"job_id": job.id, "kind": job.kind, "status": job.status}
+    if job.error:
+        status["error"] = job.error
+    return status
+
+
+@router.post("/jobs/minnisblad/", status_code=202)
+async def submit_minnisblad_job(
+    file: UploadFile = File(...),
+    chapters: str = Form(...),
+    _: str = Depends(get_token),
+):
+    """Queue a minnisblad upload and return its job id at once."""
+    text = await process_uploaded_file(file)
+    selected_chapters = parse_chapters(chapters)
+    job = await job_queue.submit(
+        "minnisblad",
+        text,
+        chapters=json.dumps(selected_chapters),
+        filename=file.filename,
+    )
+    return job_status(job)
+
+
+@router.post("/jobs/minnisblad-adstod/", status_code=202)
+async def submit_minnisblad_adstod_job(
+    file: UploadFile = File(...),
+    _: str = Depends(get_token),
+):
+    """Queue a minnisblad-adstod upload and return its job id at once."""
+    text = await process_uploaded_file(file)
+    job = await job_queue.submit("minnisblad_adstod", text, filename=file.filename)
+    return job_status(job)
+
+
+async def get_job(job_id: str) -> Job:
+    """Load a job or raise a 404 if there is none."""
+    job = await job_queue.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found.")
+    return job
+
+
+@router.get("/jobs/{job_id}")
+async def read_job(job_id: str, _: str = Depends(get_token)):
+    """Return the status of a job."""
+    return job_status(await get_job(job_id))
+
+
+@router.get("/jobs/{job_id}/result")
+async def read_job_result(job_id: str, _: str = Depends(get_token)):
+    """Return the result of a completed job."""
+    job = await get_job(job_id)
+    if job.status != "completed":
+        raise HTTPException(status_code=409, detail=f"The job is {job.status}.")
+    if job.document is not None:
+        return Response(
+            content=job.document,
+            media_type=DOCX_CONTENT_TYPE,
+            headers={
+                "Content-Disposition": f'attachment; filename="Frodi_minnisblad_{job.id}.docx"'
+            },
+        )
+    return JSONResponse(content=json.loads(job.result))
@@ -0,0 +1,15 @@
+"""Route for the Prometheus metrics."""
+
+from fastapi import APIRouter, Depends
+from fastapi.responses import Response
+from app.metrics import render_metrics
+from app.utils import get_token
+
+router = APIRouter()
+
+
+@router.get("/metrics")
+async def metrics(_: str = Depends(get_token)):
+    """Return the metrics of every worker in the Prometheus text format."""
+    content, media_type = render_metrics()
+    return Response(content=content, media_type=media_type)
@@ -1,8 +1,11 @@
 """This module contains the routes for the minnisblad application."""
 
 from datetime import datetime
+from functools import lru_cache
+from io import BytesIO
 import json
-from tempfile import NamedTemporaryFile
+from typing import List
+import zipfile
 from fastapi import (
     APIRouter,
     Request,
@@ -10,10 +13,17 @@ from fastapi import (
     UploadFile,
     Form,
     Depends,
+    HTTPException,
 )
-from fastapi.responses import FileResponse, HTMLResponse
+from fastapi.responses import HTMLResponse, Response
 from fastapi.templating import Jinja2Templates
-from docx import Document
+from app.batch import error_detail, expand_uploads, run_bounded, unique_names
+from app.executor import run_cpu
+from app import fanout
+from app.memo import CHAPTERS, CHAPTERS_BY_KEY, render_memo
+from app.metrics import stage
+from app.response_format import ResponseFormat
+from app.upstream import DEADLINE_MINNISBLAD, deadline
 from app.utils import (
     send_text_to_openai,
     get_token,
@@ -41,112 +51,167 @@ async def upload_file(
 ):
     """Process the uploaded file and return the modified document."""
     text = await process_uploaded_file(file)
+    selected_chapters = parse_chapters(chapters)
     try:
-        selected_chapters = json.loads(chapters)
-        respond_format = create_response_format(selected_chapters)
-        openai_response = await send_text_to_openai(text, respond_format)
-        output_file_path = create_docx_from_json(openai_response)
+        with deadline(DEADLINE_MINNISBLAD):
+            openai_response = await generate_memo(text, selected_chapters)
+        document = await build_docx(openai_response, selected_chapters)
         timestamp = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
         filename = "Frodi_minnisblad_" + timestamp + ".docx"
 
-        return FileResponse(
-            output_file_path,
+        return Response(
+            content=document,
             media_type="application/vnd.openxmlformats-officedocument.wordprocessingml.document",
-            filename=filename,
+            headers={"Content-Disposition": f'attachment; filename="{filename}"'},
         )
     except Exception as e:  # pylint: disable=broad-except
         handle_unexpected_error(e)
 
 
-def create_response_format(selected_chapters: list) -> dict:
-    """Create the response format based on the selected chapters."""
-    base_response = {
-        "type": "json_schema",
-        "json_schema": {
-            "name": "minnisblad",
-            "strict": True,
-            "schema": {
+@router.post("/minnisblad/batch/")
+async def upload_batch(
+    files: List[UploadFile] = File(...),
+    chapters: str = Form(...),
+    _: str = Depends(get_token),
+):
+    """Process many uploaded files, or zips of them, and return a zip of memos.
+
+    The documents are processed concurrently, up to BATCH_CONCURRENCY at a
+    time. Files that failed are listed with their errors in errors.json.
+    """
+    documents = await expand_uploads(files)
+    selected_chapters = parse_chapters(chapters)
+
+    async def generate(file: UploadFile) -> bytes:
+        text = await process_uploaded_file(file)
+        with deadline(DEADLINE_MINNISBLAD):
+            openai_response = await generate_memo(text, selected_chapters)
+        return await build_docx(openai_response, selected_chapters)
+
+    results = await run_bounded(documents, generate)
+    errors = {}
+    buffer = BytesIO()
+    with zipfile.ZipFile(buffer, "w", zipfile.ZIP_STORED) as archive:
+        for name, result in zip(unique_names(documents), results):
+            if isinstance(result, BaseException):
+                errors[name] = error_detail(result)
+            else:
+                archive.writestr("Frodi_minnisblad_" + name, result)
+        if errors:
+            archive.writestr(
+                "errors.json", json.dumps(errors, ensure_ascii=False, indent=2)
+            )
+    timestamp = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
+    filename = "Frodi_minnisblod_" + timestamp + ".zip"
+    return Response(
+        content=buffer.getvalue(),
+        media_type="application/zip",
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+    )
+
+
+async def generate_memo(text: str, selected_chapters: list) -> dict:
+    """Generate the memo JSON for a document.
+
+    With MEMO_FANOUT the chapters and sections are written by concurrent
+    calls, otherwise the whole memo is written by a single call.
+    """
+    if fanout.MEMO_FANOUT:
+        return await fanout.generate_memo_fanout(text, selected_chapters)
+    return await send_text_to_openai(text, create_response_format(selected_chapters))
+
+
+def create_response_format(selected_chapters: list) -> ResponseFormat:
+    """Create the response format based on the selected chapters.
+
+    There is one response format per distinct chapter set. It is built once,
+    frozen and reused, with the chapters in table order so the same set
+    always gives the same schema and hash.
+    """
+    unknown = [chapter for chapter in selected_chapters if chapter not in CHAPTERS_BY_KEY]
+    if unknown:
+        raise ValueError(f"Unknown chapters: {', '.join(map(str, unknown))}")
+    return build_response_format(frozenset(selected_chapters))
+
+
+@lru_cache(maxsize=2 ** len(CHAPTERS))
+def build_response_format(chapter_keys: frozenset) -> ResponseFormat:
+    """Build the frozen response format for a chapter set."""
+    chapters = [chapter for chapter in CHAPTERS if chapter.key in chapter_keys]
+    properties = {
+        "titill": {
+            "type": "string",
+            "description": "Titill minnisblaðsins.",
+        },
+        "kaflar": {
+            "type": "array",
+            "description": "Kaflar minnisblaðsins.",
+            "items": {
                 "type": "object",
                 "properties": {
-                    "titill": {
+                    "chapter_title": {
                         "type": "string",
-                        "description": "Titill minnisblaðsins.",
+                        "description": "Titill kafla.",
                     },
-                    "kaflar": {
-                        "type": "array",
-                        "description": "Kaflar minnisblaðsins.",
-                        "items": {
-                            "type": "object",
-                            "properties": {
-                                "chapter_title": {
-                                    "type": "string",
-                                    "description": "Titill kafla.",
-                                },
-                                "content": {
-                                    "type": "string",
-                                    "description": "Innihald kafla.",
-                                },
-                            },
-                            "required": ["chapter_title", "content"],
-                            "additionalProperties": False,
-                        },
+                    "content": {
+                        "type": "string",
+                        "description": "Innihald kafla.",
                     },
                 },
-                "required": [
-                    "titill",
-                    "kaflar",
-                ],
+                "required": ["chapter_title", "content"],
                 "additionalProperties": False,
             },
         },
     }
-    chapter_descriptions = {
-        "inngangur": "Inngangur minnisblaðsins.",
-        "samantekt": "Samantekt minnisblaðsins.",
-        "aaetlun": "Áætlun minnisblaðsins.",
-        "markmid": "Markmið minnisblaðsins.",
-    }
-
-    for chapter in selected_chapters:
-        if chapter in chapter_descriptions:
-            base_response["json_schema"]["schema"]["properties"][chapter] = {
-                "type": "string",
-                "description": chapter_descriptions[chapter],
-            }
-            base_response["json_schema"]["schema"]["required"].append(chapter)
-
-    return base_response
-
-
-def create_docx_from_json(response_json: dict) -> str:
-    """Create a Word document from the JSON response."""
-    doc = Document()
-
-    doc.add_heading(response_json.get("titill", "Titill Ekki Tiltækur"), level=1)
-
-    if "Inngangur" in response_json:
-        doc.add_heading("Inngangur", level=2)
-        doc.add_paragraph(response_json["Inngangur"])
-
-    if "markmid" in response_json:
-        doc.add_heading("Markmið", level=2)
-        doc.add_paragraph(response_json["markmid"])
-
-    if "aaetlun" in response_json:
-        doc.add_heading("Áætlun", level=2)
-        doc.add_paragraph(response_json["aaetlun"])
-
-    if "kaflar" in response_json:
-        for chapter in response_json["kaflar"]:
-            doc.add_heading(chapter["chapter_title"], level=2)
-            doc.add_paragraph(chapter["content"])
-
-    if "Samantekt" in response_json:
-        doc.add_heading("Samantekt", level=2)
-        doc.add_paragraph(response_json["Samantekt"])
+    for chapter in chapters:
+        properties[chapter.key] = {
+            "type": "string",
+            "description": chapter.description,
+        }
+    return ResponseFormat(
+        {
+            "type": "json_schema",
+            "json_schema": {
+                "name": "minnisblad",
+                "strict": True,
+                "schema": {
+                    "type": "object",
+                    "properties": properties,
+                    "required": ["titill", "kaflar"] + [c.key for c in chapters],
+                    "additionalProperties": False,
+                },
+            },
+        }
+    )
 
-    with NamedTemporaryFile(delete=False, suffix=".docx") as temp_file:
-        doc.save(temp_file.name)
-        temp_file_path = temp_file.name
 
-    return temp_file_path
+def parse_chapters(chapters: str) -> list:
+    """Parse and validate the chapter selection sent with an upload."""
+    try:
+        selected_chapters = json.loads(chapters)
+        if not isinstance(selected_chapters, list):
+            raise ValueError("The chapters must be a list.")
+        create_response_format(selected_chapters)
+    except (ValueError, TypeError) as e:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Chapters must be a list of: {', '.join(CHAPTERS_BY_KEY)}.",
+        ) from e
+    return selected_chapters
+
+
+def create_docx_from_json(response_json: dict, selected_chapters: list = None) -> bytes:
+    """Create a Word document from the JSON response.
+
+    The document is built in memory and returned as bytes, so nothing is
+    written to disk. When no chapter selection is given it is taken from the
+    chapters present in the response.
+    """
+    with stage("docx_build"):
+        return render_memo(response_json, selected_chapters)
+
+
+async def build_docx(response_json: dict, selected_chapters: list = None) -> bytes:
+    """Create a Word document from the JSON response on the CPU executor."""
+    with stage("docx_build"):
+        return await run_cpu(render_memo, response_json, selected_chapters)
@@ -1,5 +1,7 @@
 """This module contains the routes for the minnisblad application."""
 
+from functools import lru_cache
+from typing import List
 from fastapi import (
     APIRouter,
     Request,
@@ -10,6 +12,9 @@ from fastapi import (
 from fastapi.responses import JSONResponse, HTMLResponse
 from fastapi.templating import Jinja2Templates
 from dotenv import load_dotenv
+from app.batch import error_detail, expand_uploads, run_bounded, unique_names
+from app.response_format import ResponseFormat
+from app.upstream import DEADLINE_MINNISBLAD_ADSTOD, deadline
 from app.utils import (
     send_text_to_openai,
     get_token,
@@ -40,14 +45,50 @@ async def upload_file(
     text = await process_uploaded_file(file)
     try:
         respond_format = create_minnisblad_adstod_response_format()
-        openai_response = await send_text_to_openai(text, respond_format)
+        with deadline(DEADLINE_MINNISBLAD_ADSTOD):
+            openai_response = await send_text_to_openai(text, respond_format)
         return JSONResponse(content=openai_response)
     except Exception as e:  # pylint: disable=broad-except
         handle_unexpected_error(e)
 
 
-def create_minnisblad_adstod_response_format() -> dict:
-    """Create the response format"""
+@router.post("/minnisblad-adstod/batch/")
+async def upload_batch(
+    files: List[UploadFile] = File(...),
+    _: str = Depends(get_token),
+):
+    """Process many uploaded files, or zips of them, and return a JSON map.
+
+    The documents are reviewed concurrently, up to BATCH_CONCURRENCY at a time.
+    Each file maps to either its result or the error it failed with.
+    """
+    documents = await expand_uploads(files)
+    respond_format = create_minnisblad_adstod_response_format()
+
+    async def review(file: UploadFile) -> dict:
+        text = await process_uploaded_file(file)
+        with deadline(DEADLINE_MINNISBLAD_ADSTOD):
+            return await send_text_to_openai(text, respond_format)
+
+    results = await run_bounded(documents, review)
+    return JSONResponse(
+        content={
+            name: (
+                {"error": error_detail(result)}
+                if isinstance(result, BaseException)
+                else {"result": result}
+            )
+            for name, result in zip(unique_names(documents), results)
+        }
+    )
+
+
+@lru_cache(maxsize=None)
+def create_minnisblad_adstod_response_format() -> ResponseFormat:
+    """Create the response format.
+
+    The format never changes, so it is built and frozen once.
+    """
     response = {
         "type": "json_schema",
         "json_schema": {
@@ -103,4 +144,4 @@ def create_minnisblad_adstod_response_format() -> dict:
         },
     }
 
-    return response
+    return ResponseFormat(response)
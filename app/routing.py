@@ -0,0 +1,109 @@
+"""Choice of model for each LLM call.
+
+Not every call needs the large model: a spelling review of a short document
+or a single memo section is done as well, and faster and cheaper, by a small
+one. Each call is matched against the routes in order, by the name of its
+response format, the tokens of its input and, for memos, the selected
+chapters. The first route that matches picks the model, and calls that match
+none go to OPENAI_MODEL. When a small model returns output that doesn't fit
+the schema, the call is made again with OPENAI_MODEL.
+
+The routes can be set with MODEL_ROUTES, a JSON list such as
+``[{"name": "review_short", "model": "gpt-4o-mini",
+"formats": ["Minnisblad_adstod"], "max_tokens": 4000}]``.
+"""
+
+import json
+import os
+from fnmatch import fnmatchcase
+from typing import NamedTuple
+from dotenv import load_dotenv
+from app.memo import CHAPTERS_BY_KEY
+
+load_dotenv()
+
+OPENAI_MODEL = os.getenv("OPENAI_MODEL", "gpt-4o")
+OPENAI_SMALL_MODEL = os.getenv("OPENAI_SMALL_MODEL", "gpt-4o-mini")
+MODEL_ESCALATION = os.getenv("MODEL_ESCALATION", "true").lower() == "true"
+
+
+class Route(NamedTuple):
+    """A rule that sends the calls it matches to a model.
+
+    ``formats`` are patterns for the response format name, ``max_tokens`` is
+    the most input tokens and ``chapters`` the memo chapters that may be
+    selected. A rule left out matches any call.
+    """
+
+    name: str
+    model: str
+    formats: tuple = ()
+    max_tokens: int = None
+    chapters: tuple = None
+
+
+DEFAULT_ROUTE = Route("default", OPENAI_MODEL)
+DEFAULT_ROUTES = (
+    Route("review_short", OPENAI_SMALL_MODEL, ("Minnisblad_adstod",), 4000),
+    Route(
+        "memo_section",
+        OPENAI_SMALL_MODEL,
+        tuple(f"minnisblad_{key}" for key in CHAPTERS_BY_KEY),
+    ),
+)
+
+
+def load_routes(value: str) -> tuple:
+    """Parse the MODEL_ROUTES setting, or return the default routes."""
+    if not value:
+        return DEFAULT_ROUTES
+    return tuple(
+        Route(
+            name=item["name"],
+            model=item.get("model", OPENAI_SMALL_MODEL),
+            formats=tuple(item.get("formats", ())),
+            max_tokens=item.get("max_tokens"),
+            chapters=tuple(item["chapters"]) if "chapters" in item else None,
+        )
+        for item in json.loads(value)
+    )
+
+
+MODEL_ROUTES = load_routes(os.getenv("MODEL_ROUTES"))
+
+
+def format_name(response_format) -> str:
+    """Return the name of a response format."""
+    return (response_format.get("json_schema") or {}).get("name", "")
+
+
+def selected_chapters(response_format) -> set:
+    """Return the memo chapters asked for by a response format."""
+    schema = (response_format.get("json_schema") or {}).get("schema") or {}
+    return set(schema.get("properties", {})) & set(CHAPTERS_BY_KEY)
+
+
+def matches(route: Route, response_format, input_tokens: int) -> bool:
+    """Check if a call matches a route."""
+    if route.formats and not any(
+        fnmatchcase(format_name(response_format), pattern) for pattern in route.formats
+    ):
+        return False
+    if route.max_tokens is not None and input_tokens > route.max_tokens:
+        return False
+    return route.chapters is None or selected_chapters(response_format) <= set(
+        route.chapters
+    )
+
+
+def choose_route(response_format, input_tokens: int, routes=None) -> Route:
+    """Return the first route that matches a call, or the default route."""
+    for route in MODEL_ROUTES if routes is None else routes:
+        if matches(route, response_format, input_tokens):
+            return route
+    return DEFAULT_ROUTE
+
+
+def can_escalate(route: Route) -> bool:
+    """Check if a call on this route is made again with OPENAI_MODEL on failure."""
+    return MODEL_ESCALATION and route.model != OPENAI_MODEL
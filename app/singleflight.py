@@ -0,0 +1,65 @@
+"""Coalescing of identical requests that are in flight at the same time.
+
+When the same document is uploaded twice within seconds, for example after a
+double click, the second request waits for the first one's upstream call
+instead of starting its own.
+"""
+
+import asyncio
+
+
+class _Flight:  # pylint: disable=too-few-public-methods
+    """An upstream call and the number of requests waiting for it."""
+
+    def __init__(self, task: asyncio.Task):
+        self.task = task
+        self.waiters = 0
+
+
+class SingleFlight:
+    """Run at most one call per key at a time and share its result.
+
+    The call runs in its own task, so a waiter that is cancelled, for
+    example because its client disconnected, does not cancel it for the
+    others. It is only cancelled when every waiter has gone. A failure is
+    raised to every waiter, and the next call for the key starts afresh.
+    """
+
+    def __init__(self):
+        self._flights = {}
+        self.calls = 0
+        self.coalesced = 0
+
+    def __len__(self):
+        return len(self._flights)
+
+    async def run(self, key: str, function, *args):
+        """Return the result of ``function(*args)``, sharing calls by key."""
+        flight = self._flights.get(key)
+        if flight is None:
+            flight = _Flight(asyncio.create_task(function(*args)))
+            self._flights[key] = flight
+            flight.task.add_done_callback(lambda _: self._forget(key, flight))
+            self.calls += 1
+        else:
+            self.coalesced += 1
+        flight.waiters += 1
+        try:
+            return await asyncio.shield(flight.task)
+        finally:
+            flight.waiters -= 1
+            if flight.waiters == 0 and not flight.task.done():
+                self._forget(key, flight)
+                flight.task.cancel()
+
+    def _forget(self, key: str, flight: _Flight):
+        if self._flights.get(key) is flight:
+            del self._flights[key]
+
+    def stats(self) -> dict:
+        """Return the number of upstream calls and of requests that shared one."""
+        return {
+            "in_flight": len(self._flights),
+            "calls": self.calls,
+            "coalesced": self.coalesced,
+        }
@@ -3,10 +3,92 @@ document.addEventListener("DOMContentLoaded", () => {
   const messageInput = document.getElementById("message-input");
   const chatContainer = document.getElementById("chat-container");
   const thinkingIndicator = document.getElementById("thinking-indicator");
-  // When the page loads clear the localStorage
-  localStorage.clear();
+  const newConversationButton = document.getElementById("new-conversation");
 
-  chatForm.addEventListener("submit", (e) => {
+  // Create an empty assistant message bubble and return its text element
+  const createAssistantMessage = () => {
+    const assistantMessageDiv = document.createElement("div");
+    assistantMessageDiv.classList.add("mb-4");
+    assistantMessageDiv.innerHTML = `
+      <div class="bg-gray-200 p-4 rounded-lg max-w-lg">
+        <div class="whitespace-pre-wrap"></div>
+      </div>
+    `;
+    chatContainer.appendChild(assistantMessageDiv);
+    return assistantMessageDiv.querySelector(".whitespace-pre-wrap");
+  };
+
+  // Add a user message bubble to the chat
+  const addUserMessage = (text) => {
+    const userMessageDiv = document.createElement("div");
+    userMessageDiv.classList.add("mb-4", "flex", "justify-end");
+    userMessageDiv.innerHTML = `
+      <div class="bg-blue-500 text-white p-4 rounded-lg max-w-lg">
+        <p></p>
+      </div>
+    `;
+    userMessageDiv.querySelector("p").textContent = text;
+    chatContainer.appendChild(userMessageDiv);
+  };
+
+  // Show the conversation kept on the server after a page reload
+  const restoreConversation = async () => {
+    const threadId = localStorage.getItem("thread_id");
+    if (!threadId) return;
+    try {
+      const response = await fetch(
+        `/adstod/threads/${encodeURIComponent(threadId)}`
+      );
+      if (response.status === 404) {
+        localStorage.removeItem("thread_id");
+        return;
+      }
+      if (!response.ok) throw new Error(`HTTP ${response.status}`);
+      const { messages } = await response.json();
+      messages.forEach(({ role, text }) => {
+        if (role === "user") {
+          addUserMessage(text);
+        } else {
+          createAssistantMessage().textContent = text;
+        }
+      });
+      chatContainer.scrollTop = chatContainer.scrollHeight;
+    } catch (error) {
+      console.error("Could not restore the conversation:", error);
+    }
+  };
+
+  newConversationButton.addEventListener("click", () => {
+    localStorage.removeItem("thread_id");
+    chatContainer.replaceChildren();
+  });
+
+  const showError = () => {
+    const errorMessageDiv = document.createElement("div");
+    errorMessageDiv.classList.add("mb-4");
+    errorMessageDiv.innerHTML = `
+      <div class="bg-red-200 p-4 rounded-lg max-w-lg">
+        <p class="text-red-800">An error occurred. Please try again.</p>
+      </div>
+    `;
+    chatContainer.appendChild(errorMessageDiv);
+  };
+
+  // Parse a single Server-Sent Event block into its name and JSON data
+  const parseEvent = (block) => {
+    let event = "message";
+    let data = "";
+    block.split("\n").forEach((line) => {
+      if (line.startsWith("event:")) {
+        event = line.slice(6).trim();
+      } else if (line.startsWith("data:")) {
+        data += line.slice(5).trim();
+      }
+    });
+    return { event, data: data ? JSON.parse(data) : {} };
+  };
+
+  chatForm.addEventListener("submit", async (e) => {
     e.preventDefault();
 
     const userMessage = messageInput.value.trim();
@@ -18,73 +100,74 @@ document.addEventListener("DOMContentLoaded", () => {
       thread_id = "";
     }
     // Display user message
-    const userMessageDiv = document.createElement("div");
-    userMessageDiv.classList.add("mb-4", "flex", "justify-end");
-    userMessageDiv.innerHTML = `
-      <div class="bg-blue-500 text-white p-4 rounded-lg max-w-lg">
-        <p>${userMessage}</p>
-      </div>
-    `;
-    chatContainer.appendChild(userMessageDiv);
+    addUserMessage(userMessage);
     messageInput.value = "";
 
     // Scroll to the bottom
     chatContainer.scrollTop = chatContainer.scrollHeight;
 
-    // Show thinking indicator
+    // Show thinking indicator until the first token arrives
     thinkingIndicator.classList.remove("hidden");
 
-    // Send the user's message to the backend
-    fetch("/adstod/start", {
-      method: "POST",
-      headers: {
-        "Content-Type": "application/json",
-      },
-      body: JSON.stringify({ message: userMessage, thread_id: thread_id }),
-    })
-      .then((response) => response.json())
-      .then((data) => {
-        // Hide thinking indicator
-        thinkingIndicator.classList.add("hidden");
-
-        // Display assistant response
-        const assistantMessageDiv = document.createElement("div");
-        assistantMessageDiv.classList.add("mb-4");
-        assistantMessageDiv.innerHTML = `
-          <div class="bg-gray-200 p-4 rounded-lg max-w-lg">
-            <div class="whitespace-pre-wrap">
-              ${data.message}
-            </div>
-          </div>
-        `;
-        chatContainer.appendChild(assistantMessageDiv);
+    let messageText = null;
+    let failed = false;
 
+    const handleEvent = ({ event, data }) => {
+      if (event === "thread") {
         // Store the thread ID in localStorage
-        if (data.thread_id) {
-          localStorage.setItem("thread_id", data.thread_id);
-          console.log("Thread ID stored in localStorage as:", data.thread_id);
-        } else {
-          console.log("No thread ID received from the backend");
-        }
-
-        // Scroll to the bottom
-        chatContainer.scrollTop = chatContainer.scrollHeight;
-      })
-      .catch((error) => {
-        console.error("Error:", error);
-
-        // Hide thinking indicator
+        localStorage.setItem("thread_id", data.thread_id);
+        console.log("Thread ID stored in localStorage as:", data.thread_id);
+        return;
+      }
+      if (event === "error") {
+        failed = true;
+        return;
+      }
+      if (messageText === null) {
         thinkingIndicator.classList.add("hidden");
+        messageText = createAssistantMessage();
+      }
+      if (event === "delta") {
+        messageText.textContent += data.text;
+      }
+      chatContainer.scrollTop = chatContainer.scrollHeight;
+    };
 
-        // Optionally display an error message in the chat
-        const errorMessageDiv = document.createElement("div");
-        errorMessageDiv.classList.add("mb-4");
-        errorMessageDiv.innerHTML = `
-          <div class="bg-red-200 p-4 rounded-lg max-w-lg">
-            <p class="text-red-800">An error occurred. Please try again.</p>
-          </div>
-        `;
-        chatContainer.appendChild(errorMessageDiv);
+    try {
+      // Send the user's message to the backend and read the event stream
+      const response = await fetch("/adstod/stream", {
+        method: "POST",
+        headers: {
+          "Content-Type": "application/json",
+        },
+        body: JSON.stringify({ message: userMessage, thread_id: thread_id }),
       });
+      if (!response.ok) throw new Error(`HTTP ${response.status}`);
+
+      const reader = response.body.getReader();
+      const decoder = new TextDecoder();
+      let buffer = "";
+      while (true) {
+        const { value, done } = await reader.read();
+        if (done) break;
+        buffer += decoder.decode(value, { stream: true });
+        let boundary = buffer.indexOf("\n\n");
+        while (boundary !== -1) {
+          handleEvent(parseEvent(buffer.slice(0, boundary)));
+          buffer = buffer.slice(boundary + 2);
+          boundary = buffer.indexOf("\n\n");
+        }
+      }
+      if (failed) throw new Error("The assistant did not complete the request.");
+    } catch (error) {
+      console.error("Error:", error);
+      showError();
+    } finally {
+      // Hide thinking indicator
+      thinkingIndicator.classList.add("hidden");
+      chatContainer.scrollTop = chatContainer.scrollHeight;
+    }
   });
+
+  restoreConversation();
 });
@@ -0,0 +1,119 @@
+"""Token counting and budgets for the model calls.
+
+Tokens are counted with tiktoken and the encoding of the model, because
+Icelandic text takes far more tokens per word than English and a word count
+predicts neither the cost nor the latency of a call. When the encoding can't
+be loaded, for example without network access to download it, the count
+falls back to an estimate from the length of the text.
+
+The output budget of a call, its ``max_tokens``, is set from the response
+format and the size of the input, so a short document doesn't reserve the
+rate limit quota for a long answer.
+"""
+
+import logging
+import math
+import os
+from functools import lru_cache
+from dotenv import load_dotenv
+from app.response_format import canonical_json
+
+load_dotenv()
+
+TOKENIZER_ENCODING = os.getenv("TOKENIZER_ENCODING", "o200k_base")
+# Documents over this many tokens are rejected. Those under it but over
+# CHUNK_TOKENS are split into chunks.
+MAX_DOCUMENT_TOKENS = int(os.getenv("MAX_DOCUMENT_TOKENS", "150000"))
+# A rough estimate for Icelandic text, used when tiktoken is not available.
+CHARS_PER_TOKEN = 3
+# Chat messages cost a few tokens each on top of their content, and the
+# reply is primed with a few more.
+TOKENS_PER_MESSAGE = 3
+TOKENS_PER_REPLY = 3
+# An upload is counted when it is parsed, and again when it is chunked and
+# sent, so recent counts are kept.
+TOKEN_COUNT_CACHE_SIZE = 128
+
+# Output budgets by response format name: a base, a share of the input
+# tokens and a cap. A response cut off at the budget is retried at the cap.
+OUTPUT_BUDGETS = {
+    "minnisblad": (1000, 0.25, 4000),
+    "Minnisblad_adstod": (1000, 0.3, 4000),
+    "minnisblad_efnisyfirlit": (500, 0.02, 1000),
+    "minnisblad_kafli": (400, 0.1, 2000),
+}
+SECTION_BUDGET = (300, 0.05, 1000)
+DEFAULT_BUDGET = (1000, 0.25, 4000)
+
+logger = logging.getLogger(__name__)
+
+
+@lru_cache(maxsize=None)
+def get_encoding():
+    """Return the tiktoken encoding, or None if it can't be loaded."""
+    try:
+        import tiktoken  # pylint: disable=import-outside-toplevel
+
+        return tiktoken.get_encoding(TOKENIZER_ENCODING)
+    except Exception:  # pylint: disable=broad-except
+        logger.warning(
+            "Could not load the %s encoding, token counts are estimated",
+            TOKENIZER_ENCODING,
+        )
+        return None
+
+
+def measure_tokens(text: str) -> int:
+    """Count the tokens in a text, without keeping the count.
+
+    Used for the pieces of a document, which are counted once.
+    """
+    encoding = get_encoding()
+    if encoding is None:
+        return math.ceil(len(text) / CHARS_PER_TOKEN)
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+@lru_cache(maxsize=TOKEN_COUNT_CACHE_SIZE)
+def count_tokens(text: str) -> int:
+    """Count the tokens in a text."""
+    return measure_tokens(text)
+
+
+def count_prompt_tokens(messages: list, response_format=None) -> int:
+    """Count the prompt tokens of a chat request, as the API bills them.
+
+    The schema of a structured output is part of the prompt too.
+    """
+    total = TOKENS_PER_REPLY
+    for message in messages:
+        total += TOKENS_PER_MESSAGE + count_tokens(message.get("role", ""))
+        content = message.get("content") or ""
+        if isinstance(content, str):
+            content = [{"text": content}]
+        total += sum(count_tokens(part.get("text", "")) for part in content)
+    schema = (response_format or {}).get("json_schema", {}).get("schema")
+    if schema:
+        total += count_tokens(canonical_json(schema))
+    return total
+
+
+def budget_for(response_format) -> tuple:
+    """Return the output budget of a response format."""
+    name = (response_format.get("json_schema") or {}).get("name", "")
+    if name in OUTPUT_BUDGETS:
+        return OUTPUT_BUDGETS[name]
+    if name.startswith("minnisblad_"):
+        return SECTION_BUDGET
+    return DEFAULT_BUDGET
+
+
+def output_budget(response_format, input_tokens: int) -> int:
+    """Return the max_tokens for a call with this format and input size."""
+    base, share, cap = budget_for(response_format)
+    return min(cap, base + math.ceil(share * input_tokens))
+
+
+def output_cap(response_format) -> int:
+    """Return the largest output budget of a response format."""
+    return budget_for(response_format)[2]
@@ -0,0 +1,277 @@
+"""Per-request tracing with correlation ids and Server-Timing headers.
+
+TracingMiddleware starts a trace for every HTTP request and returns its id
+in the ``X-Request-ID`` header. The spans opened with ``span`` while the
+request is handled, including every metrics ``stage``, are summed up in the
+``Server-Timing`` header and written to TRACE_FILE as one line of OTLP JSON
+per request, the format of the OpenTelemetry collector file exporter.
+"""
+
+import json
+import logging
+import os
+import queue
+import random
+import re
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from logging.handlers import QueueListener, RotatingFileHandler
+from dotenv import load_dotenv
+
+load_dotenv()
+
+TRACE_FILE = os.getenv("TRACE_FILE", "traces.jsonl")
+TRACE_FILE_MAX_BYTES = int(os.getenv("TRACE_FILE_MAX_BYTES", "10000000"))
+TRACE_FILE_BACKUPS = int(os.getenv("TRACE_FILE_BACKUPS", "5"))
+SERVICE_NAME = "office-assistant"
+REQUEST_ID_HEADER = b"x-request-id"
+REQUEST_ID_PATTERN = re.compile(r"[A-Za-z0-9._-]{1,64}")
+TRACEPARENT_PATTERN = re.compile(r"[0-9a-f]{2}-([0-9a-f]{32})-([0-9a-f]{16})-[0-9a-f]{2}")
+SPAN_KIND_INTERNAL = 1
+SPAN_KIND_SERVER = 2
+STATUS_OK = 1
+STATUS_ERROR = 2
+
+current_trace = ContextVar("current_trace", default=None)
+current_span = ContextVar("current_span", default=None)
+
+
+class Span:  # pylint: disable=too-few-public-methods,too-many-instance-attributes
+    """A timed operation within a trace."""
+
+    def __init__(self, name: str, parent_id: str = None, kind: int = SPAN_KIND_INTERNAL):
+        self.name = name
+        self.span_id = f"{random.getrandbits(64):016x}"
+        self.parent_id = parent_id
+        self.kind = kind
+        self.attributes = {}
+        self.error = False
+        self.start_time = time.time_ns()
+        self.start = time.perf_counter_ns()
+        self.end = None
+
+    def finish(self):
+        """Mark the span as ended."""
+        self.end = time.perf_counter_ns()
+
+    def to_otlp(self, trace_id: str) -> dict:
+        """Return the span in the OTLP JSON encoding."""
+        record = {
+            "traceId": trace_id,
+            "spanId": self.span_id,
+            "name": self.name,
+            "kind": self.kind,
+            "startTimeUnixNano": str(self.start_time),
+            "endTimeUnixNano": str(self.start_time + (self.end or self.start) - self.start),
+            "attributes": [
+                {"key": key, "value": otlp_value(value)}
+                for key, value in self.attributes.items()
+            ],
+            "status": {"code": STATUS_ERROR if self.error else STATUS_OK},
+        }
+        if self.parent_id:
+            record["parentSpanId"] = self.parent_id
+        return record
+
+
+def otlp_value(value) -> dict:
+    """Return an attribute value in the OTLP JSON encoding."""
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+class Trace:
+    """The spans recorded while handling one request."""
+
+    def __init__(self, trace_id: str = None, request_id: str = None):
+        self.trace_id = trace_id or f"{random.getrandbits(128):032x}"
+        self.request_id = request_id or self.trace_id
+        self.spans = []
+
+    def server_timing(self) -> str:
+        """Return the finished spans as a Server-Timing header value.
+
+        Spans with the same name, such as the LLM calls of a chunked
+        document, are reported as the wall time from the first start to the
+        last end, since they may have run concurrently.
+        """
+        stages = {}
+        for item in self.spans:
+            if item.end is None or item.kind == SPAN_KIND_SERVER:
+                continue
+            start, end = stages.get(item.name, (item.start, item.end))
+            stages[item.name] = (min(start, item.start), max(end, item.end))
+        return ", ".join(
+            f"{name};dur={(end - start) / 1e6:.1f}" for name, (start, end) in stages.items()
+        )
+
+    def to_otlp(self) -> dict:
+        """Return the trace as an OTLP JSON export request."""
+        return {
+            "resourceSpans": [
+                {
+                    "resource": {
+                        "attributes": [
+                            {"key": "service.name", "value": otlp_value(SERVICE_NAME)}
+                        ]
+                    },
+                    "scopeSpans": [
+                        {
+                            "scope": {"name": __name__},
+                            "spans": [item.to_otlp(self.trace_id) for item in self.spans],
+                        }
+                    ],
+                }
+            ]
+        }
+
+
+@contextmanager
+def span(name: str, **attributes):
+    """Record a span in the trace of the current request, if there is one."""
+    trace = current_trace.get()
+    if trace is None:
+        yield None
+        return
+    parent = current_span.get()
+    item = Span(name, parent.span_id if parent else None)
+    item.attributes.update(attributes)
+    trace.spans.append(item)
+    token = current_span.set(item)
+    try:
+        yield item
+    except BaseException:
+        item.error = True
+        raise
+    finally:
+        item.finish()
+        current_span.reset(token)
+
+
+class TraceSink:
+    """A JSONL file of traces that is rotated when it grows too large.
+
+    Traces are serialised on the event loop but written to the file by a
+    background thread, so a slow disk doesn't hold up requests.
+    """
+
+    def __init__(
+        self,
+        path: str = TRACE_FILE,
+        max_bytes: int = TRACE_FILE_MAX_BYTES,
+        backups: int = TRACE_FILE_BACKUPS,
+    ):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.queue = None
+        self.listener = None
+
+    def write(self, trace: Trace):
+        """Queue a trace to be appended to the file, starting the writer on first use."""
+        if not self.path:
+            return
+        if self.listener is None:
+            self.queue = queue.SimpleQueue()
+            handler = RotatingFileHandler(
+                self.path, maxBytes=self.max_bytes, backupCount=self.backups, delay=True
+            )
+            self.listener = QueueListener(self.queue, handler)
+            self.listener.start()
+        self.queue.put_nowait(
+            logging.makeLogRecord(
+                {"msg": json.dumps(trace.to_otlp(), separators=(",", ":"))}
+            )
+        )
+
+    def close(self):
+        """Write the queued traces and close the file."""
+        if self.listener is not None:
+            self.listener.stop()
+            for handler in self.listener.handlers:
+                handler.close()
+            self.listener = None
+
+
+def route_label(scope: dict) -> str:
+    """Return the path template of the matched route."""
+    route = scope.get("route")
+    return getattr(route, "path", None) or "unmatched"
+
+
+def incoming_trace(headers: list) -> Trace:
+    """Start a trace, continuing the caller's trace and request ids if valid."""
+    trace_id = parent_id = request_id = None
+    for name, value in headers:
+        if name == b"traceparent":
+            match = TRACEPARENT_PATTERN.fullmatch(value.decode("latin-1"))
+            if match and match.group(1) != "0" * 32:
+                trace_id, parent_id = match.groups()
+        elif name == REQUEST_ID_HEADER:
+            value = value.decode("latin-1")
+            if REQUEST_ID_PATTERN.fullmatch(value):
+                request_id = value
+    trace = Trace(trace_id, request_id)
+    trace.spans.append(Span("request", parent_id, SPAN_KIND_SERVER))
+    return trace
+
+
+class TracingMiddleware:  # pylint: disable=too-few-public-methods
+    """ASGI middleware that traces every HTTP request."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        trace = incoming_trace(scope["headers"])
+        root = trace.spans[0]
+        root.attributes.update(
+            {"http.method": scope["method"], "http.request_id": trace.request_id}
+        )
+
+        async def traced_send(message):
+            if message["type"] == "http.response.start":
+                root.attributes["http.status_code"] = message["status"]
+                root.error = message["status"] >= 500
+                headers = [
+                    (key, value)
+                    for key, value in message.get("headers", [])
+                    if key.lower() != REQUEST_ID_HEADER
+                ]
+                headers.append((REQUEST_ID_HEADER, trace.request_id.encode()))
+                timing = trace.server_timing()
+                total = (time.perf_counter_ns() - root.start) / 1e6
+                headers.append(
+                    (
+                        b"server-timing",
+                        f"{timing + ', ' if timing else ''}total;dur={total:.1f}".encode(),
+                    )
+                )
+                message = {**message, "headers": headers}
+            await send(message)
+
+        trace_token = current_trace.set(trace)
+        span_token = current_span.set(root)
+        try:
+            await self.app(scope, receive, traced_send)
+        except BaseException:
+            root.error = True
+            raise
+        finally:
+            root.finish()
+            root.attributes["http.route"] = route_label(scope)
+            current_span.reset(span_token)
+            current_trace.reset(trace_token)
+            trace_sink.write(trace)
+
+
+trace_sink = TraceSink()
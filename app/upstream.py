@@ -0,0 +1,305 @@
+"""Deadlines, hedged requests and a circuit breaker for the upstream LLM calls.
+
+Every call to the model goes through ``call_upstream``. The call is given
+what is left of the deadline of the request it serves, set per endpoint with
+``deadline``, or LLM_DEADLINE when there is none, and is cancelled when that
+runs out. Chat completions can be hedged: when a call takes longer than the
+HEDGE_PERCENTILE of recent calls on the same route, a second identical call
+is sent, the first answer is used and the other call is cancelled. Assistant
+runs are never hedged, since a second run would answer twice in the thread.
+
+A circuit breaker counts consecutive provider failures: timeouts, dropped
+connections and 5xx errors. A call cancelled because its request ran out of
+time, or that could not leave the local rate limit queue in time, is not a
+failure of the provider, and a request that fails in several of its
+concurrent calls counts once. After CIRCUIT_FAILURES of them the
+circuit opens and calls fail at once with CircuitOpenError for
+CIRCUIT_RESET seconds. Then a single trial call is let through, which closes
+the circuit if it succeeds and opens it again if it fails. Each process has
+its own breaker.
+"""
+
+import asyncio
+import math
+import os
+import time
+from collections import defaultdict, deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dotenv import load_dotenv
+from openai import APIConnectionError, InternalServerError
+from app.metrics import (
+    CIRCUIT_REJECTED,
+    CIRCUIT_STATE,
+    HEDGED_REQUESTS,
+    UPSTREAM_DEADLINES_EXCEEDED,
+)
+from app.tracing import current_span
+
+load_dotenv()
+
+# The longest a call may take, and its deadline when the request sets none. A
+# call that runs past it counts as a provider failure.
+LLM_DEADLINE = float(os.getenv("LLM_DEADLINE", "600"))
+DEADLINE_MINNISBLAD = float(os.getenv("DEADLINE_MINNISBLAD", "240"))
+DEADLINE_MINNISBLAD_ADSTOD = float(os.getenv("DEADLINE_MINNISBLAD_ADSTOD", "180"))
+DEADLINE_ADSTOD = float(os.getenv("DEADLINE_ADSTOD", "120"))
+HEDGE_REQUESTS = os.getenv("HEDGE_REQUESTS", "false").lower() == "true"
+HEDGE_PERCENTILE = float(os.getenv("HEDGE_PERCENTILE", "0.95"))
+# Calls are only hedged once a route has this many latencies to go by.
+HEDGE_MIN_SAMPLES = 20
+HEDGE_WINDOW = 200
+CIRCUIT_FAILURES = int(os.getenv("CIRCUIT_FAILURES", "5"))
+CIRCUIT_RESET = float(os.getenv("CIRCUIT_RESET", "30"))
+
+CLOSED, HALF_OPEN, OPEN = "closed", "half_open", "open"
+CIRCUIT_STATES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+current_deadline = ContextVar("current_deadline", default=None)
+
+
+class RequestDeadline:  # pylint: disable=too-few-public-methods
+    """The time a request has for its upstream calls.
+
+    It also records whether one of the calls has failed, so the breaker
+    counts a request once however many calls it makes at the same time.
+    """
+
+    def __init__(self, end: float):
+        self.end = end
+        self.failed = False
+
+
+class DeadlineExceeded(Exception):
+    """Raised when an upstream call runs past the deadline of its request."""
+
+
+class QueueTimeout(Exception):
+    """Raised by a local queue when a call can't be sent within its deadline."""
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling the provider while the circuit is open."""
+
+    def __init__(self, retry_after: float):
+        super().__init__("The circuit to the LLM provider is open.")
+        self.retry_after = retry_after
+
+
+@contextmanager
+def deadline(seconds: float):
+    """Give the upstream calls made inside at most ``seconds`` in total.
+
+    An outer deadline that ends sooner still applies.
+    """
+    end = time.monotonic() + seconds
+    outer = current_deadline.get()
+    token = current_deadline.set(
+        RequestDeadline(end if outer is None else min(outer.end, end))
+    )
+    try:
+        yield
+    finally:
+        current_deadline.reset(token)
+
+
+def remaining() -> float:
+    """Return the seconds left for the upstream calls of the request."""
+    request = current_deadline.get()
+    return LLM_DEADLINE if request is None else request.end - time.monotonic()
+
+
+def failure_outcome():
+    """Return the outcome to record for a failed call.
+
+    Only the first failure of a request counts, and the others are recorded
+    as abandoned calls.
+    """
+    request = current_deadline.get()
+    if request is None:
+        return False
+    if request.failed:
+        return None
+    request.failed = True
+    return False
+
+
+def is_provider_failure(e: BaseException) -> bool:
+    """Check if an error means the provider is failing, rather than the request.
+
+    A call that timed out waiting in a local queue never reached the provider.
+    """
+    if isinstance(e, QueueTimeout) or isinstance(e.__cause__, QueueTimeout):
+        return False
+    return isinstance(e, (DeadlineExceeded, APIConnectionError, InternalServerError))
+
+
+class CircuitBreaker:
+    """Fails fast after repeated provider failures, until a trial call succeeds."""
+
+    def __init__(
+        self,
+        failures: int = CIRCUIT_FAILURES,
+        reset: float = CIRCUIT_RESET,
+        clock=time.monotonic,
+    ):
+        self.threshold = failures
+        self.reset_after = reset
+        self.clock = clock
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.trial = False
+
+    def set_state(self, state: str):
+        """Move to a state and show it in the metrics."""
+        self.state = state
+        CIRCUIT_STATE.set(CIRCUIT_STATES[state])
+
+    def check(self):
+        """Raise CircuitOpenError unless a call may be made now."""
+        if self.state == OPEN:
+            waited = self.clock() - self.opened_at
+            if waited < self.reset_after:
+                CIRCUIT_REJECTED.inc()
+                raise CircuitOpenError(self.reset_after - waited)
+            self.set_state(HALF_OPEN)
+            self.trial = False
+        if self.state == HALF_OPEN:
+            if self.trial:
+                CIRCUIT_REJECTED.inc()
+                raise CircuitOpenError(self.reset_after)
+            self.trial = True
+
+    def record(self, success):
+        """Record the outcome of a call, or None if it was abandoned."""
+        if success is None:
+            self.trial = False
+        elif success:
+            self.failures = 0
+            if self.state != CLOSED:
+                self.set_state(CLOSED)
+        else:
+            self.failures += 1
+            if self.state == HALF_OPEN or self.failures >= self.threshold:
+                self.opened_at = self.clock()
+                self.set_state(OPEN)
+
+    def reset(self):
+        """Close the circuit and forget the failures."""
+        self.failures = 0
+        self.trial = False
+        self.set_state(CLOSED)
+
+
+class LatencyWindow:
+    """The latencies of the most recent successful calls on each route."""
+
+    def __init__(self, size: int = HEDGE_WINDOW):
+        self.latencies = defaultdict(lambda: deque(maxlen=size))
+
+    def observe(self, key: str, seconds: float):
+        """Add the latency of a call."""
+        self.latencies[key].append(seconds)
+
+    def percentile(self, key: str, share: float):
+        """Return the nearest-rank percentile, or None with too few samples."""
+        values = self.latencies.get(key)
+        if not values or len(values) < HEDGE_MIN_SAMPLES:
+            return None
+        ordered = sorted(values)
+        return ordered[max(0, math.ceil(share * len(ordered)) - 1)]
+
+    def clear(self):
+        """Forget all latencies."""
+        self.latencies.clear()
+
+
+circuit_breaker = CircuitBreaker()
+latency_window = LatencyWindow()
+
+
+async def hedged(call, delay: float, operation: str):
+    """Run ``call()``, and again if it takes longer than ``delay`` seconds.
+
+    The first successful answer is used and the other call is cancelled.
+    """
+    tasks = {asyncio.ensure_future(call())}
+    try:
+        done, _ = await asyncio.wait(tasks, timeout=delay)
+        if done:
+            return done.pop().result()
+        first = next(iter(tasks))
+        tasks.add(asyncio.ensure_future(call()))
+        item = current_span.get()
+        if item is not None:
+            item.attributes["hedged"] = True
+        pending = set(tasks)
+        while True:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            answered = [task for task in done if task.exception() is None]
+            if answered or not pending:
+                task = (answered or list(done))[0]
+                winner = "first" if task is first else "hedge"
+                HEDGED_REQUESTS.labels(operation, winner).inc()
+                return task.result()
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+async def call_upstream(call, operation: str, hedge_key: str = None):
+    """Make an upstream call within the deadline and through the breaker.
+
+    ``call`` is a function that returns the awaitable of the call. A
+    ``hedge_key`` names the route whose latencies decide when to hedge, and
+    only calls that are safe to repeat should have one.
+    """
+    budget = remaining()
+    if budget <= 0:
+        UPSTREAM_DEADLINES_EXCEEDED.labels(operation).inc()
+        raise DeadlineExceeded(f"No time was left for the {operation} call.")
+    timeout = min(budget, LLM_DEADLINE)
+    circuit_breaker.check()
+    delay = (
+        latency_window.percentile(hedge_key, HEDGE_PERCENTILE)
+        if hedge_key and HEDGE_REQUESTS and circuit_breaker.state == CLOSED
+        else None
+    )
+    success = None
+    start = time.monotonic()
+    try:
+        async with asyncio.timeout(timeout):
+            if delay is None:
+                result = await call()
+            else:
+                result = await hedged(call, delay, operation)
+    except TimeoutError as e:
+        # Running out the request's own time says nothing about the provider.
+        if timeout == LLM_DEADLINE:
+            success = failure_outcome()
+        UPSTREAM_DEADLINES_EXCEEDED.labels(operation).inc()
+        raise DeadlineExceeded(
+            f"The {operation} call took longer than {timeout:g} seconds."
+        ) from e
+    except Exception as e:
+        if is_provider_failure(e):
+            success = failure_outcome()
+        raise
+    else:
+        success = True
+    finally:
+        circuit_breaker.record(success)
+    if hedge_key:
+        latency_window.observe(hedge_key, time.monotonic() - start)
+    return result
+
+
+async def within_deadline(awaitable, operation: str):
+    """Await the next part of an upstream call, such as a streamed event."""
+    try:
+        async with asyncio.timeout(remaining()):
+            return await awaitable
+    except TimeoutError as e:
+        UPSTREAM_DEADLINES_EXCEEDED.labels(operation).inc()
+        raise DeadlineExceeded(f"The {operation} call ran past its deadline.") from e
@@ -1,56 +1,128 @@
 """Utility functions for the app."""
 
+import asyncio
+import io
+import math
 import os
 import json
+from functools import partial
 from fastapi import HTTPException, Depends, status, UploadFile
 from fastapi.security import HTTPAuthorizationCredentials, HTTPBearer
 from dotenv import load_dotenv
-from docx import Document
-from openai import OpenAI
+from openai import APITimeoutError, RateLimitError
+from app.cache import make_cache_key, response_cache
+from app.chunking import merge_responses, split_text
+from app.docx_text import DocxText, DocxTooLargeError, InvalidDocxError, read_docx_text
+from app.executor import TaskLimitError, run_cpu
+from app.metrics import LLM_ESCALATIONS, LLM_TRUNCATED, llm_call, record_usage, stage
+from app.openai_client import client
+from app.response_format import check_response
+from app.routing import DEFAULT_ROUTE, OPENAI_MODEL, Route, can_escalate, choose_route
+from app.singleflight import SingleFlight
+from app.tokens import (
+    MAX_DOCUMENT_TOKENS,
+    count_prompt_tokens,
+    count_tokens,
+    output_budget,
+    output_cap,
+)
+from app.tracing import span
+from app.upstream import CircuitOpenError, DeadlineExceeded, call_upstream
 
 load_dotenv()
 
-openai_api_key = os.getenv("OPENAI_API_KEY")
+COMPLETION_PARAMS = {
+    "temperature": 1,
+    "top_p": 1,
+    "frequency_penalty": 0,
+    "presence_penalty": 0,
+}
+DOCX_CONTENT_TYPE = (
+    "application/vnd.openxmlformats-officedocument.wordprocessingml.document"
+)
+MIN_WORDS = 10
+SERVICE_BUSY_DETAIL = "The service is busy, please try again shortly."
+SERVICE_BUSY_RETRY_AFTER = "30"
+SERVICE_UNAVAILABLE_DETAIL = (
+    "The language model service is unavailable, please try again shortly."
+)
+SERVICE_TIMEOUT_DETAIL = "The language model did not answer in time."
+# Longer documents are split into chunks, so this is well above what fits in
+# a single request.
+MAX_WORDS = int(os.getenv("MAX_WORDS", "50000"))
 
-# Set the OpenAI API key globally
-
-OpenAI.api_key = openai_api_key
-client = OpenAI()
+SYSTEM_PROMPT = """Notendinn sendi þér minnisblað, farðu mjög varlega yfir það og
+    finndu dæmi um önnur minnisblöð, 
+    gefðu þér tíma að skoa Íslenskt málfar og stafsetningu."""
 
 BEARER_TOKEN = os.getenv("BEARER_TOKEN")
 
 # Security scheme and token validation
 token_auth_scheme = HTTPBearer()
 
+# Identical requests that miss the cache at the same time share one call.
+in_flight_requests = SingleFlight()
+
+
+def is_service_busy(e: Exception) -> bool:
+    """Check if an error means OpenAI stayed rate limited past the deadline."""
+    return isinstance(e, (RateLimitError, APITimeoutError))
+
+
+def upstream_error(e: Exception):
+    """Return the HTTP error for a failed upstream call, or None for other errors.
+
+    An open circuit and a busy service are 503s and a missed deadline is a 504.
+    """
+    if isinstance(e, CircuitOpenError):
+        return HTTPException(
+            status_code=503,
+            detail=SERVICE_UNAVAILABLE_DETAIL,
+            headers={"Retry-After": str(math.ceil(e.retry_after))},
+        )
+    if isinstance(e, DeadlineExceeded):
+        return HTTPException(status_code=504, detail=SERVICE_TIMEOUT_DETAIL)
+    if is_service_busy(e):
+        return HTTPException(
+            status_code=503,
+            detail=SERVICE_BUSY_DETAIL,
+            headers={"Retry-After": SERVICE_BUSY_RETRY_AFTER},
+        )
+    return None
+
 
 def handle_unexpected_error(e: Exception):
     """
     Utility function to handle unexpected errors.
     """
+    error = upstream_error(e)
+    if error is not None:
+        raise error from e
     raise HTTPException(status_code=500, detail="An unexpected error occurred") from e
 
 
 def extract_text_from_docx(file):
     """Extract text from a .docx file."""
-    doc = Document(file)
-    text = []
-    for paragraph in doc.paragraphs:
-        text.append(paragraph.text)
-    return "\n".join(text)
+    with stage("docx_parse"):
+        return read_docx_text(file).text
 
 
-async def send_text_to_openai(text: str, response_format: dict) -> dict:
-    """Send the text to the OpenAI API and return the response."""
-    content_text = """Notendinn sendi þér minnisblað, farðu mjög varlega yfir það og
-    finndu dæmi um önnur minnisblöð, 
-    gefðu þér tíma að skoa Íslenskt málfar og stafsetningu."""
+def build_chat_request(
+    text: str, response_format: dict, model: str = OPENAI_MODEL
+) -> dict:
+    """Build the chat completion request for a document.
+
+    The same request body is used for interactive calls and for the offline
+    Batch API, which always uses OPENAI_MODEL. Its max_tokens is the output
+    budget for the response format and the size of the prompt.
+    """
     messages = [
         {
             "role": "system",
             "content": [
                 {
                     "type": "text",
-                    "text": content_text,
+                    "text": SYSTEM_PROMPT,
                 }
             ],
         },
@@ -59,46 +131,162 @@ async def send_text_to_openai(text: str, response_format: dict) -> dict:
             "content": [{"type": "text", "text": text}],
         },
     ]
+    prompt_tokens = count_prompt_tokens(messages, response_format)
+    return {
+        "model": model,
+        "messages": messages,
+        "response_format": response_format,
+        "max_tokens": output_budget(response_format, prompt_tokens),
+        **COMPLETION_PARAMS,
+    }
+
+
+async def send_text_to_openai(text: str, response_format: dict) -> dict:
+    """Send the text to the OpenAI API and return the response.
+
+    A text over the CHUNK_TOKENS budget is split into chunks that are sent
+    concurrently, and their responses are merged into one. The text is split
+    on the CPU executor.
+    """
+    chunks = await run_cpu(split_text, text)
+    with span("send_text_to_openai", chunks=len(chunks)):
+        if len(chunks) == 1:
+            return await send_chunk_to_openai(text, response_format)
+        responses = await asyncio.gather(
+            *(send_chunk_to_openai(chunk, response_format) for chunk in chunks)
+        )
+        return merge_responses(responses)
+
+
+async def send_chunk_to_openai(text: str, response_format: dict) -> dict:
+    """Send a text that fits in one request to the OpenAI API.
 
-    completion = client.chat.completions.create(
-        model="gpt-4o",
-        messages=messages,
-        temperature=1,
-        max_tokens=4000,
-        top_p=1,
-        frequency_penalty=0,
-        presence_penalty=0,
-        response_format=response_format,
+    Identical requests are answered from the response cache, or wait for the
+    same upstream call if one is in flight. Frozen response formats are keyed
+    on their precomputed hash. The model is chosen by the routing policy.
+    """
+    route = choose_route(response_format, count_tokens(text))
+    cache_key = make_cache_key(
+        text,
+        SYSTEM_PROMPT,
+        getattr(response_format, "digest", response_format),
+        route.model,
+        COMPLETION_PARAMS,
     )
-    response = json.loads(completion.choices[0].message.content)
-    return response
-
-
-def check_document_length(file) -> bool:
-    """Check if the document is within the word limit and is a word document."""
-    if (
-        file.content_type
-        != "application/vnd.openxmlformats-officedocument.wordprocessingml.document"
-        or not file.filename.endswith(".docx")
-    ):
-        return False
-    file.file.seek(0)
-    text = extract_text_from_docx(file.file)
-    word_count = len(text.split())
-    if word_count > 5000 or word_count < 10:
-        return False
-    return True
+    cached = await response_cache.get(cache_key)
+    if cached is not None:
+        return cached
 
+    content = await in_flight_requests.run(
+        cache_key, request_completion, cache_key, text, response_format, route
+    )
+    return json.loads(content)
 
-async def process_uploaded_file(file: UploadFile):
-    """Helper function to process the uploaded file."""
-    if not check_document_length(file):
-        raise HTTPException(
-            status_code=400,
-            detail="The document must contain between 10 and 5000 words.",
+
+async def create_completion(request: dict, route: str):
+    """Call the chat completions API and count the tokens it used.
+
+    The call is made within the request deadline, and may be hedged.
+    """
+    with llm_call(request["model"], route):
+        completion = await call_upstream(
+            partial(client.chat.completions.create, **request),
+            "chat",
+            hedge_key=f"{route}/{request['model']}",
         )
-    file.file.seek(0)
-    return extract_text_from_docx(file.file)
+    record_usage(request["model"], completion.usage)
+    return completion
+
+
+async def complete(text: str, response_format: dict, model: str, route: str) -> str:
+    """Ask a model for a response and return its raw content.
+
+    A response that was cut off at its output budget is asked for again
+    with the largest budget of its format.
+    """
+    request = build_chat_request(text, response_format, model)
+    completion = await create_completion(request, route)
+    cap = output_cap(response_format)
+    if completion.choices[0].finish_reason == "length" and request["max_tokens"] < cap:
+        LLM_TRUNCATED.inc()
+        completion = await create_completion({**request, "max_tokens": cap}, route)
+    return completion.choices[0].message.content
+
+
+async def request_completion(
+    cache_key: str, text: str, response_format: dict, route: Route = DEFAULT_ROUTE
+) -> str:
+    """Call the API, cache the response and return its raw content.
+
+    When a small model's response doesn't fit the response format, it is
+    asked for again from OPENAI_MODEL.
+    """
+    content = await complete(text, response_format, route.model, route.name)
+    if can_escalate(route):
+        try:
+            check_response(content, response_format)
+        except ValueError:
+            LLM_ESCALATIONS.labels(route.name).inc()
+            content = await complete(text, response_format, OPENAI_MODEL, route.name)
+    json.loads(content)  # Don't cache a response that is not valid JSON.
+    await response_cache.set(cache_key, content)
+    return content
+
+
+def is_word_document(file: UploadFile) -> bool:
+    """Check if the uploaded file is a word document."""
+    return file.content_type == DOCX_CONTENT_TYPE and file.filename.endswith(".docx")
+
+
+def length_error(max_words: int) -> HTTPException:
+    """Return the error for a document that is too short or too long."""
+    return HTTPException(
+        status_code=400,
+        detail=f"The document must contain between {MIN_WORDS} and {max_words} words.",
+    )
+
+
+def invalid_document_error() -> HTTPException:
+    """Return the error for a file that is not a readable .docx document."""
+    return HTTPException(
+        status_code=400, detail="The file is not a valid .docx document."
+    )
+
+
+def check_word_count(document: DocxText, max_words: int) -> DocxText:
+    """Reject a document that is too short or went over the word limit."""
+    if document.truncated or document.word_count < MIN_WORDS:
+        raise length_error(max_words)
+    return document
+
+
+async def process_uploaded_file(file: UploadFile):
+    """Helper function to process the uploaded file.
+
+    The document is parsed and its tokens counted on the CPU executor, so a
+    large upload doesn't hold up other requests.
+    """
+    with span("process_uploaded_file"):
+        if not is_word_document(file):
+            raise length_error(MAX_WORDS)
+        await file.seek(0)
+        data = await file.read()
+        try:
+            with stage("docx_parse"):
+                document = await run_cpu(read_docx_text, io.BytesIO(data), MAX_WORDS)
+        except (DocxTooLargeError, TaskLimitError) as e:
+            raise HTTPException(
+                status_code=413, detail="The document is too large to process."
+            ) from e
+        except InvalidDocxError as e:
+            raise invalid_document_error() from e
+        text = check_word_count(document, MAX_WORDS).text
+        if await run_cpu(count_tokens, text) > MAX_DOCUMENT_TOKENS:
+            raise HTTPException(
+                status_code=400,
+                detail=f"The document must not be longer than {MAX_DOCUMENT_TOKENS} tokens.",
+            )
+        return text
 
 
 def get_token(credentials: HTTPAuthorizationCredentials = Depends(token_auth_scheme)):
@@ -0,0 +1,67 @@
+"""Benchmark the citation rewriting against the previous implementation.
+
+Run with ``python -m benchmarks.bench_citations``.
+"""
+
+import re
+import timeit
+from functools import partial
+from app.citations import CitationRewriter
+from app.routes.adstod import process_message
+
+
+def legacy_process_message(the_message):
+    """The two-pass implementation that process_message replaced."""
+    matches = re.findall(r"【.*?†(.*?)】", the_message)
+    file_map = {}
+    for file in matches:
+        if file not in file_map:
+            file_map[file] = len(file_map) + 1
+    text_with_indices = re.sub(
+        r"【.*?†(.*?)】", lambda match: f"【{file_map[match.group(1)]}】", the_message
+    )
+    sources_list = "\n".join(f"{index}: {file}" for file, index in file_map.items())
+    if not sources_list:
+        return text_with_indices
+    return f"{text_with_indices}\n\nSources:\n{sources_list}"
+
+
+def make_reply(paragraphs: int, sources: int = 25) -> str:
+    """Build a long reply with a citation after every sentence."""
+    sentence = "Samkvæmt reglugerðinni skal stofnunin skila skýrslu árlega"
+    return "\n\n".join(
+        " ".join(
+            f"{sentence}【{p}:{s}†skjal_{(p * 3 + s) % sources}.pdf】."
+            for s in range(8)
+        )
+        for p in range(paragraphs)
+    )
+
+
+def stream_rewrite(chunks):
+    """Rewrite a reply that arrives as stream chunks."""
+    rewriter = CitationRewriter()
+    return "".join(rewriter.feed(chunk) for chunk in chunks) + rewriter.finish()
+
+
+def main():
+    """Run the benchmark and print the results."""
+    for paragraphs in (10, 100, 1000):
+        reply = make_reply(paragraphs)
+        assert process_message(reply) == legacy_process_message(reply)
+        chunks = [reply[i : i + 16] for i in range(0, len(reply), 16)]
+        number = max(1, 2000 // paragraphs)
+        results = {
+            "legacy": timeit.timeit(
+                partial(legacy_process_message, reply), number=number
+            ),
+            "single pass": timeit.timeit(partial(process_message, reply), number=number),
+            "streamed": timeit.timeit(partial(stream_rewrite, chunks), number=number),
+        }
+        print(f"{len(reply):>9} chars, {paragraphs * 8} citations")
+        for name, total in results.items():
+            print(f"  {name:<12} {total / number * 1e6:10.1f} µs")
+
+
+if __name__ == "__main__":
+    main()
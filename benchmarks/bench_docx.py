@@ -0,0 +1,55 @@
+"""Benchmark the .docx text extraction against the previous two-pass path.
+
+Run with ``python -m benchmarks.bench_docx``.
+"""
+
+import io
+import timeit
+from functools import partial
+from docx import Document
+from app.docx_text import read_docx_text
+from app.utils import MAX_WORDS
+
+
+def legacy_extract(data: bytes) -> str:
+    """The previous path: parse once to check the length and once for the text."""
+    for _ in range(2):
+        doc = Document(io.BytesIO(data))
+        text = "\n".join(paragraph.text for paragraph in doc.paragraphs)
+    if len(text.split()) > MAX_WORDS:
+        return ""
+    return text
+
+
+def streaming_extract(data: bytes) -> str:
+    """The single streaming pass with the word limit cutoff."""
+    document = read_docx_text(io.BytesIO(data), max_words=MAX_WORDS)
+    return "" if document.truncated else document.text
+
+
+def make_document(words: int) -> bytes:
+    """Build a document with the given number of words."""
+    doc = Document()
+    sentence = "Ráðuneytið leggur til að reglugerðinni verði breytt sem hér segir"
+    per_paragraph = len(sentence.split())
+    for _ in range(words // per_paragraph):
+        doc.add_paragraph(sentence)
+    buffer = io.BytesIO()
+    doc.save(buffer)
+    return buffer.getvalue()
+
+
+def main():
+    """Run the benchmark and print the results."""
+    for words in (1000, 5000, 50000):
+        data = make_document(words)
+        number = 20 if words < 50000 else 3
+        legacy = timeit.timeit(partial(legacy_extract, data), number=number)
+        streaming = timeit.timeit(partial(streaming_extract, data), number=number)
+        print(f"{words:>6} words")
+        print(f"  legacy     {legacy / number * 1000:8.2f} ms")
+        print(f"  streaming  {streaming / number * 1000:8.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
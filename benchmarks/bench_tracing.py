@@ -0,0 +1,63 @@
+"""Benchmark the per-request overhead of the tracing and metrics middleware.
+
+Run with ``python -m benchmarks.bench_tracing``.
+"""
+
+import asyncio
+import tempfile
+import time
+import httpx
+from fastapi import FastAPI
+from app import tracing
+from app.metrics import MetricsMiddleware, stage
+
+
+def make_app(*middleware) -> FastAPI:
+    """Build an app with one route that runs three stages."""
+    app = FastAPI()
+    for cls in middleware:
+        app.add_middleware(cls)
+
+    @app.get("/items/{item_id}")
+    async def read_item(item_id: str):
+        for name in ("docx_parse", "llm_call", "docx_build"):
+            with stage(name):
+                pass
+        return {"item_id": item_id}
+
+    return app
+
+
+async def time_requests(app: FastAPI, number: int) -> float:
+    """Return the mean time of a request to the app, in microseconds."""
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        for _ in range(100):
+            await client.get("/items/warmup")
+        start = time.perf_counter()
+        for _ in range(number):
+            await client.get("/items/42")
+        return (time.perf_counter() - start) / number * 1e6
+
+
+def main():
+    """Run the benchmark and print the results."""
+    number = 5000
+    traced = make_app(MetricsMiddleware, tracing.TracingMiddleware)
+    results = {
+        "none": asyncio.run(time_requests(make_app(), number)),
+        "metrics": asyncio.run(time_requests(make_app(MetricsMiddleware), number)),
+    }
+    tracing.trace_sink = tracing.TraceSink("")
+    results["+tracing, no file"] = asyncio.run(time_requests(traced, number))
+    with tempfile.TemporaryDirectory() as directory:
+        tracing.trace_sink = tracing.TraceSink(f"{directory}/traces.jsonl")
+        results["+tracing"] = asyncio.run(time_requests(traced, number))
+        tracing.trace_sink.close()
+    for name, result in results.items():
+        overhead = result - results["none"]
+        print(f"  {name:<18} {result:8.1f} us/request  (+{overhead:.1f} us)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,383 @@
+"""Load test the app against the fake OpenAI server.
+
+The fake server and the app are started as uvicorn processes on free ports,
+and each endpoint is driven at rising concurrency. For every level the
+throughput, the p50, p95 and p99 latency, the memory of every app worker
+and the p50 and p95 of the prompt, completion and max_tokens of the chat
+completions the fake server answered, with how many went to each model, are
+reported. The results are stored
+in ``benchmarks/results/<commit>.json`` so that a later run can be compared
+with them.
+
+Run with ``python -m benchmarks.load``, and for example
+``python -m benchmarks.load --compare 1a2b3c4`` to compare with a commit.
+"""
+
+import argparse
+import asyncio
+import io
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+from collections import Counter
+from datetime import datetime, timezone
+from pathlib import Path
+import httpx
+from docx import Document
+
+RESULTS_DIR = Path(__file__).parent / "results"
+BEARER_TOKEN = "load-test"
+DOCX_CONTENT_TYPE = (
+    "application/vnd.openxmlformats-officedocument.wordprocessingml.document"
+)
+ENDPOINTS = ("minnisblad", "minnisblad-adstod", "adstod")
+CHAPTERS = '["inngangur", "samantekt", "aaetlun", "markmid"]'
+
+
+def free_port() -> int:
+    """Return a free local port."""
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def make_documents(count: int, words: int = 600) -> list:
+    """Build documents that all differ, so no uploads are coalesced."""
+    sentence = "Ráðuneytið leggur til að reglugerðinni verði breytt sem hér segir"
+    paragraph = " ".join([sentence] * (words // len(sentence.split()) // 5 + 1))
+    documents = []
+    for number in range(count):
+        doc = Document()
+        doc.add_paragraph(f"Minnisblað númer {number}")
+        for _ in range(5):
+            doc.add_paragraph(paragraph)
+        buffer = io.BytesIO()
+        doc.save(buffer)
+        documents.append(buffer.getvalue())
+    return documents
+
+
+def build_request(endpoint: str, number: int, documents: list) -> dict:
+    """Return the arguments of one request to an endpoint."""
+    headers = {"Authorization": f"Bearer {BEARER_TOKEN}"}
+    if endpoint == "adstod":
+        return {
+            "url": "/adstod/start",
+            "json": {"message": f"Spurning númer {number}"},
+        }
+    files = {
+        "file": ("skjal.docx", documents[number % len(documents)], DOCX_CONTENT_TYPE)
+    }
+    if endpoint == "minnisblad":
+        return {
+            "url": "/minnisblad/upload/",
+            "files": files,
+            "data": {"chapters": CHAPTERS},
+            "headers": headers,
+        }
+    return {"url": "/minnisblad-adstod/upload/", "files": files, "headers": headers}
+
+
+def percentile(values: list, share: float) -> float:
+    """Return the nearest-rank percentile of the values."""
+    ordered = sorted(values)
+    return ordered[max(0, int(round(share * len(ordered))) - 1)]
+
+
+def child_pids(pid: int) -> list:
+    """Return the ids of the child processes of a process, on Linux."""
+    try:
+        children = Path(f"/proc/{pid}/task/{pid}/children").read_text(encoding="ascii")
+    except OSError:
+        return []
+    return [int(child) for child in children.split()]
+
+
+def resident_memory(pid: int) -> float:
+    """Return the resident memory of a process in MB, on Linux."""
+    try:
+        status = Path(f"/proc/{pid}/status").read_text(encoding="ascii")
+    except OSError:
+        return 0.0
+    for line in status.splitlines():
+        if line.startswith("VmRSS:"):
+            return int(line.split()[1]) / 1024
+    return 0.0
+
+
+def worker_memory(pid: int) -> list:
+    """Return the memory of every app worker in MB.
+
+    With several workers uvicorn runs them as children of a supervisor.
+    """
+    workers = [
+        child
+        for child in child_pids(pid)
+        if b"resource_tracker" not in Path(f"/proc/{child}/cmdline").read_bytes()
+    ] or [pid]
+    return [round(resident_memory(worker), 1) for worker in workers]
+
+
+async def run_level(client: httpx.AsyncClient, endpoint: str, concurrency: int, args):
+    """Send ``args.requests`` requests with ``concurrency`` in flight at a time."""
+    latencies, errors = [], 0
+    counter = iter(range(args.requests))
+
+    async def worker():
+        nonlocal errors
+        for number in counter:
+            request = build_request(endpoint, number, args.documents)
+            start = time.perf_counter()
+            try:
+                response = await client.post(**request)
+            except httpx.HTTPError:
+                errors += 1
+                continue
+            if response.status_code == 200:
+                latencies.append(time.perf_counter() - start)
+            else:
+                errors += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    return {
+        "endpoint": endpoint,
+        "concurrency": concurrency,
+        "requests": args.requests,
+        "errors": errors,
+        "throughput": round(len(latencies) / elapsed, 2),
+        "p50": round(percentile(latencies, 0.50), 4) if latencies else None,
+        "p95": round(percentile(latencies, 0.95), 4) if latencies else None,
+        "p99": round(percentile(latencies, 0.99), 4) if latencies else None,
+    }
+
+
+def start_server(module: str, port: int, env: dict, workers: int = 1):
+    """Start a uvicorn server as a subprocess."""
+    command = [sys.executable, "-m", "uvicorn", module, "--port", str(port)]
+    command += ["--workers", str(workers), "--log-level", "warning", "--no-access-log"]
+    return subprocess.Popen(command, env={**os.environ, **env})
+
+
+async def wait_until_ready(url: str, timeout: float = 30):
+    """Wait for a server to answer."""
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient() as client:
+        while True:
+            try:
+                await client.get(url)
+                return
+            except httpx.TransportError:
+                if time.monotonic() > deadline:
+                    raise
+                await asyncio.sleep(0.2)
+
+
+def token_summary(usage: list) -> dict:
+    """Return the p50 and p95 of each kind of token in the chat usage."""
+    summary = {}
+    for kind in ("prompt_tokens", "completion_tokens", "max_tokens"):
+        values = [item[kind] for item in usage if item.get(kind) is not None]
+        summary[kind] = {
+            "p50": percentile(values, 0.50) if values else None,
+            "p95": percentile(values, 0.95) if values else None,
+        }
+    return summary
+
+
+async def run_load(args, app_process, app_url: str, fake_url: str) -> list:
+    """Drive every endpoint at every concurrency level."""
+    results = []
+    timeout = httpx.Timeout(300)
+    limits = httpx.Limits(max_connections=max(args.concurrency))
+    async with httpx.AsyncClient(
+        base_url=app_url, timeout=timeout, limits=limits
+    ) as client, httpx.AsyncClient(base_url=fake_url) as fake:
+        for endpoint in args.endpoints:
+            for concurrency in args.concurrency:
+                await fake.get("/fake/usage", params={"reset": True})
+                result = await run_level(client, endpoint, concurrency, args)
+                result["memory_mb"] = worker_memory(app_process.pid)
+                usage = await fake.get("/fake/usage", params={"reset": True})
+                result["tokens"] = token_summary(usage.json())
+                result["models"] = dict(Counter(item["model"] for item in usage.json()))
+                results.append(result)
+                print(format_result(result), flush=True)
+    return results
+
+
+def format_result(result: dict, baseline: dict = None) -> str:
+    """Format one result as a table row, with the change from the baseline."""
+    row = (
+        f"{result['endpoint']:<18} {result['concurrency']:>4} "
+        f"{result['throughput']:>8.2f}/s  p50 {result['p50'] or 0:7.3f}s  "
+        f"p95 {result['p95'] or 0:7.3f}s  p99 {result['p99'] or 0:7.3f}s  "
+        f"errors {result['errors']:>3}  mem {max(result['memory_mb'], default=0):6.1f}MB"
+    )
+    tokens = result.get("tokens", {})
+    for kind, label in (("prompt_tokens", "prompt"), ("max_tokens", "max")):
+        if (tokens.get(kind) or {}).get("p50") is not None:
+            row += f"  {label} {tokens[kind]['p50']}/{tokens[kind]['p95']}"
+    for model, calls in result.get("models", {}).items():
+        row += f"  {model} {calls}"
+    if baseline:
+        row += f"  throughput {change(baseline['throughput'], result['throughput'])}"
+        row += f"  p95 {change(baseline['p95'], result['p95'])}"
+        before = (baseline.get("tokens") or {}).get("max_tokens") or {}
+        if before.get("p50") and (tokens.get("max_tokens") or {}).get("p50"):
+            row += f"  max {change(before['p50'], tokens['max_tokens']['p50'])}"
+    return row
+
+
+def change(before, after) -> str:
+    """Format the relative change between two values."""
+    if not before or after is None:
+        return "n/a"
+    return f"{(after - before) / before:+.1%}"
+
+
+def regressions(results: list, baseline: list, threshold: float) -> list:
+    """Return the results whose throughput or p95 got worse than the threshold."""
+    previous = {(item["endpoint"], item["concurrency"]): item for item in baseline}
+    worse = []
+    for result in results:
+        before = previous.get((result["endpoint"], result["concurrency"]))
+        if not before or not result["p95"] or not before["p95"]:
+            continue
+        if (
+            result["throughput"] < before["throughput"] * (1 - threshold)
+            or result["p95"] > before["p95"] * (1 + threshold)
+        ):
+            worse.append((result, before))
+    return worse
+
+
+def current_commit() -> str:
+    """Return the short hash of the checked out commit, marked if modified."""
+    commit = subprocess.run(
+        ["git", "rev-parse", "--short", "HEAD"],
+        capture_output=True, text=True, check=True,
+    ).stdout.strip()
+    dirty = subprocess.run(
+        ["git", "status", "--porcelain", "--untracked-files=no"],
+        capture_output=True, text=True, check=True,
+    ).stdout.strip()
+    return f"{commit}-dirty" if dirty else commit
+
+
+def load_results(name: str, directory: Path = RESULTS_DIR) -> dict:
+    """Load stored results by commit or by path."""
+    path = Path(name)
+    if not path.exists():
+        path = directory / f"{name}.json"
+    return json.loads(path.read_text(encoding="utf-8"))
+
+
+def parse_args(argv=None):
+    """Parse the command line."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--endpoints", nargs="+", choices=ENDPOINTS, default=ENDPOINTS)
+    parser.add_argument("--concurrency", nargs="+", type=int, default=[1, 4, 16, 64])
+    parser.add_argument("--requests", type=int, default=64, help="Requests per level.")
+    parser.add_argument("--workers", type=int, default=1, help="App workers.")
+    parser.add_argument(
+        "--latency", type=float, default=0.5, help="Chat completion latency."
+    )
+    parser.add_argument(
+        "--run-latency", type=float, default=1.0, help="Assistant run latency."
+    )
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument(
+        "--tail-rate", type=float, default=0.0, help="Share of slow completions."
+    )
+    parser.add_argument(
+        "--tail-latency", type=float, default=0.0, help="Slow completion latency."
+    )
+    parser.add_argument("--hedge", action="store_true", help="Hedge slow completions.")
+    parser.add_argument("--compare", help="Commit or results file to compare with.")
+    parser.add_argument(
+        "--threshold", type=float, default=0.1, help="Allowed regression, 0.1 is 10%%."
+    )
+    parser.add_argument("--out", help="Where to store the results.")
+    return parser.parse_args(argv)
+
+
+def run_servers(args) -> list:
+    """Start the fake server and the app, run the load and stop them again."""
+    fake_port, app_port = free_port(), free_port()
+    fake_env = {
+        "FAKE_OPENAI_LATENCY": str(args.latency),
+        "FAKE_OPENAI_RUN_LATENCY": str(args.run_latency),
+        "FAKE_OPENAI_ERROR_RATE": str(args.error_rate),
+        "FAKE_OPENAI_TAIL_RATE": str(args.tail_rate),
+        "FAKE_OPENAI_TAIL_LATENCY": str(args.tail_latency),
+        "FAKE_OPENAI_SEED": "0",
+    }
+    app_env = {
+        "OPENAI_BASE_URL": f"http://127.0.0.1:{fake_port}/v1",
+        "OPENAI_API_KEY": "load-test",
+        "BEARER_TOKEN": BEARER_TOKEN,
+        "OPENAI_REQUESTS_PER_MINUTE": "1000000",
+        "OPENAI_TOKENS_PER_MINUTE": "1000000000",
+        "RUN_POLL_MAX_INTERVAL": "0.5",
+        "RESPONSE_CACHE_SIZE": "0",
+        "JOB_WORKERS": "0",
+        "TRACE_FILE": "",
+        "HEDGE_REQUESTS": str(args.hedge).lower(),
+    }
+    fake = start_server("tests.fake_openai:app", fake_port, fake_env)
+    service = start_server("app.main:app", app_port, app_env, args.workers)
+    app_url, fake_url = f"http://127.0.0.1:{app_port}", f"http://127.0.0.1:{fake_port}"
+    try:
+        asyncio.run(wait_until_ready(f"{fake_url}/docs"))
+        asyncio.run(wait_until_ready(app_url))
+        return asyncio.run(run_load(args, service, app_url, fake_url))
+    finally:
+        for process in (service, fake):
+            process.terminate()
+            process.wait()
+
+
+def compare(results: list, baseline: dict, threshold: float) -> bool:
+    """Print the results next to the baseline and return whether any regressed."""
+    previous = {(item["endpoint"], item["concurrency"]): item for item in baseline["results"]}
+    print(f"Compared with {baseline['commit']}:")
+    for result in results:
+        print(format_result(result, previous.get((result["endpoint"], result["concurrency"]))))
+    worse = regressions(results, baseline["results"], threshold)
+    for result, _ in worse:
+        print(f"Regression: {result['endpoint']} at concurrency {result['concurrency']}")
+    return bool(worse)
+
+
+def main(argv=None):
+    """Run the load test and store, print and compare the results."""
+    args = parse_args(argv)
+    baseline = load_results(args.compare) if args.compare else None
+    args.documents = make_documents(args.requests)
+    results = run_servers(args)
+
+    commit = current_commit()
+    report = {
+        "commit": commit,
+        "date": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "config": {
+            key: value for key, value in vars(args).items() if key != "documents"
+        },
+        "results": results,
+    }
+    out = Path(args.out) if args.out else RESULTS_DIR / f"{commit}.json"
+    out.parent.mkdir(parents=True, exist_ok=True)
+    out.write_text(json.dumps(report, indent=2), encoding="utf-8")
+    print(f"Results stored in {out}")
+
+    if baseline and compare(results, baseline, args.threshold):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,193 @@
+"""Micro-benchmarks of the CPU hot paths over a generated corpus.
+
+Each operation is timed as the best of several rounds, and its peak
+allocation is measured in a separate run under tracemalloc. The corpus has
+documents of 1k, 5k and 50k words, a document with tables, memos of two
+sizes and an assistant reply with heavy citations. The results are stored
+in ``benchmarks/results/micro/<commit>.json`` for later comparison.
+
+Run with ``python -m benchmarks.micro``, and for example
+``python -m benchmarks.micro --compare 1a2b3c4`` to compare with a commit.
+"""
+
+import argparse
+import asyncio
+import io
+import json
+import sys
+import timeit
+import tracemalloc
+from datetime import datetime, timezone
+from pathlib import Path
+from docx import Document
+from starlette.datastructures import Headers, UploadFile
+from app.memo import CHAPTERS
+from app.routes.adstod import process_message
+from app.routes.minnisblad import (
+    build_response_format,
+    create_docx_from_json,
+    create_response_format,
+)
+from app.utils import DOCX_CONTENT_TYPE, extract_text_from_docx, process_uploaded_file
+from benchmarks.bench_citations import make_reply
+from benchmarks.load import RESULTS_DIR, change, current_commit, load_results
+
+MICRO_RESULTS_DIR = RESULTS_DIR / "micro"
+SENTENCE = "Ráðuneytið leggur til að reglugerðinni verði breytt sem hér segir"
+CHAPTER_KEYS = [chapter.key for chapter in CHAPTERS]
+
+
+def make_document(words: int, tables: int = 0) -> bytes:
+    """Build a document with about ``words`` words, a share of them in tables."""
+    doc = Document()
+    per_paragraph = len(SENTENCE.split()) * 5
+    table_words = words // 2 if tables else 0
+    for _ in range((words - table_words) // per_paragraph):
+        doc.add_paragraph(" ".join([SENTENCE] * 5))
+    for _ in range(tables):
+        rows = table_words // tables // (4 * len(SENTENCE.split()))
+        table = doc.add_table(rows=max(1, rows), cols=4)
+        for row in table.rows:
+            for cell in row.cells:
+                cell.text = SENTENCE
+    buffer = io.BytesIO()
+    doc.save(buffer)
+    return buffer.getvalue()
+
+
+def make_memo(chapters: int, words_per_chapter: int) -> dict:
+    """Build a memo response like the one the model returns."""
+    text = " ".join([SENTENCE] * (words_per_chapter // len(SENTENCE.split())))
+    return {
+        "titill": "Minnisblað um breytingar á reglugerð",
+        "kaflar": [
+            {"chapter_title": f"Kafli {number}", "content": text}
+            for number in range(chapters)
+        ],
+        **{key: text for key in CHAPTER_KEYS},
+    }
+
+
+def upload(data: bytes) -> UploadFile:
+    """Wrap a document as an uploaded file."""
+    return UploadFile(
+        io.BytesIO(data),
+        filename="skjal.docx",
+        headers=Headers({"content-type": DOCX_CONTENT_TYPE}),
+    )
+
+
+def build_operations() -> dict:
+    """Return the benchmarked operations by name."""
+    documents = {
+        "1k": make_document(1000),
+        "5k": make_document(5000),
+        "50k": make_document(50000),
+        "5k_tables": make_document(5000, tables=10),
+    }
+    operations = {}
+    for size, data in documents.items():
+        operations[f"extract_text_from_docx[{size}]"] = lambda data=data: (
+            extract_text_from_docx(io.BytesIO(data))
+        )
+        operations[f"process_uploaded_file[{size}]"] = lambda data=data: (
+            asyncio.run(process_uploaded_file(upload(data)))
+        )
+    for size, memo in (
+        ("small", make_memo(3, 100)),
+        ("large", make_memo(30, 500)),
+    ):
+        operations[f"create_docx_from_json[{size}]"] = lambda memo=memo: (
+            create_docx_from_json(memo, CHAPTER_KEYS)
+        )
+    operations["create_response_format"] = lambda: create_response_format(CHAPTER_KEYS)
+    operations["build_response_format[uncached]"] = lambda: (
+        build_response_format.__wrapped__(frozenset(CHAPTER_KEYS))
+    )
+    for paragraphs in (10, 1000):
+        reply = make_reply(paragraphs)
+        operations[f"process_message[{paragraphs * 8}_citations]"] = (
+            lambda reply=reply: process_message(reply)
+        )
+    return operations
+
+
+def measure(operation, rounds: int) -> dict:
+    """Return the best time per call and the peak allocation of one call."""
+    timer = timeit.Timer(operation)
+    number, _ = timer.autorange()
+    seconds = min(timer.repeat(repeat=rounds, number=number)) / number
+    tracemalloc.start()
+    operation()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {"seconds": seconds, "peak_kb": round(peak / 1024, 1)}
+
+
+def regressions(results: dict, baseline: dict, threshold: float) -> list:
+    """Return the operations that got slower or allocate more than the threshold."""
+    worse = []
+    for name, result in results.items():
+        before = baseline.get(name)
+        if before and (
+            result["seconds"] > before["seconds"] * (1 + threshold)
+            or result["peak_kb"] > before["peak_kb"] * (1 + threshold)
+        ):
+            worse.append(name)
+    return worse
+
+
+def format_result(name: str, result: dict, before: dict = None) -> str:
+    """Format one result as a table row, with the change from the baseline."""
+    row = f"{name:<42} {result['seconds'] * 1e3:10.3f} ms {result['peak_kb']:10.1f} KB"
+    if before:
+        row += f"  time {change(before['seconds'], result['seconds'])}"
+        row += f"  peak {change(before['peak_kb'], result['peak_kb'])}"
+    return row
+
+
+def parse_args(argv=None):
+    """Parse the command line."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--filter", default="", help="Only run matching operations.")
+    parser.add_argument("--rounds", type=int, default=5, help="Timing rounds.")
+    parser.add_argument("--compare", help="Commit or results file to compare with.")
+    parser.add_argument(
+        "--threshold", type=float, default=0.2, help="Allowed regression, 0.2 is 20%%."
+    )
+    parser.add_argument("--out", help="Where to store the results.")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    """Run the benchmarks and store, print and compare the results."""
+    args = parse_args(argv)
+    baseline = (
+        load_results(args.compare, MICRO_RESULTS_DIR)["results"] if args.compare else {}
+    )
+    results = {}
+    for name, operation in build_operations().items():
+        if args.filter in name:
+            results[name] = measure(operation, args.rounds)
+            print(format_result(name, results[name], baseline.get(name)), flush=True)
+
+    commit = current_commit()
+    report = {
+        "commit": commit,
+        "date": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "results": results,
+    }
+    out = Path(args.out) if args.out else MICRO_RESULTS_DIR / f"{commit}.json"
+    out.parent.mkdir(parents=True, exist_ok=True)
+    out.write_text(json.dumps(report, indent=2), encoding="utf-8")
+    print(f"Results stored in {out}")
+
+    worse = regressions(results, baseline, args.threshold)
+    for name in worse:
+        print(f"Regression: {name}")
+    if worse:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
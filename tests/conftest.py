@@ -0,0 +1,89 @@
+"""Shared fixtures for the tests."""
+
+import httpx
+import pytest
+import pytest_asyncio
+from openai import AsyncOpenAI
+from sqlmodel import SQLModel
+from app import database
+from app.cache import response_cache
+from app.conversations import conversation_store
+from app.main import app
+from app.tokens import count_tokens
+from app.upstream import circuit_breaker, latency_window
+from app.tracing import TraceSink
+from tests.fake_openai import FakeOpenAI, create_app
+
+
+@pytest.fixture(autouse=True)
+def clear_response_cache():
+    """Start every test with an empty response cache and conversation store."""
+    response_cache.clear()
+    conversation_store.clear()
+    yield
+    response_cache.clear()
+    conversation_store.clear()
+
+
+@pytest.fixture(autouse=True)
+def close_circuit():
+    """Start every test with a closed circuit and no latencies to hedge by."""
+    circuit_breaker.reset()
+    latency_window.clear()
+    yield
+    circuit_breaker.reset()
+    latency_window.clear()
+
+
+@pytest.fixture(autouse=True)
+def estimate_tokens(monkeypatch):
+    """Count tokens with the estimate, so tests don't download an encoding."""
+    monkeypatch.setattr("app.tokens.get_encoding", lambda: None)
+    count_tokens.cache_clear()
+    yield
+    count_tokens.cache_clear()
+
+
+@pytest.fixture(name="trace_sink", autouse=True)
+def fixture_trace_sink(monkeypatch, tmp_path):
+    """Write the traces of each test to a temporary file."""
+    sink = TraceSink(str(tmp_path / "traces.jsonl"))
+    monkeypatch.setattr("app.tracing.trace_sink", sink)
+    yield sink
+    sink.close()
+
+
+@pytest.fixture(name="sqlite_database")
+def fixture_sqlite_database(monkeypatch, tmp_path):
+    """Point the database at a temporary SQLite file."""
+    monkeypatch.setenv("DATABASE_URL", f"sqlite:///{tmp_path / 'app.db'}")
+    database.get_engine.cache_clear()
+    SQLModel.metadata.create_all(database.get_engine())
+    yield
+    database.get_engine.cache_clear()
+
+
+@pytest.fixture(name="fake_state")
+def fixture_fake_state():
+    """Return the state of the fake OpenAI server."""
+    return FakeOpenAI()
+
+
+@pytest_asyncio.fixture(name="fake_client")
+async def fixture_fake_client(fake_state):
+    """Return an OpenAI client that talks to the fake server."""
+    transport = httpx.ASGITransport(app=create_app(fake_state))
+    async with httpx.AsyncClient(transport=transport) as http_client:
+        yield AsyncOpenAI(
+            api_key="test", base_url="http://fake/v1", http_client=http_client
+        )
+
+
+@pytest_asyncio.fixture(name="app_client")
+async def fixture_app_client(monkeypatch, fake_client):
+    """Return a client for the app, with OpenAI replaced by the fake server."""
+    monkeypatch.setattr("app.routes.adstod.client", fake_client)
+    monkeypatch.setattr("app.utils.client", fake_client)
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://app") as client:
+        yield client
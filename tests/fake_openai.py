@@ -0,0 +1,483 @@
+"""A local stand-in for the OpenAI API, for tests that must not use the network.
+
+It implements chat completions, the assistant threads, runs and messages
+used by the adstod page, with or without streaming, and the files and batches
+endpoints used by the bulk mode. Chat requests are answered with a made-up
+instance of their response format schema. Latency and errors can be injected
+to see how the app behaves under load, and the token usage of every chat
+completion is listed at ``/fake/usage``. Mount it on an ``httpx.ASGITransport``,
+or run it with ``uvicorn tests.fake_openai:app`` and point ``OPENAI_BASE_URL``
+at it, in which case it is configured with the ``FAKE_OPENAI_*`` variables.
+"""
+
+import asyncio
+import json
+import os
+import random
+import time
+import uuid
+from fastapi import FastAPI, File, Form, HTTPException, UploadFile
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+
+FAKE_TEXT = "Texti frá gerviþjóni."
+FAKE_REPLY = (
+    "Samkvæmt reglunum skal sækja um fyrir 1. mars【4:0†reglur.pdf】. "
+    "Umsóknin fer svo til afgreiðslu hjá ráðuneytinu【4:1†leidbeiningar.pdf】."
+)
+STREAM_DELTAS = 8
+RUN_ACTIVE_STATES = {"queued", "in_progress"}
+
+
+def fake_instance(schema: dict):
+    """Make up a value that fits a JSON schema."""
+    if "enum" in schema:
+        return schema["enum"][0]
+    kind = schema.get("type", "object")
+    if kind == "object":
+        return {
+            key: fake_instance(value)
+            for key, value in schema.get("properties", {}).items()
+        }
+    if kind == "array":
+        return [fake_instance(schema.get("items", {}))]
+    return {"string": FAKE_TEXT, "number": 0, "integer": 0, "boolean": False}.get(kind)
+
+
+def fake_usage(prompt: str, completion: str) -> dict:
+    """Make up a token usage from the length of the texts."""
+    prompt_tokens, completion_tokens = len(prompt) // 4, len(completion) // 4
+    return {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "total_tokens": prompt_tokens + completion_tokens,
+    }
+
+
+def fake_completion(body: dict, invalid: bool = False) -> dict:
+    """Answer a chat completion request body.
+
+    A reply longer than max_tokens is cut off, as the API does. An
+    ``invalid`` reply is an empty object, whatever the schema.
+    """
+    schema = body["response_format"]["json_schema"]["schema"]
+    content = json.dumps({} if invalid else fake_instance(schema), ensure_ascii=False)
+    finish_reason = "stop"
+    if body.get("max_tokens") and len(content) // 4 > body["max_tokens"]:
+        content = content[: body["max_tokens"] * 4]
+        finish_reason = "length"
+    return {
+        "id": f"chatcmpl-{uuid.uuid4().hex}",
+        "object": "chat.completion",
+        "created": 0,
+        "model": body["model"],
+        "choices": [
+            {
+                "index": 0,
+                "finish_reason": finish_reason,
+                "message": {"role": "assistant", "content": content},
+            }
+        ],
+        "usage": fake_usage(json.dumps(body["messages"]), content),
+    }
+
+
+def format_event(event: str, data) -> str:
+    """Format a Server-Sent Event of an assistant stream."""
+    if not isinstance(data, str):
+        data = json.dumps(data, ensure_ascii=False)
+    return f"event: {event}\ndata: {data}\n\n"
+
+
+class FakeOpenAI:  # pylint: disable=too-many-instance-attributes
+    """State of the fake server.
+
+    ``latency`` is how long a chat completion takes and ``run_latency`` how
+    long an assistant run takes, in seconds. A share ``error_rate`` of chat
+    completions and run creations fail with ``error_status``.
+    ``model_latency`` overrides ``latency`` for some models, and a share
+    ``tail_rate`` of chat completions take ``tail_latency`` instead, like the
+    slow tail of a real provider. Models in ``invalid_models`` answer with
+    output that doesn't fit the schema.
+    ``polls_until_complete`` sets how many times a batch is reported as in
+    progress before it completes. Requests whose custom_id is in
+    ``failing_ids`` end up in the error file, and those in ``truncated_ids``
+    are cut off at a token limit.
+    """
+
+    def __init__(  # pylint: disable=too-many-arguments
+        self,
+        polls_until_complete: int = 1,
+        failing_ids=(),
+        latency=0.0,
+        *,
+        truncated_ids=(),
+        run_latency=0.0,
+        error_rate=0.0,
+        error_status=500,
+        seed=None,
+        model_latency=None,
+        tail_rate=0.0,
+        tail_latency=0.0,
+        invalid_models=(),
+    ):
+        self.latency = latency
+        self.model_latency = dict(model_latency or {})
+        self.tail_rate = tail_rate
+        self.tail_latency = tail_latency
+        self.invalid_models = set(invalid_models)
+        self.run_latency = run_latency
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.random = random.Random(seed)
+        self.chat_requests = []
+        self.usage = []
+        self.errors = 0
+        self.polls_until_complete = polls_until_complete
+        self.failing_ids = set(failing_ids)
+        self.truncated_ids = set(truncated_ids)
+        self.files = {}
+        self.batches = {}
+        self.polls = {}
+        self.threads = {}
+        self.runs = {}
+
+    @classmethod
+    def from_env(cls) -> "FakeOpenAI":
+        """Configure the fake server from FAKE_OPENAI_* environment variables."""
+        seed = os.getenv("FAKE_OPENAI_SEED")
+        return cls(
+            latency=float(os.getenv("FAKE_OPENAI_LATENCY", "0")),
+            run_latency=float(os.getenv("FAKE_OPENAI_RUN_LATENCY", "0")),
+            error_rate=float(os.getenv("FAKE_OPENAI_ERROR_RATE", "0")),
+            error_status=int(os.getenv("FAKE_OPENAI_ERROR_STATUS", "500")),
+            seed=int(seed) if seed else None,
+            model_latency=json.loads(os.getenv("FAKE_OPENAI_MODEL_LATENCY", "{}")),
+            tail_rate=float(os.getenv("FAKE_OPENAI_TAIL_RATE", "0")),
+            tail_latency=float(os.getenv("FAKE_OPENAI_TAIL_LATENCY", "0")),
+        )
+
+    def chat_latency(self, model: str) -> float:
+        """Return how long a chat completion with a model takes."""
+        if self.tail_rate and self.random.random() < self.tail_rate:
+            return self.tail_latency
+        return self.model_latency.get(model, self.latency)
+
+    def injected_error(self):
+        """Return an error response for a share ``error_rate`` of requests."""
+        if not self.error_rate or self.random.random() >= self.error_rate:
+            return None
+        self.errors += 1
+        return JSONResponse(
+            status_code=self.error_status,
+            content={"error": {"message": "Injected failure.", "type": "server_error"}},
+            headers={"retry-after-ms": "10"} if self.error_status == 429 else None,
+        )
+
+    def add_message(  # pylint: disable=too-many-arguments
+        self, thread_id: str, role: str, text: str, run_id=None, assistant_id=None
+    ) -> dict:
+        """Add a message to a thread and return it."""
+        message = {
+            "id": f"msg_{uuid.uuid4().hex}",
+            "object": "thread.message",
+            "created_at": int(time.time()),
+            "thread_id": thread_id,
+            "role": role,
+            "content": [{"type": "text", "text": {"value": text, "annotations": []}}],
+            "run_id": run_id,
+            "assistant_id": assistant_id,
+            "attachments": [],
+            "metadata": {},
+        }
+        self.threads[thread_id].append(message)
+        return message
+
+    def start_run(self, thread_id: str, body: dict) -> dict:
+        """Start a run on a thread, creating the thread if needed."""
+        if thread_id not in self.threads:
+            self.threads[thread_id] = []
+        for message in body.get("thread", {}).get("messages", []) + body.get(
+            "additional_messages", []
+        ):
+            self.add_message(thread_id, message["role"], message["content"])
+        run = {
+            "id": f"run_{uuid.uuid4().hex}",
+            "object": "thread.run",
+            "created_at": int(time.time()),
+            "thread_id": thread_id,
+            "assistant_id": body["assistant_id"],
+            "instructions": body.get("instructions") or "",
+            "model": "gpt-4o",
+            "status": "queued",
+            "tools": [],
+            "usage": None,
+        }
+        self.runs[run["id"]] = (run, time.monotonic() + self.run_latency)
+        return run
+
+    def finish_run(self, run: dict) -> dict:
+        """Write the reply of a run and mark it completed."""
+        prompt = self.threads[run["thread_id"]][-1]["content"][0]["text"]["value"]
+        self.add_message(
+            run["thread_id"], "assistant", FAKE_REPLY, run["id"], run["assistant_id"]
+        )
+        run["status"] = "completed"
+        run["usage"] = fake_usage(prompt, FAKE_REPLY)
+        return run
+
+    def retrieve_run(self, run_id: str) -> dict:
+        """Return a run, completing it once its latency has passed."""
+        run, completes_at = self.runs[run_id]
+        if run["status"] in RUN_ACTIVE_STATES:
+            if time.monotonic() >= completes_at:
+                self.finish_run(run)
+            else:
+                run["status"] = "in_progress"
+        return run
+
+    def cancel_run(self, run_id: str) -> dict:
+        """Cancel a run that has not finished."""
+        run, _ = self.runs[run_id]
+        if run["status"] in RUN_ACTIVE_STATES:
+            run["status"] = "cancelled"
+        return run
+
+    def has_active_run(self, thread_id: str) -> bool:
+        """Check if a thread has a run that has not finished."""
+        return any(
+            self.retrieve_run(run["id"])["status"] in RUN_ACTIVE_STATES
+            for run, _ in list(self.runs.values())
+            if run["thread_id"] == thread_id
+        )
+
+    async def stream_run(self, run: dict):
+        """Stream the events of a run, with the reply in a few deltas."""
+        yield format_event("thread.run.created", run)
+        message_id = f"msg_{uuid.uuid4().hex}"
+        size = -(-len(FAKE_REPLY) // STREAM_DELTAS)
+        for index in range(0, len(FAKE_REPLY), size):
+            await asyncio.sleep(self.run_latency / STREAM_DELTAS)
+            delta = {
+                "id": message_id,
+                "object": "thread.message.delta",
+                "delta": {
+                    "content": [
+                        {
+                            "index": 0,
+                            "type": "text",
+                            "text": {
+                                "value": FAKE_REPLY[index : index + size],
+                                "annotations": [],
+                            },
+                        }
+                    ]
+                },
+            }
+            yield format_event("thread.message.delta", delta)
+            if run["status"] == "cancelled":
+                yield format_event("thread.run.cancelled", run)
+                return
+        yield format_event("thread.run.completed", self.finish_run(run))
+        yield format_event("done", "[DONE]")
+
+    def add_file(self, content: bytes, purpose: str) -> dict:
+        """Store a file and return its metadata."""
+        file_id = f"file-{uuid.uuid4().hex}"
+        self.files[file_id] = content
+        return {
+            "id": file_id,
+            "object": "file",
+            "bytes": len(content),
+            "created_at": 0,
+            "filename": f"{file_id}.jsonl",
+            "purpose": purpose,
+        }
+
+    def run_batch(self, batch: dict):
+        """Answer every request in the batch input file."""
+        output, errors = [], []
+        for line in self.files[batch["input_file_id"]].decode("utf-8").splitlines():
+            if not line.strip():
+                continue
+            request = json.loads(line)
+            custom_id = request["custom_id"]
+            if custom_id in self.failing_ids:
+                errors.append(
+                    {
+                        "id": f"batch_req_{uuid.uuid4().hex}",
+                        "custom_id": custom_id,
+                        "response": {
+                            "status_code": 500,
+                            "body": {"error": {"message": "Fake failure."}},
+                        },
+                        "error": None,
+                    }
+                )
+            else:
+                if custom_id in self.truncated_ids:
+                    request["body"]["max_tokens"] = 1
+                output.append(
+                    {
+                        "id": f"batch_req_{uuid.uuid4().hex}",
+                        "custom_id": custom_id,
+                        "response": {
+                            "status_code": 200,
+                            "body": fake_completion(request["body"]),
+                        },
+                        "error": None,
+                    }
+                )
+        for key, lines in (("output_file_id", output), ("error_file_id", errors)):
+            if lines:
+                content = "".join(json.dumps(item) + "\n" for item in lines)
+                batch[key] = self.add_file(content.encode("utf-8"), "batch_output")["id"]
+        batch["status"] = "completed"
+        batch["request_counts"] = {
+            "total": len(output) + len(errors),
+            "completed": len(output),
+            "failed": len(errors),
+        }
+
+
+def create_app(state: FakeOpenAI = None) -> FastAPI:
+    """Create the fake API app around the given state."""
+    state = state or FakeOpenAI()
+    fake = FastAPI()
+    fake.state.openai = state
+
+    @fake.post("/v1/chat/completions")
+    async def chat_completions(body: dict):
+        state.chat_requests.append(body)
+        await asyncio.sleep(state.chat_latency(body["model"]))
+        error = state.injected_error()
+        if error:
+            return error
+        completion = fake_completion(body, body["model"] in state.invalid_models)
+        state.usage.append(
+            {
+                **completion["usage"],
+                "max_tokens": body.get("max_tokens"),
+                "model": body["model"],
+            }
+        )
+        return completion
+
+    @fake.get("/fake/usage")
+    async def usage(reset: bool = False):
+        """The usage, max_tokens and model of every chat completion so far."""
+        usage = state.usage
+        if reset:
+            state.usage = []
+        return usage
+
+    def run_response(thread_id: str, body: dict):
+        error = state.injected_error()
+        if error:
+            return error
+        run = state.start_run(thread_id, body)
+        if body.get("stream"):
+            return StreamingResponse(
+                state.stream_run(run), media_type="text/event-stream"
+            )
+        return run
+
+    @fake.post("/v1/threads/runs")
+    async def create_thread_and_run(body: dict):
+        return run_response(f"thread_{uuid.uuid4().hex}", body)
+
+    @fake.post("/v1/threads/{thread_id}/runs")
+    async def create_run(thread_id: str, body: dict):
+        if thread_id not in state.threads:
+            raise HTTPException(status_code=404, detail="No such thread.")
+        if state.has_active_run(thread_id):
+            return JSONResponse(
+                status_code=400,
+                content={
+                    "error": {
+                        "message": f"Thread {thread_id} already has an active run.",
+                        "type": "invalid_request_error",
+                    }
+                },
+            )
+        return run_response(thread_id, body)
+
+    @fake.get("/v1/threads/{thread_id}/runs/{run_id}")
+    async def retrieve_run(thread_id: str, run_id: str):
+        if run_id not in state.runs or thread_id not in state.threads:
+            raise HTTPException(status_code=404, detail="No such run.")
+        return state.retrieve_run(run_id)
+
+    @fake.post("/v1/threads/{thread_id}/runs/{run_id}/cancel")
+    async def cancel_run(thread_id: str, run_id: str):
+        if run_id not in state.runs or thread_id not in state.threads:
+            raise HTTPException(status_code=404, detail="No such run.")
+        return state.cancel_run(run_id)
+
+    @fake.get("/v1/threads/{thread_id}/messages")
+    async def list_messages(
+        thread_id: str, order: str = "desc", limit: int = 20, run_id: str = None
+    ):
+        if thread_id not in state.threads:
+            raise HTTPException(status_code=404, detail="No such thread.")
+        messages = [
+            message
+            for message in state.threads[thread_id]
+            if run_id is None or message["run_id"] == run_id
+        ]
+        if order == "desc":
+            messages = messages[::-1]
+        messages = messages[:limit]
+        return {
+            "object": "list",
+            "data": messages,
+            "first_id": messages[0]["id"] if messages else None,
+            "last_id": messages[-1]["id"] if messages else None,
+            "has_more": False,
+        }
+
+    @fake.post("/v1/files")
+    async def create_file(file: UploadFile = File(...), purpose: str = Form(...)):
+        return state.add_file(await file.read(), purpose)
+
+    @fake.get("/v1/files/{file_id}/content", response_class=PlainTextResponse)
+    async def file_content(file_id: str):
+        if file_id not in state.files:
+            raise HTTPException(status_code=404, detail="No such file.")
+        return state.files[file_id].decode("utf-8")
+
+    @fake.post("/v1/batches")
+    async def create_batch(body: dict):
+        if body.get("input_file_id") not in state.files:
+            raise HTTPException(status_code=400, detail="No such file.")
+        batch = {
+            "id": f"batch_{uuid.uuid4().hex}",
+            "object": "batch",
+            "endpoint": body["endpoint"],
+            "input_file_id": body["input_file_id"],
+            "completion_window": body["completion_window"],
+            "status": "validating",
+            "created_at": 0,
+            "output_file_id": None,
+            "error_file_id": None,
+        }
+        state.batches[batch["id"]] = batch
+        state.polls[batch["id"]] = 0
+        return batch
+
+    @fake.get("/v1/batches/{batch_id}")
+    async def retrieve_batch(batch_id: str):
+        if batch_id not in state.batches:
+            raise HTTPException(status_code=404, detail="No such batch.")
+        batch = state.batches[batch_id]
+        state.polls[batch_id] += 1
+        if batch["status"] in ("validating", "in_progress"):
+            if state.polls[batch_id] >= state.polls_until_complete:
+                state.run_batch(batch)
+            else:
+                batch["status"] = "in_progress"
+        return batch
+
+    return fake
+
+
+app = create_app(FakeOpenAI.from_env())
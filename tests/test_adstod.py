@@ -1,9 +1,16 @@
 """Test the adstod routes."""
 
+import asyncio
+import json
+import time
+from types import SimpleNamespace
+import httpx
 import pytest
+from openai import NotFoundError, RateLimitError
 from pydantic import BaseModel
 from fastapi.testclient import TestClient
 from app.main import app
+from app.routes import adstod
 
 client = TestClient(app)
 
@@ -17,6 +24,8 @@ class Thread(BaseModel):
 class Run(BaseModel):
     """A run object."""
 
+    id: str = "run_1"
+    thread_id: str = "3421"
     status: str
 
 
@@ -48,18 +57,26 @@ class Text(BaseModel):
 def mock_openai_assistant(mocker):
     """Mock the response from the OpenAI API."""
     mocker.patch(
-        "app.routes.adstod.client.beta.threads.create", return_value=Thread(id="3421")
+        "app.routes.adstod.client.beta.threads.create_and_run",
+        new_callable=mocker.AsyncMock,
+        return_value=Run(thread_id="3421", status="queued"),
     )
     mocker.patch(
-        "app.routes.adstod.client.beta.threads.messages.create",
-        return_value="Test Message",
+        "app.routes.adstod.client.beta.threads.runs.create",
+        new_callable=mocker.AsyncMock,
+        side_effect=lambda thread_id, **_: Run(thread_id=thread_id, status="queued"),
     )
     mocker.patch(
-        "app.routes.adstod.client.beta.threads.runs.create_and_poll",
-        return_value=Run(status="completed"),
+        "app.routes.adstod.client.beta.threads.runs.retrieve",
+        new_callable=mocker.AsyncMock,
+        side_effect=lambda run_id, thread_id: Run(
+            id=run_id, thread_id=thread_id, status="completed"
+        ),
     )
+    mocker.patch("app.routes.adstod.RUN_POLL_INITIAL_INTERVAL", 0.01)
     mocker.patch(
         "app.routes.adstod.client.beta.threads.messages.list",
+        new_callable=mocker.AsyncMock,
         return_value=Messages(
             data=[Message(content=[Text(text=Value(value="Test Content"))])]
         ),
@@ -84,7 +101,88 @@ def test_send_message_to_adstod_without_session_id():
     response = client.post("/adstod/start", json={"message": "Hello"})
     assert response.status_code == 200
     # There should be a thread id in the response
-    assert "thread_id" in response.json()
+    assert response.json()["thread_id"] == "3421"
+
+
+def test_only_the_newest_message_is_fetched(mocker):
+    """The reply should be read with a bounded, newest-first query."""
+    messages_list = mocker.patch(
+        "app.routes.adstod.client.beta.threads.messages.list",
+        new_callable=mocker.AsyncMock,
+        return_value=Messages(
+            data=[Message(content=[Text(text=Value(value="Test Content"))])]
+        ),
+    )
+    client.post("/adstod/start", json={"message": "Hello", "thread_id": "3421_test"})
+    messages_list.assert_awaited_once_with(
+        thread_id="3421_test", run_id="run_1", order="desc", limit=1
+    )
+
+
+def test_run_is_polled_with_backoff(mocker):
+    """A pending run should be polled with a growing interval."""
+    statuses = iter(["queued", "in_progress", "in_progress", "completed"])
+    mocker.patch(
+        "app.routes.adstod.client.beta.threads.runs.retrieve",
+        new_callable=mocker.AsyncMock,
+        side_effect=lambda run_id, thread_id: Run(
+            id=run_id, thread_id=thread_id, status=next(statuses)
+        ),
+    )
+    sleep = mocker.patch("app.routes.adstod.asyncio.sleep")
+    response = client.post("/adstod/start", json={"message": "Hello"})
+    assert response.status_code == 200
+    intervals = [call.args[0] for call in sleep.await_args_list]
+    assert len(intervals) == 4
+    assert intervals == sorted(intervals)
+    assert intervals[-1] <= adstod.RUN_POLL_MAX_INTERVAL
+
+
+def test_failed_run_returns_error(mocker):
+    """A run that does not complete should return an error."""
+    mocker.patch(
+        "app.routes.adstod.client.beta.threads.runs.retrieve",
+        new_callable=mocker.AsyncMock,
+        side_effect=lambda run_id, thread_id: Run(
+            id=run_id, thread_id=thread_id, status="failed"
+        ),
+    )
+    response = client.post("/adstod/start", json={"message": "Hello"})
+    assert response.status_code == 500
+    assert response.json() == {"error": "The assistant did not complete the request."}
+
+
+@pytest.mark.asyncio
+async def test_many_conversations_run_concurrently(mocker):
+    """Pending runs should wait on the event loop, not on threads."""
+    polls = {}
+
+    async def retrieve(run_id, thread_id):
+        polls[thread_id] = polls.get(thread_id, 0) + 1
+        status = "completed" if polls[thread_id] > 2 else "in_progress"
+        return Run(id=run_id, thread_id=thread_id, status=status)
+
+    mocker.patch(
+        "app.routes.adstod.client.beta.threads.runs.retrieve",
+        new_callable=mocker.AsyncMock,
+        side_effect=retrieve,
+    )
+    mocker.patch("app.routes.adstod.RUN_POLL_INITIAL_INTERVAL", 0.1)
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as c:
+        start = time.perf_counter()
+        responses = await asyncio.gather(
+            *(
+                c.post(
+                    "/adstod/start",
+                    json={"message": "Hello", "thread_id": f"thread_{i}"},
+                )
+                for i in range(500)
+            )
+        )
+        elapsed = time.perf_counter() - start
+    assert all(response.status_code == 200 for response in responses)
+    assert elapsed < 5
 
 
 def test_adstod_page():
@@ -92,3 +190,333 @@ def test_adstod_page():
     response = client.get("/adstod")
     assert response.status_code == 200
     assert "<title>Fróði</title>" in response.text
+
+
+class EventStream:
+    """A fake assistant event stream that records whether it was closed."""
+
+    def __init__(self, events):
+        self.events = events
+        self.closed = False
+
+    def __aiter__(self):
+        return self.events
+
+    async def close(self):
+        """Close the stream."""
+        self.closed = True
+
+
+def stream_events(*deltas, final="thread.run.completed"):
+    """Build a fake assistant event stream with the given text deltas."""
+
+    async def events():
+        yield SimpleNamespace(
+            event="thread.run.created", data=SimpleNamespace(thread_id="3421")
+        )
+        for text in deltas:
+            block = SimpleNamespace(type="text", text=SimpleNamespace(value=text))
+            yield SimpleNamespace(
+                event="thread.message.delta",
+                data=SimpleNamespace(delta=SimpleNamespace(content=[block])),
+            )
+        yield SimpleNamespace(event=final, data=None)
+
+    return EventStream(events())
+
+
+def parse_sse(body: str) -> list:
+    """Parse a Server-Sent Events body into (event, data) pairs."""
+    parsed = []
+    for block in body.strip().split("\n\n"):
+        lines = dict(line.split(": ", 1) for line in block.split("\n"))
+        parsed.append((lines["event"], json.loads(lines["data"])))
+    return parsed
+
+
+def test_stream_relays_deltas(mocker):
+    """The stream endpoint should relay each delta as an event."""
+    mocker.patch(
+        "app.routes.adstod.client.beta.threads.create_and_run",
+        new_callable=mocker.AsyncMock,
+        return_value=stream_events("Halló ", "heimur【4:0†sk", "jal.pdf】"),
+    )
+    response = client.post("/adstod/stream", json={"message": "Hello"})
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/event-stream")
+    assert parse_sse(response.text) == [
+        ("thread", {"thread_id": "3421"}),
+        ("delta", {"text": "Halló "}),
+        ("delta", {"text": "heimur"}),
+        ("delta", {"text": "【1】"}),
+        ("delta", {"text": "\n\nSources:\n1: skjal.pdf"}),
+        ("done", {}),
+    ]
+
+
+def test_stream_continues_existing_thread(mocker):
+    """The stream endpoint should add the message to the given thread."""
+    create = mocker.patch(
+        "app.routes.adstod.client.beta.threads.runs.create",
+        new_callable=mocker.AsyncMock,
+        return_value=stream_events("Svar"),
+    )
+    response = client.post(
+        "/adstod/stream", json={"message": "Hello", "thread_id": "3421"}
+    )
+    assert parse_sse(response.text)[-2:] == [("delta", {"text": "Svar"}), ("done", {})]
+    assert create.await_args.kwargs["stream"] is True
+    assert create.await_args.kwargs["thread_id"] == "3421"
+
+
+def test_stream_reports_failed_run(mocker):
+    """A failed run should end the stream with an error event."""
+    events = stream_events("Hál", final="thread.run.failed")
+    mocker.patch(
+        "app.routes.adstod.client.beta.threads.create_and_run",
+        new_callable=mocker.AsyncMock,
+        return_value=events,
+    )
+    response = client.post("/adstod/stream", json={"message": "Hello"})
+    assert parse_sse(response.text)[-1] == (
+        "error",
+        {"error": "The assistant did not complete the request."},
+    )
+    assert events.closed
+
+
+def test_stream_is_closed_when_the_run_completes(mocker):
+    """The upstream stream should be closed once the reply has been relayed."""
+    events = stream_events("Svar")
+    mocker.patch(
+        "app.routes.adstod.client.beta.threads.create_and_run",
+        new_callable=mocker.AsyncMock,
+        return_value=events,
+    )
+    response = client.post("/adstod/stream", json={"message": "Hello"})
+    assert parse_sse(response.text)[-1] == ("done", {})
+    assert events.closed
+
+
+def test_stream_cancels_the_run_at_the_deadline(monkeypatch, mocker):
+    """A run that doesn't stream its next event in time should be cancelled."""
+
+    async def events():
+        yield SimpleNamespace(
+            event="thread.run.created", data=SimpleNamespace(id="run_1", thread_id="3421")
+        )
+        await asyncio.sleep(5)
+        yield SimpleNamespace(event="thread.run.completed", data=None)
+
+    monkeypatch.setattr("app.routes.adstod.DEADLINE_ADSTOD", 0.1)
+    mocker.patch(
+        "app.routes.adstod.client.beta.threads.create_and_run",
+        new_callable=mocker.AsyncMock,
+        return_value=EventStream(events()),
+    )
+    cancel = mocker.patch(
+        "app.routes.adstod.client.beta.threads.runs.cancel",
+        new_callable=mocker.AsyncMock,
+    )
+    response = client.post("/adstod/stream", json={"message": "Hello"})
+    assert parse_sse(response.text)[-1] == (
+        "error",
+        {"error": "The language model did not answer in time."},
+    )
+    cancel.assert_awaited_once_with(run_id="run_1", thread_id="3421")
+
+
+@pytest.mark.asyncio
+async def test_stream_cancels_the_run_when_the_client_goes_away(mocker):
+    """A client that disconnects mid-stream should still get its run cancelled."""
+
+    class SlowClosingStream(EventStream):  # pylint: disable=too-few-public-methods
+        """A stream whose close waits for the network, like the real one."""
+
+        async def close(self):
+            await asyncio.sleep(0.01)
+            self.closed = True
+
+    async def events():
+        yield SimpleNamespace(
+            event="thread.run.created", data=SimpleNamespace(id="run_1", thread_id="3421")
+        )
+        await asyncio.sleep(5)
+        yield SimpleNamespace(event="thread.run.completed", data=None)
+
+    stream = SlowClosingStream(events())
+    mocker.patch(
+        "app.routes.adstod.client.beta.threads.create_and_run",
+        new_callable=mocker.AsyncMock,
+        return_value=stream,
+    )
+    cancel = mocker.patch(
+        "app.routes.adstod.client.beta.threads.runs.cancel",
+        new_callable=mocker.AsyncMock,
+    )
+    first_event = asyncio.Event()
+    body = json.dumps({"message": "Hello"}).encode()
+    messages = [{"type": "http.request", "body": body, "more_body": False}]
+
+    async def receive():
+        if messages:
+            return messages.pop(0)
+        await first_event.wait()
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        if message["type"] == "http.response.body" and message.get("body"):
+            first_event.set()
+
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": "POST",
+        "scheme": "http",
+        "path": "/adstod/stream",
+        "raw_path": b"/adstod/stream",
+        "query_string": b"",
+        "root_path": "",
+        "headers": [(b"content-type", b"application/json")],
+        "client": ("test", 1),
+        "server": ("test", 80),
+    }
+    await asyncio.wait_for(app(scope, receive, send), timeout=2)
+    assert stream.closed
+    cancel.assert_awaited_once_with(run_id="run_1", thread_id="3421")
+
+
+def test_stream_reports_upstream_error(mocker):
+    """An upstream exception should end the stream with an error event."""
+    mocker.patch(
+        "app.routes.adstod.client.beta.threads.create_and_run",
+        new_callable=mocker.AsyncMock,
+        side_effect=Exception("Test exception"),
+    )
+    response = client.post("/adstod/stream", json={"message": "Hello"})
+    assert parse_sse(response.text) == [
+        ("error", {"error": "The assistant did not complete the request."})
+    ]
+
+
+def test_stream_turn_is_restored_without_listing_the_thread(mocker):
+    """A reload should get the conversation from the store."""
+    mocker.patch(
+        "app.routes.adstod.client.beta.threads.create_and_run",
+        new_callable=mocker.AsyncMock,
+        return_value=stream_events("Halló【4:0†skjal.pdf】"),
+    )
+    client.post("/adstod/stream", json={"message": "Hæ"})
+    client.post("/adstod/start", json={"message": "Meira", "thread_id": "3421"})
+    messages_list = mocker.patch(
+        "app.routes.adstod.client.beta.threads.messages.list",
+        new_callable=mocker.AsyncMock,
+    )
+    response = client.get("/adstod/threads/3421")
+    assert response.status_code == 200
+    assert response.json() == {
+        "thread_id": "3421",
+        "messages": [
+            {"role": "user", "text": "Hæ"},
+            {"role": "assistant", "text": "Halló【1】\n\nSources:\n1: skjal.pdf"},
+            {"role": "user", "text": "Meira"},
+            {"role": "assistant", "text": "Test Content"},
+        ],
+    }
+    messages_list.assert_not_awaited()
+
+
+def thread_message(role, text, assistant_id=adstod.ASSISTANT_ID):
+    """Return a listed thread message, answered by the given assistant."""
+    block = SimpleNamespace(type="text", text=SimpleNamespace(value=text))
+    return SimpleNamespace(
+        role=role,
+        content=[block],
+        assistant_id=assistant_id if role == "assistant" else None,
+    )
+
+
+def test_unknown_thread_is_listed_once(mocker):
+    """A thread missing from the store should be listed from OpenAI once."""
+    messages_list = mocker.patch(
+        "app.routes.adstod.client.beta.threads.messages.list",
+        new_callable=mocker.AsyncMock,
+        return_value=SimpleNamespace(
+            data=[
+                thread_message("assistant", "Svar【1:0†a.pdf】"),
+                thread_message("user", "Spurning"),
+            ]
+        ),
+    )
+    first = client.get("/adstod/threads/thread_old")
+    second = client.get("/adstod/threads/thread_old")
+    assert first.json() == second.json()
+    assert first.json()["messages"] == [
+        {"role": "user", "text": "Spurning"},
+        {"role": "assistant", "text": "Svar【1】\n\nSources:\n1: a.pdf"},
+    ]
+    messages_list.assert_awaited_once_with(
+        thread_id="thread_old", order="desc", limit=adstod.conversation_store.max_messages
+    )
+
+
+def test_turn_on_a_thread_not_stored_lists_the_thread(mocker):
+    """A reload after a turn on a thread missing from the store should list it."""
+    client.post("/adstod/start", json={"message": "Meira", "thread_id": "thread_old"})
+    messages_list = mocker.patch(
+        "app.routes.adstod.client.beta.threads.messages.list",
+        new_callable=mocker.AsyncMock,
+        return_value=SimpleNamespace(data=[]),
+    )
+    client.get("/adstod/threads/thread_old")
+    messages_list.assert_awaited_once()
+
+
+@pytest.mark.parametrize(
+    "messages",
+    [
+        [thread_message("assistant", "Svar", "asst_other"), thread_message("user", "Hæ")],
+        [thread_message("user", "Hæ")],
+    ],
+)
+def test_thread_of_another_assistant_is_not_shown(mocker, messages):
+    """Only threads this assistant has answered in should be listed."""
+    mocker.patch(
+        "app.routes.adstod.client.beta.threads.messages.list",
+        new_callable=mocker.AsyncMock,
+        return_value=SimpleNamespace(data=messages),
+    )
+    response = client.get("/adstod/threads/thread_other")
+    assert response.status_code == 404
+    assert response.json() == {"error": "The conversation was not found."}
+
+
+def test_missing_thread_returns_not_found(mocker):
+    """A thread that OpenAI does not know should return a 404."""
+    request = httpx.Request("GET", "https://api.openai.com/v1/threads/x/messages")
+    mocker.patch(
+        "app.routes.adstod.client.beta.threads.messages.list",
+        new_callable=mocker.AsyncMock,
+        side_effect=NotFoundError(
+            "Not found", response=httpx.Response(404, request=request), body=None
+        ),
+    )
+    response = client.get("/adstod/threads/missing")
+    assert response.status_code == 404
+    assert response.json() == {"error": "The conversation was not found."}
+
+
+def test_rate_limited_run_returns_service_busy(mocker):
+    """A run that stays rate limited should get a 503 with Retry-After."""
+    request = httpx.Request("POST", "https://api.openai.com/v1/threads/runs")
+    mocker.patch(
+        "app.routes.adstod.client.beta.threads.create_and_run",
+        new_callable=mocker.AsyncMock,
+        side_effect=RateLimitError(
+            "Rate limited", response=httpx.Response(429, request=request), body=None
+        ),
+    )
+    response = client.post("/adstod/start", json={"message": "Hello"})
+    assert response.status_code == 503
+    assert response.headers["retry-after"] == "30"
@@ -0,0 +1,198 @@
+"""Test the batch upload routes."""
+
+import asyncio
+import io
+import json
+import os
+import time
+import zipfile
+import pytest
+from fastapi.testclient import TestClient
+from app.batch import run_bounded
+from app.main import app
+from app.utils import DOCX_CONTENT_TYPE
+
+client = TestClient(app)
+
+BEARER_TOKEN = os.getenv("BEARER_TOKEN")
+
+with open("tests/test_document.docx", "rb") as document_file:
+    DOCUMENT = document_file.read()
+with open("tests/test_document_short.docx", "rb") as document_file:
+    SHORT_DOCUMENT = document_file.read()
+
+
+def post_batch(url: str, files: list, data: dict = None):
+    """Post a batch of files to the given route."""
+    return client.post(
+        url,
+        files=[("files", file) for file in files],
+        data=data or {},
+        headers={"Authorization": f"Bearer {BEARER_TOKEN}"},
+    )
+
+
+def make_zip(entries: dict) -> bytes:
+    """Build a zip archive in memory."""
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w") as archive:
+        for name, content in entries.items():
+            archive.writestr(name, content)
+    return buffer.getvalue()
+
+
+@pytest.fixture(name="send_text")
+def fixture_send_text(mocker):
+    """Mock the OpenAI call in both routes."""
+    response = {
+        "titill": "Titill",
+        "kaflar": [{"chapter_title": "Kafli", "content": "Efni"}],
+        "malfar": "Gott",
+    }
+    mocker.patch("app.routes.minnisblad.send_text_to_openai", return_value=response)
+    return mocker.patch(
+        "app.routes.minnisblad_adstod.send_text_to_openai", return_value=response
+    )
+
+
+def test_adstod_batch_returns_result_per_file(send_text):
+    """Each file should map to its result or its error."""
+    response = post_batch(
+        "/minnisblad-adstod/batch/",
+        [
+            ("a.docx", DOCUMENT, DOCX_CONTENT_TYPE),
+            ("a.docx", DOCUMENT, DOCX_CONTENT_TYPE),
+            ("stutt.docx", SHORT_DOCUMENT, DOCX_CONTENT_TYPE),
+        ],
+    )
+    assert response.status_code == 200
+    assert response.json() == {
+        "a.docx": {"result": send_text.return_value},
+        "a (2).docx": {"result": send_text.return_value},
+        "stutt.docx": {
+            "error": "The document must contain between 10 and 50000 words."
+        },
+    }
+
+
+def test_adstod_batch_accepts_zip(send_text):
+    """Documents inside a zip archive should be processed."""
+    archive = make_zip(
+        {"mappa/b.docx": DOCUMENT, "c.docx": DOCUMENT, "lesa.txt": "ekki skjal"}
+    )
+    response = post_batch(
+        "/minnisblad-adstod/batch/", [("skjol.zip", archive, "application/zip")]
+    )
+    assert response.status_code == 200
+    assert sorted(response.json()) == ["b.docx", "c.docx"]
+    assert send_text.call_count == 2
+
+
+def test_adstod_batch_reports_unexpected_errors(send_text):
+    """An upstream failure should only fail its own document."""
+    send_text.side_effect = [Exception("Test exception"), {"malfar": "Gott"}]
+    response = post_batch(
+        "/minnisblad-adstod/batch/",
+        [
+            ("a.docx", DOCUMENT, DOCX_CONTENT_TYPE),
+            ("b.docx", DOCUMENT, DOCX_CONTENT_TYPE),
+        ],
+    )
+    assert sorted(response.json().values(), key=str) == [
+        {"error": "An unexpected error occurred"},
+        {"result": {"malfar": "Gott"}},
+    ]
+
+
+def test_batch_rejects_too_many_files(mocker):
+    """A batch over the file limit should be rejected."""
+    mocker.patch("app.batch.BATCH_MAX_FILES", 1)
+    response = post_batch(
+        "/minnisblad-adstod/batch/",
+        [
+            ("a.docx", DOCUMENT, DOCX_CONTENT_TYPE),
+            ("b.docx", DOCUMENT, DOCX_CONTENT_TYPE),
+        ],
+    )
+    assert response.status_code == 400
+
+
+def test_batch_rejects_invalid_zip():
+    """A corrupt zip archive should be rejected."""
+    response = post_batch(
+        "/minnisblad-adstod/batch/", [("skjol.zip", b"not a zip", "application/zip")]
+    )
+    assert response.status_code == 400
+    assert response.json() == {"detail": "skjol.zip is not a valid zip file."}
+
+
+def test_batch_rejects_zip_bomb():
+    """A zip entry that inflates far beyond its compressed size should be rejected."""
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED) as archive:
+        archive.writestr("sprengja.docx", bytes(10 * 1024 * 1024))
+    response = post_batch(
+        "/minnisblad-adstod/batch/",
+        [("skjol.zip", buffer.getvalue(), "application/zip")],
+    )
+    assert response.status_code == 413
+    assert response.json() == {"detail": "skjol.zip is too large to unpack."}
+
+
+def test_batch_rejects_zip_over_the_size_limits(monkeypatch):
+    """Documents over the size limits should be rejected before they are read."""
+    with open("tests/test_document.docx", "rb") as file:
+        document = file.read()
+    archive = make_zip({"a.docx": document, "b.docx": document})
+    monkeypatch.setattr("app.batch.BATCH_MAX_UNPACKED_BYTES", len(document) + 1)
+    response = post_batch(
+        "/minnisblad-adstod/batch/", [("skjol.zip", archive, "application/zip")]
+    )
+    assert response.status_code == 413
+    monkeypatch.setattr("app.batch.BATCH_MAX_DOCUMENT_BYTES", len(document) - 1)
+    archive = make_zip({"a.docx": document})
+    response = post_batch(
+        "/minnisblad-adstod/batch/", [("skjol.zip", archive, "application/zip")]
+    )
+    assert response.status_code == 413
+
+
+def test_minnisblad_batch_returns_zip_of_memos(send_text):  # pylint: disable=unused-argument
+    """The memo batch should return a zip with a memo per document."""
+    response = post_batch(
+        "/minnisblad/batch/",
+        [
+            ("a.docx", DOCUMENT, DOCX_CONTENT_TYPE),
+            ("stutt.docx", SHORT_DOCUMENT, DOCX_CONTENT_TYPE),
+        ],
+        data={"chapters": '["inngangur"]'},
+    )
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/zip"
+    with zipfile.ZipFile(io.BytesIO(response.content)) as archive:
+        assert sorted(archive.namelist()) == ["Frodi_minnisblad_a.docx", "errors.json"]
+        assert json.loads(archive.read("errors.json")) == {
+            "stutt.docx": "The document must contain between 10 and 50000 words."
+        }
+
+
+@pytest.mark.asyncio
+async def test_run_bounded_respects_limit():
+    """No more than the limit should run at once and throughput should scale."""
+    running = 0
+    peak = 0
+
+    async def work(item):
+        nonlocal running, peak
+        running += 1
+        peak = max(peak, running)
+        await asyncio.sleep(0.1)
+        running -= 1
+        return item * 2
+
+    start = time.perf_counter()
+    results = await run_bounded(list(range(8)), work, limit=4)
+    elapsed = time.perf_counter() - start
+    assert results == [item * 2 for item in range(8)]
+    assert peak == 4
+    assert 0.2 <= elapsed < 0.4
@@ -0,0 +1,222 @@
+"""Test the offline bulk mode against the fake OpenAI server."""
+
+import json
+import sys
+import pytest
+from docx import Document
+from app import bulk
+from app.routes.minnisblad import create_response_format
+from app.routes.minnisblad_adstod import create_minnisblad_adstod_response_format
+from tests.fake_openai import FAKE_TEXT, FakeOpenAI
+
+
+@pytest.fixture(name="fake_state")
+def fixture_fake_state(monkeypatch):
+    """Return the state of the fake server, without waiting between polls."""
+    monkeypatch.setattr(bulk, "BATCH_POLL_INITIAL_INTERVAL", 0)
+    return FakeOpenAI(polls_until_complete=3)
+
+
+@pytest.fixture(name="documents")
+def fixture_documents(tmp_path):
+    """Write two valid documents and one that is too short."""
+    with open("tests/test_document.docx", "rb") as file:
+        document = file.read()
+    with open("tests/test_document_short.docx", "rb") as file:
+        short_document = file.read()
+    paths = []
+    for name, content in [
+        ("a.docx", document),
+        ("b.docx", document),
+        ("stutt.docx", short_document),
+    ]:
+        (tmp_path / name).write_bytes(content)
+        paths.append(str(tmp_path / name))
+    return paths
+
+
+def test_build_batch_file_has_one_request_per_document():
+    """Each document should become one chat completion request."""
+    response_format = create_minnisblad_adstod_response_format()
+    data = bulk.build_batch_file({"a.docx": "Texti a", "b.docx": "Texti b"}, response_format)
+    lines = [json.loads(line) for line in data.decode("utf-8").splitlines()]
+    assert [line["custom_id"] for line in lines] == ["a.docx", "b.docx"]
+    assert lines[0]["url"] == "/v1/chat/completions"
+    assert lines[0]["body"]["messages"][1]["content"][0]["text"] == "Texti a"
+    assert lines[0]["body"]["response_format"] == json.loads(json.dumps(response_format))
+
+
+def test_parse_batch_output_maps_errors():
+    """Failed requests should map to their error message."""
+    data = "\n".join(
+        [
+            json.dumps({"custom_id": "a", "response": None, "error": {"message": "Villa"}}),
+            json.dumps(
+                {
+                    "custom_id": "b",
+                    "response": {"status_code": 429, "body": {"error": {}}},
+                    "error": None,
+                }
+            ),
+        ]
+    )
+    assert bulk.parse_batch_output(data) == {
+        "a": {"error": "Villa"},
+        "b": {"error": "The request failed."},
+    }
+
+
+@pytest.mark.asyncio
+async def test_run_bulk_maps_results_to_documents(fake_client, fake_state, documents):
+    """Every document should get a result from the batch or its own error."""
+    response_format = create_minnisblad_adstod_response_format()
+    results = await bulk.run_bulk(documents, response_format, client=fake_client)
+    assert results["a.docx"] == results["b.docx"]
+    assert results["a.docx"]["result"]["properties"]["malfar"] == FAKE_TEXT
+    assert results["stutt.docx"] == {
+        "error": "The document must contain between 10 and 50000 words."
+    }
+    assert len(fake_state.batches) == 1
+    assert list(fake_state.polls.values()) == [3]
+
+
+@pytest.mark.asyncio
+async def test_run_bulk_reports_failed_requests(fake_client, fake_state, documents):
+    """A request that fails in the batch should only fail its own document."""
+    fake_state.failing_ids = {"b.docx"}
+    response_format = create_minnisblad_adstod_response_format()
+    results = await bulk.run_bulk(documents[:2], response_format, client=fake_client)
+    assert "result" in results["a.docx"]
+    assert results["b.docx"] == {"error": "Fake failure."}
+
+
+def test_parse_batch_output_reports_invalid_replies():
+    """A cut off or invalid reply should only fail its own request."""
+
+    def record(custom_id, content, finish_reason="stop"):
+        choice = {"finish_reason": finish_reason, "message": {"content": content}}
+        return json.dumps(
+            {
+                "custom_id": custom_id,
+                "response": {"status_code": 200, "body": {"choices": [choice]}},
+                "error": None,
+            }
+        )
+
+    data = "\n".join(
+        [
+            record("a", '{"svar": "Já"}'),
+            record("b", '{"svar": "N', finish_reason="length"),
+            record("c", '{"svar": "N'),
+        ]
+    )
+    assert bulk.parse_batch_output(data) == {
+        "a": {"result": {"svar": "Já"}},
+        "b": {"error": "The response was cut off at the output token limit."},
+        "c": {"error": "The response is not valid JSON."},
+    }
+
+
+@pytest.mark.asyncio
+async def test_run_bulk_reports_truncated_responses(fake_client, fake_state, documents):
+    """A reply cut off in the batch should only fail its own document."""
+    fake_state.truncated_ids = {"b.docx"}
+    response_format = create_minnisblad_adstod_response_format()
+    results = await bulk.run_bulk(documents[:2], response_format, client=fake_client)
+    assert "result" in results["a.docx"]
+    assert results["b.docx"] == {
+        "error": "The response was cut off at the output token limit."
+    }
+
+
+@pytest.mark.asyncio
+async def test_wait_for_batch_raises_when_batch_fails(fake_client, fake_state):
+    """A batch that ends in any other state than completed should raise."""
+    batch = await bulk.submit_batch(b"", client=fake_client)
+    fake_state.batches[batch.id]["status"] = "expired"
+    with pytest.raises(bulk.BatchError):
+        await bulk.wait_for_batch(batch, client=fake_client)
+
+
+@pytest.mark.asyncio
+async def test_run_bulk_skips_batch_without_valid_documents(fake_client, fake_state, tmp_path):
+    """Nothing should be submitted when every document is rejected."""
+    (tmp_path / "bilad.docx").write_bytes(b"ekki skjal")
+    results = await bulk.run_bulk(
+        [str(tmp_path / "bilad.docx"), str(tmp_path / "vantar.docx")],
+        create_minnisblad_adstod_response_format(),
+        client=fake_client,
+    )
+    assert sorted(results) == ["bilad.docx", "vantar.docx"]
+    assert not fake_state.batches
+
+
+def test_main_writes_memos(mocker, monkeypatch, tmp_path, documents):
+    """The command line should write a memo per document and the errors."""
+    run_bulk = mocker.patch(
+        "app.bulk.run_bulk",
+        new_callable=mocker.AsyncMock,
+        return_value={
+            "a.docx": {"result": {"titill": "Titill", "inngangur": "Inngangur"}},
+            "stutt.docx": {"error": "Of stutt"},
+        },
+    )
+    out = tmp_path / "out"
+    monkeypatch.setattr(
+        sys,
+        "argv",
+        ["bulk", "--kind", "minnisblad", "--chapters", "inngangur", "--out", str(out)]
+        + documents,
+    )
+    bulk.main()
+    assert run_bulk.call_args.args[1] == create_response_format(["inngangur"])
+    document = Document(str(out / "Frodi_minnisblad_a.docx"))
+    assert "Inngangur" in [paragraph.text for paragraph in document.paragraphs]
+    assert json.loads((out / "errors.json").read_text()) == {
+        "stutt.docx": {"error": "Of stutt"}
+    }
+
+
+def test_documents_with_the_same_name_are_numbered(tmp_path):
+    """Files with the same name in different folders should not share a name."""
+    with open("tests/test_document.docx", "rb") as file:
+        document = file.read()
+    paths = []
+    for folder in ("fyrri", "seinni"):
+        (tmp_path / folder).mkdir()
+        (tmp_path / folder / "a.docx").write_bytes(document)
+        paths.append(str(tmp_path / folder / "a.docx"))
+    texts, errors = bulk.read_documents(paths)
+    assert list(texts) == ["a.docx", "a (2).docx"]
+    assert not errors
+
+
+def test_main_writes_reviews(mocker, monkeypatch, tmp_path, documents):
+    """The command line should write the reviews to a JSON file."""
+    results = {"a.docx": {"result": {"malfar": "Gott"}}}
+    mocker.patch("app.bulk.run_bulk", new_callable=mocker.AsyncMock, return_value=results)
+    out = tmp_path / "results.json"
+    monkeypatch.setattr(sys, "argv", ["bulk", "--out", str(out)] + documents)
+    bulk.main()
+    assert json.loads(out.read_text()) == results
+
+
+@pytest.mark.asyncio
+async def test_run_bulk_merges_chunks_of_long_documents(
+    mocker, fake_client, fake_state, documents
+):
+    """A long document should be sent as several requests and merged."""
+    mocker.patch("app.chunking.CHUNK_TOKENS", 10)
+    response_format = create_minnisblad_adstod_response_format()
+    results = await bulk.run_bulk(documents[:1], response_format, client=fake_client)
+    (batch,) = fake_state.batches.values()
+    assert batch["request_counts"]["total"] > 1
+    assert results["a.docx"]["result"]["properties"]["malfar"] == FAKE_TEXT
+
+
+def test_merge_document_results_reports_missing_chunks():
+    """A document with a chunk missing from the output should fail."""
+    results = bulk.merge_document_results(
+        {"a.docx#1": {"result": {"malfar": "Gott"}}}, {"a.docx": ["a.docx#1", "a.docx#2"]}
+    )
+    assert results == {"a.docx": {"error": "The batch has no result for it."}}
@@ -0,0 +1,147 @@
+"""Test the response cache."""
+
+import os
+import pytest
+from fastapi.testclient import TestClient
+from app.cache import LRUCache, ResponseCache, make_cache_key, response_cache
+from app.database import get_session
+from app.main import app
+from app.models import CachedResponse
+from app.utils import send_text_to_openai
+from tests.utils import upload_file_with_mocked_openai
+
+client = TestClient(app)
+
+BEARER_TOKEN = os.getenv("BEARER_TOKEN")
+
+
+@pytest.fixture(name="completion_create")
+def fixture_completion_create(mocker):
+    """Mock the chat completion call of the OpenAI client."""
+    completion = mocker.Mock()
+    completion.choices = [mocker.Mock()]
+    completion.usage = None
+    completion.choices[0].message.content = '{"malfar": "Test"}'
+    return mocker.patch(
+        "app.utils.client.chat.completions.create",
+        new_callable=mocker.AsyncMock,
+        return_value=completion,
+    )
+
+
+def test_cache_key_depends_on_every_part():
+    """The key should change when any part of the request changes."""
+    key = make_cache_key("text", {"type": "json"}, "gpt-4o", {"temperature": 1})
+    assert key == make_cache_key("text", {"type": "json"}, "gpt-4o", {"temperature": 1})
+    assert key != make_cache_key("text!", {"type": "json"}, "gpt-4o", {"temperature": 1})
+    assert key != make_cache_key("text", {"type": "json"}, "gpt-4o-mini", {"temperature": 1})
+    assert key != make_cache_key("text", {"type": "json"}, "gpt-4o", {"temperature": 0})
+
+
+def test_lru_cache_evicts_least_recently_used():
+    """The cache should evict the least recently used entry when full."""
+    cache = LRUCache(max_size=2, ttl=60)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1
+    cache.set("c", 3)
+    assert cache.get("b") is None
+    assert cache.get("a") == 1
+    assert cache.stats()["evictions"] == 1
+
+
+def test_lru_cache_expires_entries(mocker):
+    """Entries should expire after the TTL."""
+    monotonic = mocker.patch("app.cache.time.monotonic", return_value=100.0)
+    cache = LRUCache(max_size=2, ttl=10)
+    cache.set("a", 1)
+    monotonic.return_value = 111.0
+    assert cache.get("a") is None
+    assert cache.stats()["expirations"] == 1
+    assert len(cache) == 0
+
+
+@pytest.mark.asyncio
+async def test_identical_request_is_served_from_cache(completion_create):
+    """The second identical request should not call the API."""
+    first = await send_text_to_openai("Sami textinn.", {"type": "json_object"})
+    second = await send_text_to_openai("Sami textinn.", {"type": "json_object"})
+    assert first == second == {"malfar": "Test"}
+    assert completion_create.await_count == 1
+    await send_text_to_openai("Annar texti.", {"type": "json_object"})
+    assert completion_create.await_count == 2
+
+
+@pytest.mark.asyncio
+async def test_cached_response_is_a_copy(completion_create):
+    """Changing a returned response should not change the cached one."""
+    first = await send_text_to_openai("Sami textinn.", {"type": "json_object"})
+    first["malfar"] = "Changed"
+    second = await send_text_to_openai("Sami textinn.", {"type": "json_object"})
+    assert second == {"malfar": "Test"}
+    assert completion_create.await_count == 1
+
+
+@pytest.mark.asyncio
+@pytest.mark.usefixtures("sqlite_database")
+async def test_persistent_tier_survives_memory_eviction():
+    """A response evicted from memory should be loaded from the database."""
+    cache = ResponseCache(max_size=1, ttl=60, persist=True)
+    await cache.set("a", '{"value": 1}')
+    await cache.set("b", '{"value": 2}')
+    assert await cache.get("a") == {"value": 1}
+    assert await cache.get("missing") is None
+    stats = cache.stats()["persistent"]
+    assert stats == {
+        "enabled": True,
+        "hits": 1,
+        "misses": 1,
+        "writes": 2,
+        "expired": 0,
+    }
+
+
+@pytest.mark.asyncio
+@pytest.mark.usefixtures("sqlite_database")
+async def test_persistent_tier_expires_entries():
+    """Expired responses in the database should be treated as misses."""
+    await ResponseCache(max_size=1, ttl=60, persist=True).set("a", '{"value": 1}')
+    assert await ResponseCache(max_size=1, ttl=-1, persist=True).get("a") is None
+    assert await ResponseCache(max_size=1, ttl=60, persist=True).get("a") is None
+
+
+@pytest.mark.asyncio
+@pytest.mark.usefixtures("sqlite_database")
+async def test_expired_rows_are_swept_on_write(monkeypatch):
+    """Expired rows should be deleted on a write, at most once per interval."""
+    monkeypatch.setattr("app.cache.CACHE_SWEEP_INTERVAL", 3600)
+    old = ResponseCache(max_size=10, ttl=60, persist=True)
+    await old.set("a", '{"value": 1}')
+    cache = ResponseCache(max_size=10, ttl=-1, persist=True)
+    await cache.set("b", '{"value": 2}')
+    await cache.set("c", '{"value": 3}')
+    assert cache.stats()["persistent"]["expired"] == 2
+    with get_session() as session:
+        assert session.get(CachedResponse, "a") is None
+        assert session.get(CachedResponse, "b") is None
+        # The second write comes before the next sweep is due.
+        assert session.get(CachedResponse, "c") is not None
+
+
+def test_cache_stats_endpoint(completion_create):  # pylint: disable=unused-argument
+    """The stats endpoint should report hits and misses."""
+    for _ in range(2):
+        upload_file_with_mocked_openai("/minnisblad-adstod/upload/", client)
+    response = client.get(
+        "/cache/stats", headers={"Authorization": f"Bearer {BEARER_TOKEN}"}
+    )
+    assert response.status_code == 200
+    assert response.json()["memory"]["hits"] == 1
+    assert response.json()["memory"]["misses"] == 1
+    assert response.json() == response_cache.stats()
+
+
+def test_cache_stats_requires_token():
+    """The stats endpoint should require a valid token."""
+    response = client.get("/cache/stats", headers={"Authorization": "Bearer invalid"})
+    assert response.status_code == 401
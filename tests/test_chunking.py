@@ -0,0 +1,142 @@
+"""Test splitting long documents and merging the chunk responses."""
+
+import asyncio
+import json
+import time
+import pytest
+from app.chunking import merge_responses, split_text
+from app.tokens import count_tokens, measure_tokens
+from app.utils import send_text_to_openai
+
+PARAGRAPH = " ".join(["Þetta er setning í löngu minnisblaði."] * 5)
+
+
+def test_short_text_is_one_chunk():
+    """A text within the budget should not be split."""
+    assert split_text("Stuttur texti.\nAnnar.", max_tokens=100) == [
+        "Stuttur texti.\nAnnar."
+    ]
+
+
+def test_chunks_end_on_paragraphs_within_budget():
+    """Chunks should keep whole paragraphs and stay within the budget."""
+    text = "\n".join([PARAGRAPH] * 10)
+    chunks = split_text(text, max_tokens=200)
+    assert len(chunks) > 1
+    assert all(count_tokens(chunk) <= 200 for chunk in chunks)
+    assert "\n".join(chunks) == text
+
+
+def test_heading_moves_to_the_next_chunk():
+    """A heading should start a chunk rather than end one."""
+    text = "\n".join([PARAGRAPH, "Annar kafli", PARAGRAPH])
+    chunks = split_text(text, max_tokens=count_tokens(PARAGRAPH) + 10)
+    assert chunks == [PARAGRAPH, "Annar kafli\n" + PARAGRAPH]
+
+
+def test_long_paragraph_is_split_on_sentences():
+    """A paragraph over the budget should be split between sentences."""
+    chunks = split_text(PARAGRAPH + " " + "orð " * 200, max_tokens=40)
+    assert all(count_tokens(chunk) <= 40 for chunk in chunks)
+    assert chunks[0].endswith("minnisblaði.")
+    assert " ".join(chunks).split() == (PARAGRAPH + " " + "orð " * 200).split()
+
+
+def test_long_sentence_is_counted_once(mocker):
+    """A sentence over the budget should be split without counting it again per word."""
+    count = mocker.patch("app.chunking.measure_tokens", side_effect=measure_tokens)
+    text = "orð " * 5000
+    chunks = split_text(text, max_tokens=2000)
+    assert len(chunks) > 1
+    assert all(count_tokens(chunk) <= 2000 for chunk in chunks)
+    assert " ".join(chunks).split() == text.split()
+    counted = sum(len(call.args[0]) for call in count.call_args_list)
+    assert counted < 10 * len(text)
+
+
+def test_pieces_are_not_kept_in_the_count_cache():
+    """Splitting should keep only the count of the whole text in the cache."""
+    text = "\n".join([PARAGRAPH + " " + "orð " * 50] * 20)
+    split_text(text, max_tokens=100)
+    assert count_tokens.cache_info().currsize == 1
+
+
+def test_merge_review_feedback():
+    """Feedback should be joined per field, without repeats."""
+    responses = [
+        {
+            "name": "Minnisblad_adstod",
+            "type": "object",
+            "properties": {"malfar": "Gott.", "stafsetning": "Villa í 1.", "radleggingar": ""},
+        },
+        {
+            "name": "Annað",
+            "type": "object",
+            "properties": {
+                "malfar": "Gott.",
+                "stafsetning": "Villa í 2.",
+                "radleggingar": "Styttu.",
+            },
+        },
+    ]
+    assert merge_responses(responses) == {
+        "name": "Minnisblad_adstod",
+        "type": "object",
+        "properties": {
+            "malfar": "Gott.",
+            "stafsetning": "Villa í 1.\n\nVilla í 2.",
+            "radleggingar": "Styttu.",
+        },
+    }
+
+
+def test_merge_memo_chapters():
+    """The title should come from the first chunk and the chapters be joined."""
+    responses = [
+        {
+            "titill": "Titill",
+            "kaflar": [{"chapter_title": "A", "content": "a"}],
+            "inngangur": "Fyrri.",
+        },
+        {
+            "titill": "Annar",
+            "kaflar": [{"chapter_title": "B", "content": "b"}],
+            "inngangur": "Seinni.",
+        },
+    ]
+    assert merge_responses(responses) == {
+        "titill": "Titill",
+        "kaflar": [
+            {"chapter_title": "A", "content": "a"},
+            {"chapter_title": "B", "content": "b"},
+        ],
+        "inngangur": "Fyrri.\n\nSeinni.",
+    }
+
+
+@pytest.mark.asyncio
+async def test_long_text_chunks_are_sent_concurrently(mocker):
+    """A long text should take about as long as one chunk."""
+    mocker.patch("app.chunking.CHUNK_TOKENS", 200)
+
+    async def create(**request):
+        await asyncio.sleep(0.2)
+        completion = mocker.Mock()
+        completion.choices = [mocker.Mock()]
+        completion.usage = None
+        text = request["messages"][1]["content"][0]["text"]
+        completion.choices[0].message.content = json.dumps({"malfar": text[:5]})
+        return completion
+
+    create_mock = mocker.patch(
+        "app.utils.client.chat.completions.create",
+        new_callable=mocker.AsyncMock,
+        side_effect=create,
+    )
+    text = "\n".join(f"{i}. {PARAGRAPH}" for i in range(1, 11))
+    start = time.perf_counter()
+    response = await send_text_to_openai(text, {"type": "json_object"})
+    elapsed = time.perf_counter() - start
+    assert create_mock.await_count == len(split_text(text)) > 1
+    assert elapsed < 0.2 * 2
+    assert response["malfar"].startswith("1. Þe\n\n")
@@ -0,0 +1,47 @@
+"""Test the citation rewriting."""
+
+from app.citations import CitationRewriter
+from app.routes.adstod import process_message
+
+
+def rewrite(*chunks) -> str:
+    """Feed the chunks to a rewriter and return the full output."""
+    rewriter = CitationRewriter()
+    return "".join(rewriter.feed(chunk) for chunk in chunks) + rewriter.finish()
+
+
+def test_process_message_without_citations():
+    """A message without citations should be returned unchanged."""
+    assert process_message("Engar heimildir hér.") == "Engar heimildir hér."
+
+
+def test_process_message_numbers_sources_in_order():
+    """Sources should be numbered by first appearance and reused."""
+    message = "A【4:0†b.pdf】 B【4:1†a.pdf】 C【5:2†b.pdf】"
+    assert process_message(message) == (
+        "A【1】 B【2】 C【1】\n\nSources:\n1: b.pdf\n2: a.pdf"
+    )
+
+
+def test_marker_split_across_chunks():
+    """A marker split across chunks should be rewritten once it is complete."""
+    rewriter = CitationRewriter()
+    assert rewriter.feed("Texti【4:") == "Texti"
+    assert rewriter.feed("0†skjal") == ""
+    assert rewriter.feed(".pdf】 meira") == "【1】 meira"
+    assert rewriter.finish() == "\n\nSources:\n1: skjal.pdf"
+
+
+def test_chunked_output_matches_whole_message():
+    """Rewriting in chunks of any size should match rewriting in one go."""
+    message = "Upphaf【4:0†a.pdf】 miðja 【x】 og【4:1†b.docx】 endir【4:2†a.pdf】."
+    expected = process_message(message)
+    for size in range(1, len(message) + 1):
+        chunks = [message[i : i + size] for i in range(0, len(message), size)]
+        assert rewrite(*chunks) == expected
+
+
+def test_unterminated_marker_is_flushed():
+    """An unterminated marker should be sent as plain text at the end."""
+    assert rewrite("Texti 【4:0†skj") == "Texti 【4:0†skj"
+    assert rewrite("Texti 【4:0\n†skj】") == "Texti 【4:0\n†skj】"
@@ -0,0 +1,131 @@
+"""Test the server-side conversation store."""
+
+import os
+import pytest
+from fastapi.testclient import TestClient
+from prometheus_client import REGISTRY
+from app.conversations import ConversationStore, conversation_store
+from app.database import get_session
+from app.main import app
+from app.models import Conversation
+
+client = TestClient(app)
+
+BEARER_TOKEN = os.getenv("BEARER_TOKEN")
+
+
+def turn(number: int) -> list:
+    """Return a question and its reply."""
+    return [
+        {"role": "user", "text": f"Spurning {number}"},
+        {"role": "assistant", "text": f"Svar {number}"},
+    ]
+
+
+@pytest.mark.asyncio
+async def test_store_keeps_only_the_most_recent_messages():
+    """A thread should be capped at max_messages messages."""
+    store = ConversationStore(max_size=10, ttl=60, max_messages=3)
+    await store.set("thread", turn(0))
+    for number in range(1, 3):
+        assert await store.add("thread", *turn(number))
+    assert await store.get("thread") == turn(1)[1:] + turn(2)
+
+
+@pytest.mark.asyncio
+async def test_turn_of_a_thread_not_stored_is_dropped():
+    """A turn should not be stored as the whole of a thread that isn't stored."""
+    store = ConversationStore(max_size=10, ttl=60, max_messages=10)
+    assert not await store.add("thread", *turn(2))
+    assert await store.get("thread") is None
+    stats = store.stats()["memory"]
+    assert (stats["hits"], stats["misses"]) == (0, 1)
+
+
+@pytest.mark.asyncio
+async def test_store_returns_a_copy():
+    """Changing returned messages should not change the stored ones."""
+    store = ConversationStore(max_size=10, ttl=60, max_messages=10)
+    await store.set("thread", turn(1))
+    (await store.get("thread")).append({"role": "user", "text": "Breytt"})
+    assert await store.get("thread") == turn(1)
+
+
+@pytest.mark.asyncio
+async def test_store_memory_is_exported_as_metrics():
+    """The threads and characters in memory should be shown in the metrics."""
+    store = ConversationStore(max_size=2, ttl=60, max_messages=10)
+    for thread_id in ("a", "b", "c"):
+        await store.set(thread_id, turn(1))
+    characters = store.stats()["memory"]["characters"]
+    assert REGISTRY.get_sample_value("conversation_store_threads") == 2
+    assert REGISTRY.get_sample_value("conversation_store_characters") == characters
+    response = client.get("/metrics", headers={"Authorization": f"Bearer {BEARER_TOKEN}"})
+    assert f"conversation_store_characters {float(characters)}" in response.text
+
+
+@pytest.mark.asyncio
+async def test_store_evicts_least_recently_used_thread():
+    """The number of threads in memory should be capped."""
+    store = ConversationStore(max_size=2, ttl=60, max_messages=10)
+    for thread_id in ("a", "b", "c"):
+        await store.set(thread_id, turn(1))
+    assert await store.get("a") is None
+    stats = store.stats()["memory"]
+    assert stats["size"] == 2
+    assert stats["evictions"] == 1
+    assert stats["characters"] > 0
+
+
+@pytest.mark.asyncio
+@pytest.mark.usefixtures("sqlite_database")
+async def test_persistent_tier_survives_memory_eviction():
+    """A thread evicted from memory should be loaded from the database."""
+    store = ConversationStore(max_size=1, ttl=60, max_messages=10, persist=True)
+    await store.set("a", turn(1))
+    await store.set("b", turn(3))
+    assert await store.add("a", *turn(2))
+    await store.set("b", turn(3))
+    assert await store.get("a") == turn(1) + turn(2)
+    assert await store.get("missing") is None
+    assert store.stats()["persistent"] == {
+        "enabled": True,
+        "hits": 1,
+        "misses": 1,
+        "writes": 4,
+        "expired": 0,
+    }
+
+
+@pytest.mark.asyncio
+@pytest.mark.usefixtures("sqlite_database")
+async def test_persistent_tier_drops_expired_threads():
+    """A thread older than the TTL should not be loaded from the database."""
+    store = ConversationStore(max_size=1, ttl=60, max_messages=10, persist=True)
+    await store.set("a", turn(1))
+    store.memory.clear()
+    store.memory.ttl = -60
+    assert await store.get("a") is None
+
+
+@pytest.mark.asyncio
+@pytest.mark.usefixtures("sqlite_database")
+async def test_expired_threads_are_swept_from_the_database():
+    """Threads that expired should be deleted even if they are never read."""
+    store = ConversationStore(max_size=10, ttl=60, max_messages=10, persist=True)
+    await store.set("old", turn(1))
+    store.memory.ttl = -60
+    await store.sweep(force=True)
+    assert store.stats()["persistent"]["expired"] == 1
+    with get_session() as session:
+        assert session.get(Conversation, "old") is None
+
+
+def test_stats_endpoint_requires_token():
+    """The stats should only be shown with a valid token."""
+    assert client.get("/adstod/stats").status_code == 403
+    response = client.get(
+        "/adstod/stats", headers={"Authorization": f"Bearer {BEARER_TOKEN}"}
+    )
+    assert response.status_code == 200
+    assert response.json() == conversation_store.stats()
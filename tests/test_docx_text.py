@@ -0,0 +1,100 @@
+"""Test the streaming .docx text extraction."""
+
+import io
+import os
+import pytest
+from docx import Document
+from docx.enum.text import WD_BREAK
+from fastapi.testclient import TestClient
+from app.docx_text import DocxTooLargeError, InvalidDocxError, read_docx_text
+from app.main import app
+from app.utils import DOCX_CONTENT_TYPE
+
+client = TestClient(app)
+
+BEARER_TOKEN = os.getenv("BEARER_TOKEN")
+
+
+def make_docx(paragraphs: int, words_per_paragraph: int = 10) -> io.BytesIO:
+    """Build a document with tables, tabs and breaks in memory."""
+    doc = Document()
+    doc.add_heading("Fyrirsögn", level=1)
+    for i in range(paragraphs):
+        paragraph = doc.add_paragraph(" ".join(["orð"] * words_per_paragraph))
+        run = paragraph.add_run("\tflipi")
+        run.add_break()
+        run.add_text("lína")
+        run.add_break(WD_BREAK.PAGE)
+        if i % 10 == 0:
+            table = doc.add_table(rows=1, cols=2)
+            table.cell(0, 0).text = "Ekki með í textanum"
+    buffer = io.BytesIO()
+    doc.save(buffer)
+    buffer.seek(0)
+    return buffer
+
+
+def test_matches_python_docx():
+    """The text should match the paragraphs read by python-docx."""
+    file = make_docx(25)
+    expected = "\n".join(p.text for p in Document(file).paragraphs)
+    file.seek(0)
+    result = read_docx_text(file)
+    assert result.text == expected
+    assert result.word_count == len(expected.split())
+    assert not result.truncated
+
+
+def test_stops_at_word_limit():
+    """Parsing should stop as soon as the word limit is exceeded."""
+    result = read_docx_text(make_docx(1000), max_words=100)
+    assert result.truncated
+    assert 100 < result.word_count < 120
+
+
+def test_invalid_file_raises():
+    """A file that is not a .docx document should raise InvalidDocxError."""
+    with pytest.raises(InvalidDocxError):
+        read_docx_text(io.BytesIO(b"not a zip file"))
+
+
+def test_oversized_document_part_raises(mocker):
+    """A document part over the size limit should be rejected."""
+    mocker.patch("app.docx_text.MAX_DOCUMENT_PART_BYTES", 1024)
+    with pytest.raises(DocxTooLargeError):
+        read_docx_text(make_docx(100))
+
+
+def upload(content: bytes):
+    """Upload a document to the minnisblad-adstod route."""
+    return client.post(
+        "/minnisblad-adstod/upload/",
+        files={"file": ("skjal.docx", content, DOCX_CONTENT_TYPE)},
+        headers={"Authorization": f"Bearer {BEARER_TOKEN}"},
+    )
+
+
+def test_upload_of_long_document_is_rejected(mocker):
+    """A document over the word limit should be rejected before the API call."""
+    send = mocker.patch("app.routes.minnisblad_adstod.send_text_to_openai")
+    response = upload(make_docx(1000, words_per_paragraph=60).getvalue())
+    assert response.status_code == 400
+    assert response.json() == {
+        "detail": "The document must contain between 10 and 50000 words."
+    }
+    send.assert_not_called()
+
+
+def test_upload_of_corrupt_document_is_rejected():
+    """A corrupt .docx upload should be rejected with a 400."""
+    response = upload(b"not a zip file")
+    assert response.status_code == 400
+    assert response.json() == {"detail": "The file is not a valid .docx document."}
+
+
+def test_upload_of_oversized_document_is_rejected(mocker):
+    """A document part over the size limit should be rejected with a 413."""
+    mocker.patch("app.docx_text.MAX_DOCUMENT_PART_BYTES", 1024)
+    response = upload(make_docx(100).getvalue())
+    assert response.status_code == 413
+    assert response.json() == {"detail": "The document is too large to process."}
@@ -0,0 +1,139 @@
+"""Test the executor for CPU-bound work."""
+
+import asyncio
+import os
+import time
+import pytest
+from fastapi.testclient import TestClient
+from app.executor import CPUExecutor, TaskLimitError
+from app.main import app
+from app.routes.minnisblad import build_docx
+from app import executor
+from tests.utils import upload_file_with_mocked_openai
+
+client = TestClient(app)
+
+needs_worker_limits = pytest.mark.skipif(
+    not executor.WORKER_LIMITS, reason="Worker limits need Unix signals."
+)
+
+
+def spin(seconds: float) -> int:
+    """Keep a CPU busy for a while."""
+    end = time.monotonic() + seconds
+    while time.monotonic() < end:
+        pass
+    return os.getpid()
+
+
+def allocate(megabytes: int) -> int:
+    """Allocate a block of memory."""
+    return len(bytearray(megabytes * 1024 * 1024))
+
+
+def die(seconds: float):
+    """Kill the worker process after a while."""
+    time.sleep(seconds)
+    os._exit(1)
+
+
+@pytest.fixture(name="process_executor", scope="module")
+def fixture_process_executor():
+    """Return a process pool executor with one warm worker."""
+    pool = CPUExecutor("process", workers=1, timeout=0.5, memory_mb=2048)
+    yield pool
+    pool.pool.shutdown(cancel_futures=True)
+
+
+@pytest.mark.asyncio
+async def test_thread_executor_runs_tasks():
+    """Tasks on the thread pool should run off the event loop thread."""
+    pool = CPUExecutor("thread", workers=2)
+    assert await pool.run(spin, 0) == os.getpid()
+    await pool.stop()
+
+
+@pytest.mark.asyncio
+async def test_thread_executor_times_out():
+    """A task that runs over the timeout should be abandoned."""
+    pool = CPUExecutor("thread", workers=1, timeout=0.05)
+    with pytest.raises(TaskLimitError):
+        await pool.run(spin, 0.5)
+    await pool.stop()
+
+
+def test_unknown_executor_kind():
+    """Only thread and process pools are supported."""
+    with pytest.raises(ValueError):
+        CPUExecutor("fiber")
+
+
+@pytest.mark.asyncio
+async def test_process_executor_runs_in_worker(process_executor):
+    """Tasks on the process pool should run in a worker process."""
+    await process_executor.start()
+    assert await process_executor.run(spin, 0) != os.getpid()
+
+
+@pytest.mark.asyncio
+@needs_worker_limits
+async def test_process_executor_interrupts_long_tasks(process_executor):
+    """A task over the timeout should be interrupted, and the worker reused."""
+    with pytest.raises(TaskLimitError, match="longer than"):
+        await process_executor.run(spin, 5)
+    assert await process_executor.run(spin, 0) != os.getpid()
+
+
+@pytest.mark.asyncio
+@needs_worker_limits
+async def test_process_executor_limits_memory(process_executor):
+    """A task over the memory limit should fail, and the worker be reused."""
+    with pytest.raises(TaskLimitError, match="memory"):
+        await process_executor.run(allocate, 4096)
+    assert await process_executor.run(allocate, 10) == 10 * 1024 * 1024
+
+
+def test_limits_are_off_without_unix_signals(monkeypatch, mocker, caplog):
+    """Where the limits can't be set, tasks should run without them."""
+    monkeypatch.setattr(executor, "WORKER_LIMITS", False)
+    resource = mocker.patch("app.executor.resource")
+    signals = mocker.patch("app.executor.signal")
+    executor.init_worker(1)
+    assert executor.run_limited(sum, ([1, 2],), 0.01) == 3
+    assert not resource.mock_calls
+    assert not signals.mock_calls
+    pool = CPUExecutor("process", workers=1)
+    pool.pool.shutdown()
+    assert "limits of the CPU workers are off" in caplog.text
+
+
+@pytest.mark.asyncio
+async def test_dead_worker_fails_every_task_on_its_pool():
+    """All tasks on a pool whose worker died should fail with TaskLimitError."""
+    pool = CPUExecutor("process", workers=2, timeout=5, memory_mb=0)
+    await pool.start()
+    results = await asyncio.gather(
+        pool.run(die, 0.1),
+        pool.run(spin, 0.5),
+        pool.run(spin, 0.5),
+        return_exceptions=True,
+    )
+    assert all(isinstance(result, TaskLimitError) for result in results)
+    assert await pool.run(spin, 0) != os.getpid()
+    await pool.stop()
+
+
+@pytest.mark.asyncio
+async def test_docx_is_built_in_worker(monkeypatch, process_executor):
+    """Memos should render in a worker process."""
+    monkeypatch.setattr(executor, "cpu_executor", process_executor)
+    document = await build_docx({"titill": "Titill", "kaflar": []}, [])
+    assert document.startswith(b"PK")
+
+
+def test_slow_parse_is_rejected(monkeypatch, mocker):
+    """An upload that takes too long to parse should be rejected."""
+    monkeypatch.setattr(executor.cpu_executor, "timeout", 0.01)
+    mocker.patch("app.utils.read_docx_text", side_effect=lambda *args: spin(0.2))
+    response = upload_file_with_mocked_openai("/minnisblad-adstod/upload/", client)
+    assert response.status_code == 413
@@ -0,0 +1,65 @@
+"""Test the app against the fake OpenAI server."""
+
+import pytest
+from app.routes import adstod
+from app.utils import DOCX_CONTENT_TYPE
+from tests.fake_openai import FakeOpenAI
+from tests.utils import BEARER_TOKEN
+
+
+@pytest.mark.asyncio
+async def test_assistant_run_is_polled_until_complete(monkeypatch, fake_state, app_client):
+    """A run on the fake server should be polled until its latency has passed."""
+    fake_state.run_latency = 0.05
+    monkeypatch.setattr(adstod, "RUN_POLL_INITIAL_INTERVAL", 0.01)
+    response = await app_client.post("/adstod/start", json={"message": "Hæ"})
+    assert response.status_code == 200
+    body = response.json()
+    assert "【1】" in body["message"] and "1: reglur.pdf" in body["message"]
+    response = await app_client.post(
+        "/adstod/start", json={"message": "Og svo?", "thread_id": body["thread_id"]}
+    )
+    assert response.json()["thread_id"] == body["thread_id"]
+    assert len(fake_state.threads[body["thread_id"]]) == 4
+
+
+@pytest.mark.asyncio
+async def test_assistant_stream_is_relayed(fake_state, app_client):
+    """The streamed deltas of the fake server should reach the browser."""
+    response = await app_client.post("/adstod/stream", json={"message": "Hæ"})
+    events = [
+        block.split("\n")[0].removeprefix("event: ")
+        for block in response.text.strip().split("\n\n")
+    ]
+    assert events[0] == "thread"
+    assert events.count("delta") > 1
+    assert events[-1] == "done"
+    (thread_id,) = fake_state.threads
+    history = await app_client.get(f"/adstod/threads/{thread_id}")
+    assert [message["role"] for message in history.json()["messages"]] == [
+        "user",
+        "assistant",
+    ]
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("fake_state", [FakeOpenAI(error_rate=1.0, error_status=429)])
+async def test_injected_errors_return_service_busy(fake_state, app_client):
+    """Errors injected by the fake server should surface as a 503."""
+    response = await app_client.post("/adstod/start", json={"message": "Hæ"})
+    assert response.status_code == 503
+    assert fake_state.errors > 1
+
+
+@pytest.mark.asyncio
+async def test_upload_uses_fake_completion(fake_state, app_client):
+    """An upload should be answered from the response format schema."""
+    with open("tests/test_document.docx", "rb") as file:
+        document = file.read()
+    response = await app_client.post(
+        "/minnisblad-adstod/upload/",
+        files={"file": ("test_document.docx", document, DOCX_CONTENT_TYPE)},
+        headers={"Authorization": f"Bearer {BEARER_TOKEN}"},
+    )
+    assert response.status_code == 200
+    assert len(fake_state.chat_requests) == 1
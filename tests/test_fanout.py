@@ -0,0 +1,82 @@
+"""Test the generation of memos one chapter at a time."""
+
+import time
+import pytest
+from app import fanout
+from app.routes.minnisblad import create_docx_from_json, generate_memo
+from tests.fake_openai import FAKE_TEXT
+
+SECTIONS = ["inngangur", "samantekt", "aaetlun", "markmid"]
+
+
+@pytest.fixture(autouse=True)
+def fanout_mode(monkeypatch, fake_client):
+    """Turn on fan-out mode and send the calls to the fake server."""
+    monkeypatch.setattr(fanout, "MEMO_FANOUT", True)
+    monkeypatch.setattr("app.utils.client", fake_client)
+
+
+@pytest.mark.asyncio
+async def test_memo_is_assembled_from_parts(fake_state):
+    """The parts should be put together into the single call JSON."""
+    memo = await generate_memo("Texti skjalsins.", SECTIONS)
+    assert memo == {
+        "titill": FAKE_TEXT,
+        "kaflar": [{"chapter_title": FAKE_TEXT, "content": FAKE_TEXT}],
+        **{key: FAKE_TEXT for key in SECTIONS},
+    }
+    names = sorted(
+        request["response_format"]["json_schema"]["name"]
+        for request in fake_state.chat_requests
+    )
+    assert names == sorted(
+        ["minnisblad_efnisyfirlit", "minnisblad_kafli"]
+        + [f"minnisblad_{key}" for key in SECTIONS]
+    )
+    assert create_docx_from_json(memo, SECTIONS).startswith(b"PK")
+
+
+@pytest.mark.asyncio
+async def test_only_selected_sections_are_written(fake_state):
+    """Sections that were not selected should not be generated."""
+    memo = await generate_memo("Texti skjalsins.", ["samantekt"])
+    assert "inngangur" not in memo and memo["samantekt"] == FAKE_TEXT
+    assert len(fake_state.chat_requests) == 3
+
+
+@pytest.mark.asyncio
+async def test_parts_are_written_concurrently(fake_state):
+    """The memo should take two calls of time, not one per part."""
+    fake_state.latency = 0.1
+    start = time.perf_counter()
+    await generate_memo("Texti skjalsins.", SECTIONS)
+    assert time.perf_counter() - start < 0.35
+    assert len(fake_state.chat_requests) == 6
+
+
+@pytest.mark.asyncio
+async def test_chapters_keep_the_outline_order(mocker):
+    """Chapters should be in the planned order and capped in number."""
+    plans = [{"chapter_title": f"Kafli {i}", "lysing": f"Um {i}"} for i in range(20)]
+
+    async def send(_text, response_format):
+        schema = response_format["json_schema"]
+        if schema["name"] == "minnisblad_efnisyfirlit":
+            return {"titill": "Titill", "kaflar": plans}
+        description = schema["schema"]["properties"]["content"]["description"]
+        return {"content": description.split("„")[1].split("“")[0]}
+
+    mocker.patch("app.fanout.send_text_to_openai", side_effect=send)
+    memo = await fanout.generate_memo_fanout("Texti.", [])
+    assert [chapter["content"] for chapter in memo["kaflar"]] == [
+        f"Kafli {i}" for i in range(fanout.MEMO_FANOUT_MAX_CHAPTERS)
+    ]
+
+
+@pytest.mark.asyncio
+async def test_single_call_without_fanout(monkeypatch, fake_state):
+    """Without fan-out mode the memo should be written by one call."""
+    monkeypatch.setattr(fanout, "MEMO_FANOUT", False)
+    memo = await generate_memo("Texti skjalsins.", SECTIONS)
+    assert set(memo) == {"titill", "kaflar", *SECTIONS}
+    assert len(fake_state.chat_requests) == 1
@@ -0,0 +1,323 @@
+"""Test the background job queue and its routes."""
+
+import asyncio
+import io
+import os
+from datetime import timedelta
+import httpx
+import pytest
+import pytest_asyncio
+from docx import Document
+from sqlmodel import select
+from app.database import get_session
+from app.jobs import JOB_DEADLINE, JOB_LEASE
+from app.main import app
+from app.models import Job, utcnow
+from app.routes.jobs import job_queue, run_minnisblad_adstod_job
+from app.upstream import CircuitOpenError, remaining
+from app.utils import DOCX_CONTENT_TYPE, upstream_error
+
+BEARER_TOKEN = os.getenv("BEARER_TOKEN")
+HEADERS = {"Authorization": f"Bearer {BEARER_TOKEN}"}
+
+with open("tests/test_document.docx", "rb") as document_file:
+    DOCUMENT = document_file.read()
+
+pytestmark = pytest.mark.usefixtures("sqlite_database")
+
+
+@pytest_asyncio.fixture(name="http_client")
+async def fixture_http_client():
+    """Run the job workers and return a client for the app."""
+    await job_queue.start(workers=2)
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as c:
+        yield c
+    await job_queue.stop()
+
+
+@pytest.fixture(name="send_text")
+def fixture_send_text(mocker):
+    """Mock the OpenAI call made by the job handlers."""
+    send_text = mocker.patch(
+        "app.routes.jobs.send_text_to_openai",
+        return_value={
+            "titill": "Titill",
+            "kaflar": [{"chapter_title": "Kafli", "content": "Efni"}],
+            "malfar": "Gott",
+        },
+    )
+    # Memo jobs call the model through generate_memo.
+    mocker.patch("app.routes.minnisblad.send_text_to_openai", new=send_text)
+    return send_text
+
+
+async def wait_for_job(http_client, job_id: str) -> dict:
+    """Poll the job until it is no longer queued or running."""
+    for _ in range(100):
+        response = await http_client.get(f"/jobs/{job_id}", headers=HEADERS)
+        if response.json()["status"] not in ("queued", "running"):
+            return response.json()
+        await asyncio.sleep(0.02)
+    raise AssertionError("The job did not finish.")
+
+
+async def submit(http_client, url: str, data: dict = None):
+    """Submit the test document to a job route."""
+    return await http_client.post(
+        url,
+        files={"file": ("test_document.docx", DOCUMENT, DOCX_CONTENT_TYPE)},
+        data=data or {},
+        headers=HEADERS,
+    )
+
+
+@pytest.mark.asyncio
+@pytest.mark.usefixtures("send_text")
+async def test_minnisblad_adstod_job(http_client):
+    """A review job should be queued at once and its result fetched later."""
+    response = await submit(http_client, "/jobs/minnisblad-adstod/")
+    assert response.status_code == 202
+    assert response.json()["status"] == "queued"
+    job_id = response.json()["job_id"]
+    assert (await wait_for_job(http_client, job_id))["status"] == "completed"
+    result = await http_client.get(f"/jobs/{job_id}/result", headers=HEADERS)
+    assert result.json()["malfar"] == "Gott"
+
+
+@pytest.mark.asyncio
+@pytest.mark.usefixtures("send_text")
+async def test_minnisblad_job_returns_document(http_client):
+    """A memo job should return the generated document."""
+    response = await submit(
+        http_client, "/jobs/minnisblad/", data={"chapters": '["inngangur"]'}
+    )
+    job_id = response.json()["job_id"]
+    await wait_for_job(http_client, job_id)
+    result = await http_client.get(f"/jobs/{job_id}/result", headers=HEADERS)
+    assert result.headers["content-type"] == DOCX_CONTENT_TYPE
+    assert Document(io.BytesIO(result.content)).paragraphs[0].text == "Titill"
+
+
+@pytest.mark.asyncio
+async def test_failed_job_reports_error(http_client, send_text):
+    """A job whose handler fails should be marked as failed."""
+    send_text.side_effect = Exception("Test exception")
+    response = await submit(http_client, "/jobs/minnisblad-adstod/")
+    job_id = response.json()["job_id"]
+    status = await wait_for_job(http_client, job_id)
+    assert status["status"] == "failed"
+    assert status["error"] == "An unexpected error occurred"
+    result = await http_client.get(f"/jobs/{job_id}/result", headers=HEADERS)
+    assert result.status_code == 409
+
+
+@pytest.mark.asyncio
+async def test_failed_job_reports_upstream_error(http_client, send_text):
+    """A job should report an upstream failure like an upload would."""
+    send_text.side_effect = CircuitOpenError(retry_after=30)
+    response = await submit(http_client, "/jobs/minnisblad-adstod/")
+    status = await wait_for_job(http_client, response.json()["job_id"])
+    assert status["status"] == "failed"
+    assert status["error"] == upstream_error(CircuitOpenError(retry_after=30)).detail
+
+
+@pytest.mark.asyncio
+async def test_unknown_job_returns_404(http_client):
+    """An unknown job id should return a 404."""
+    response = await http_client.get("/jobs/missing", headers=HEADERS)
+    assert response.status_code == 404
+
+
+@pytest.mark.asyncio
+@pytest.mark.usefixtures("send_text")
+async def test_interrupted_jobs_are_recovered_on_start():
+    """Queued jobs and stale running jobs should be picked up after a restart."""
+    stale = utcnow() - timedelta(hours=1)
+    with get_session() as session:
+        session.add(Job(id="queued", kind="minnisblad_adstod", text="Texti"))
+        session.add(
+            Job(
+                id="stale",
+                kind="minnisblad_adstod",
+                text="Texti",
+                status="running",
+                attempts=1,
+                updated_at=stale,
+            )
+        )
+        session.add(
+            Job(
+                id="gave_up",
+                kind="minnisblad_adstod",
+                text="Texti",
+                status="running",
+                attempts=3,
+                updated_at=stale,
+            )
+        )
+        session.commit()
+    await job_queue.start(workers=1)
+    try:
+        for _ in range(100):
+            jobs = {job_id: await job_queue.get(job_id) for job_id in ("queued", "stale")}
+            if all(job.status == "completed" for job in jobs.values()):
+                break
+            await asyncio.sleep(0.02)
+    finally:
+        await job_queue.stop()
+    assert jobs["stale"].attempts == 2
+    assert jobs["queued"].status == "completed"
+    assert (await job_queue.get("gave_up")).status == "failed"
+
+
+@pytest.mark.asyncio
+@pytest.mark.usefixtures("send_text")
+async def test_stale_job_is_recovered_while_running(monkeypatch):
+    """A job left running by a crashed worker should be picked up by a poll."""
+    monkeypatch.setattr("app.jobs.JOB_POLL_INTERVAL", 0.01)
+    await job_queue.start(workers=1)
+    try:
+        with get_session() as session:
+            session.add(
+                Job(
+                    id="stale",
+                    kind="minnisblad_adstod",
+                    text="Texti",
+                    status="running",
+                    attempts=1,
+                    updated_at=utcnow() - timedelta(hours=1),
+                )
+            )
+            session.commit()
+        for _ in range(100):
+            job = await job_queue.get("stale")
+            if job.status == "completed":
+                break
+            await asyncio.sleep(0.02)
+    finally:
+        await job_queue.stop()
+    assert job.status == "completed"
+    assert job.attempts == 2
+
+
+def test_finished_jobs_are_purged_after_retention():
+    """Jobs that ended longer ago than JOB_RETENTION should be deleted on a poll."""
+    old = utcnow() - timedelta(days=30)
+    with get_session() as session:
+        for job_id, status, updated_at in [
+            ("old_completed", "completed", old),
+            ("old_failed", "failed", old),
+            ("new_completed", "completed", utcnow()),
+            ("old_queued", "queued", old),
+        ]:
+            session.add(
+                Job(
+                    id=job_id,
+                    kind="minnisblad_adstod",
+                    text="Texti",
+                    status=status,
+                    updated_at=updated_at,
+                )
+            )
+        session.commit()
+    assert job_queue._find_queued() == "old_queued"  # pylint: disable=protected-access
+    with get_session() as session:
+        remaining_ids = set(session.exec(select(Job.id)))
+    assert remaining_ids == {"new_completed", "old_queued"}
+
+
+def test_job_is_claimed_once():
+    """Only the first worker to claim a job should get it."""
+    with get_session() as session:
+        session.add(Job(id="job", kind="minnisblad_adstod", text="Texti"))
+        session.commit()
+    # pylint: disable=protected-access
+    assert job_queue._claim("job").status == "running"
+    assert job_queue._claim("job") is None
+
+
+@pytest.mark.asyncio
+async def test_running_job_renews_its_lease(monkeypatch, mocker):
+    """A job that outlives its lease should not be taken for a stale one."""
+    monkeypatch.setattr("app.jobs.JOB_HEARTBEAT", 0.01)
+    leases = []
+
+    async def slow_send_text(*_):
+        leases.append((await job_queue.get("long")).updated_at)
+        await asyncio.sleep(0.1)
+        leases.append((await job_queue.get("long")).updated_at)
+        return {"titill": "Titill", "kaflar": [], "malfar": "Gott"}
+
+    mocker.patch("app.routes.jobs.send_text_to_openai", new=slow_send_text)
+    with get_session() as session:
+        session.add(Job(id="long", kind="minnisblad_adstod", text="Texti"))
+        session.commit()
+    job = job_queue._claim("long")  # pylint: disable=protected-access
+    await job_queue._run(job)  # pylint: disable=protected-access
+    assert leases[1] > leases[0]
+    assert (await job_queue.get("long")).status == "completed"
+
+
+@pytest.mark.asyncio
+async def test_job_taken_from_a_worker_keeps_its_status(mocker):
+    """A worker whose job was requeued or failed meanwhile should not store it."""
+
+    async def interrupted_send_text(*_):
+        with get_session() as session:
+            session.get(Job, "taken").status = "failed"
+            session.commit()
+        return {"titill": "Titill", "kaflar": [], "malfar": "Gott"}
+
+    mocker.patch("app.routes.jobs.send_text_to_openai", new=interrupted_send_text)
+    with get_session() as session:
+        session.add(Job(id="taken", kind="minnisblad_adstod", text="Texti"))
+        session.commit()
+    job = job_queue._claim("taken")  # pylint: disable=protected-access
+    await job_queue._run(job)  # pylint: disable=protected-access
+    job = await job_queue.get("taken")
+    assert job.status == "failed"
+    assert job.result is None
+
+
+@pytest.mark.asyncio
+async def test_job_calls_have_a_deadline_within_the_lease(mocker):
+    """The upstream calls of a job should end before its lease runs out."""
+    budgets = []
+
+    async def send_text(*_):
+        budgets.append(remaining())
+        return {"titill": "Titill", "kaflar": [], "malfar": "Gott"}
+
+    mocker.patch("app.routes.jobs.send_text_to_openai", new=send_text)
+    await run_minnisblad_adstod_job(Job(id="job", kind="minnisblad_adstod", text="Texti"))
+    assert budgets[0] <= JOB_DEADLINE < JOB_LEASE
+
+
+@pytest.mark.asyncio
+async def test_jobs_without_a_database_return_503(monkeypatch):
+    """Jobs should be refused clearly when no database is configured."""
+    monkeypatch.delenv("DATABASE_URL")
+    monkeypatch.delenv("POSTGRES_SERVER", raising=False)
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as c:
+        response = await submit(c, "/jobs/minnisblad-adstod/")
+        status = await c.get("/jobs/some-job", headers=HEADERS)
+    assert response.status_code == 503
+    assert response.json() == {
+        "detail": "Jobs are not available, as no database is configured."
+    }
+    assert status.status_code == 503
+
+
+@pytest.mark.asyncio
+async def test_workers_need_a_database(monkeypatch, caplog):
+    """Without a database the workers should not start or poll."""
+    monkeypatch.delenv("DATABASE_URL")
+    monkeypatch.delenv("POSTGRES_SERVER", raising=False)
+    await job_queue.start(workers=2)
+    try:
+        assert not job_queue._workers  # pylint: disable=protected-access
+    finally:
+        await job_queue.stop()
+    assert "Could not recover" not in caplog.text
@@ -0,0 +1,83 @@
+"""Test the memo renderer."""
+
+import io
+from docx import Document
+from app.memo import CHAPTERS, HOUSE_FONT, TEMPLATE_PACKAGE, get_renderer
+from app.routes.minnisblad import create_docx_from_json, create_response_format
+
+RESPONSE = {
+    "titill": "Titill",
+    "samantekt": "Samantekt texti",
+    "inngangur": "Inngangur texti",
+    "kaflar": [{"chapter_title": "Kafli 1", "content": "Efni 1"}],
+    "aaetlun": "Áætlun texti",
+    "markmid": "Markmið texti",
+}
+
+
+def paragraph_texts(data: bytes) -> list:
+    """Return the text of every paragraph in a .docx file."""
+    return [p.text for p in Document(io.BytesIO(data)).paragraphs]
+
+
+def test_sections_are_rendered_in_order():
+    """The chapters should be placed around the kaflar as in the table."""
+    data = create_docx_from_json(RESPONSE, [c.key for c in CHAPTERS])
+    assert paragraph_texts(data) == [
+        "Titill",
+        "Inngangur",
+        "Inngangur texti",
+        "Markmið",
+        "Markmið texti",
+        "Áætlun",
+        "Áætlun texti",
+        "Kafli 1",
+        "Efni 1",
+        "Samantekt",
+        "Samantekt texti",
+    ]
+
+
+def test_only_selected_chapters_are_rendered():
+    """Chapters that were not selected should be left out."""
+    data = create_docx_from_json(RESPONSE, ["samantekt"])
+    assert paragraph_texts(data) == [
+        "Titill",
+        "Kafli 1",
+        "Efni 1",
+        "Samantekt",
+        "Samantekt texti",
+    ]
+
+
+def test_selection_defaults_to_chapters_in_response():
+    """Without a selection the chapters in the response should be rendered."""
+    data = create_docx_from_json({"titill": "Titill", "markmid": "Markmið texti"})
+    assert paragraph_texts(data) == ["Titill", "Markmið", "Markmið texti"]
+
+
+def test_renderer_is_compiled_once_per_selection():
+    """The same chapter selection should reuse the compiled renderer."""
+    first = get_renderer(frozenset(["inngangur", "markmid"]))
+    assert get_renderer(frozenset(["markmid", "inngangur"])) is first
+    assert get_renderer(frozenset(["inngangur"])) is not first
+
+
+def test_template_is_not_changed_by_rendering():
+    """Rendering should work on a clone of the template."""
+    create_docx_from_json(RESPONSE)
+    assert not TEMPLATE_PACKAGE.main_document_part.document.paragraphs
+
+
+def test_house_styles_are_applied():
+    """The generated document should use the house styles."""
+    doc = Document(io.BytesIO(create_docx_from_json(RESPONSE)))
+    assert doc.styles["Normal"].font.name == HOUSE_FONT
+    assert doc.core_properties.author == "Fróði"
+
+
+def test_response_format_uses_chapter_table():
+    """The schema should use the descriptions from the chapter table."""
+    schema = create_response_format(["markmid"])["json_schema"]["schema"]
+    assert schema["properties"]["markmid"]["description"] == CHAPTERS[1].description
+    assert schema["required"] == ("titill", "kaflar", "markmid")
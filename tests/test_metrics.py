@@ -0,0 +1,81 @@
+"""Test the Prometheus metrics."""
+
+import os
+import pytest
+from fastapi.testclient import TestClient
+from prometheus_client import REGISTRY
+from app.main import app
+from app.metrics import mark_process_dead, render_metrics
+from tests.utils import upload_file_with_mocked_openai
+
+client = TestClient(app)
+
+BEARER_TOKEN = os.getenv("BEARER_TOKEN")
+
+
+def sample(name: str, **labels) -> float:
+    """Return the current value of a metric sample, or 0."""
+    return REGISTRY.get_sample_value(name, labels) or 0
+
+
+def test_metrics_requires_token():
+    """The metrics should only be shown with a valid token."""
+    assert client.get("/metrics").status_code == 403
+
+
+@pytest.mark.usefixtures("sqlite_database")
+def test_requests_are_counted_by_route_template():
+    """Requests should be labelled with the route template, not the path."""
+    labels = {"method": "GET", "route": "/jobs/{job_id}", "status": "404"}
+    before = sample("http_requests_total", **labels)
+    client.get(
+        "/jobs/missing-job", headers={"Authorization": f"Bearer {BEARER_TOKEN}"}
+    )
+    assert sample("http_requests_total", **labels) == before + 1
+    unmatched = {"method": "GET", "route": "unmatched", "status": "404"}
+    before = sample("http_requests_total", **unmatched)
+    client.get("/no/such/page")
+    assert sample("http_requests_total", **unmatched) == before + 1
+
+
+def test_upload_stages_are_timed(mocker):
+    """An upload should record its stages and the tokens used."""
+    completion = mocker.Mock()
+    completion.choices = [mocker.Mock()]
+    completion.choices[0].message.content = '{"malfar": "Gott"}'
+    completion.usage.prompt_tokens = 100
+    completion.usage.completion_tokens = 20
+    mocker.patch("app.routing.MODEL_ROUTES", ())  # One call, to the default model.
+    mocker.patch(
+        "app.utils.client.chat.completions.create",
+        new_callable=mocker.AsyncMock,
+        return_value=completion,
+    )
+    stages = ("upload_read", "docx_parse", "llm_call", "response_write")
+    before = {name: sample("stage_duration_seconds_count", stage=name) for name in stages}
+    tokens = sample("llm_tokens_total", model="gpt-4o", kind="prompt")
+    response = upload_file_with_mocked_openai("/minnisblad-adstod/upload/", client)
+    assert response.status_code == 200
+    for name in stages:
+        assert sample("stage_duration_seconds_count", stage=name) == before[name] + 1
+    assert sample("llm_tokens_total", model="gpt-4o", kind="prompt") == tokens + 100
+    assert sample("stage_in_progress", stage="llm_call") == 0
+
+
+def test_metrics_endpoint_uses_text_format():
+    """The metrics should be returned in the Prometheus text format."""
+    response = client.get(
+        "/metrics", headers={"Authorization": f"Bearer {BEARER_TOKEN}"}
+    )
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain")
+    assert "# TYPE http_request_duration_seconds histogram" in response.text
+    assert 'http_requests_in_progress{method="GET"} 1.0' in response.text
+
+
+def test_metrics_of_all_workers_are_collected(monkeypatch, tmp_path):
+    """With a multiprocess directory the metrics are read from its files."""
+    monkeypatch.setenv("PROMETHEUS_MULTIPROC_DIR", str(tmp_path))
+    content, _ = render_metrics()
+    assert b"http_requests_total" not in content
+    mark_process_dead()
@@ -1,7 +1,9 @@
 """Test the routes in the FastAPI app."""
 
+import io
 import os
 import pytest
+from docx import Document
 from fastapi.testclient import TestClient
 from app.main import app
 from app.utils import send_text_to_openai
@@ -26,9 +28,9 @@ def mock_openai_response(mocker):
     """Mock the response from the OpenAI API."""
     mock_response = {
         "titill": "Test Title",
-        "Inngangur": "Test Introduction",
+        "inngangur": "Test Introduction",
         "kaflar": [{"chapter_title": "Test Chapter", "content": "Test Content"}],
-        "Samantekt": "Test Summary",
+        "samantekt": "Test Summary",
         "aaetlun": "Test Plan",
         "markmid": "Test Objective",
     }
@@ -66,7 +68,7 @@ def test_upload_file_that_is_too_short():
     )
     assert response.status_code == 400
     assert response.json() == {
-        "detail": "The document must contain between 10 and 5000 words."
+        "detail": "The document must contain between 10 and 50000 words."
     }
 
 
@@ -98,11 +100,27 @@ async def test_send_text_to_openai(mocker):
     # Mock the OpenAI client's chat completion create method
     mock_completion = mocker.Mock()
     mock_completion.choices = [mocker.Mock()]
+    mock_completion.usage = None
     mock_completion.choices[0].message.content = '{"result": "Test Response"}'
     mocker.patch(
-        "app.utils.client.chat.completions.create", return_value=mock_completion
+        "app.utils.client.chat.completions.create",
+        new_callable=mocker.AsyncMock,
+        return_value=mock_completion,
     )
     text = "This is a test text."
     response_format = {"type": "json"}
     response = await send_text_to_openai(text, response_format)
     assert response == {"result": "Test Response"}
+
+
+def test_upload_file_does_not_write_temp_files(mocker):
+    """The generated document should be returned without touching disk."""
+    temp_file = mocker.patch("tempfile.NamedTemporaryFile")
+    response = upload_file_with_mocked_openai("/minnisblad/upload/", client)
+    assert response.status_code == 200
+    assert response.headers["content-disposition"].startswith(
+        'attachment; filename="Frodi_minnisblad_'
+    )
+    temp_file.assert_not_called()
+    document = Document(io.BytesIO(response.content))
+    assert document.paragraphs[0].text == "Test Title"
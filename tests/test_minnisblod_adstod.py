@@ -71,7 +71,7 @@ def test_upload_file_that_is_too_short():
     response = upload_file_that_is_too_short("/minnisblad-adstod/upload/", client)
     assert response.status_code == 400
     assert response.json() == {
-        "detail": "The document must contain between 10 and 5000 words."
+        "detail": "The document must contain between 10 and 50000 words."
     }
 
 
@@ -0,0 +1,92 @@
+"""Test the shared OpenAI client."""
+
+import asyncio
+import io
+import json
+import os
+import time
+import httpx
+import pytest
+from docx import Document
+from app.main import app
+from app import openai_client, utils
+from app.routes import adstod
+from tests.fake_openai import fake_instance
+
+BEARER_TOKEN = os.getenv("BEARER_TOKEN")
+
+LATENCY = 0.5
+PARALLEL_UPLOADS = 10
+
+
+def test_client_is_shared():
+    """The routes and the utils should use the same client instance."""
+    assert utils.client is openai_client.client
+    assert adstod.client is openai_client.client
+
+
+def test_http_client_uses_configured_pool(mocker):
+    """The HTTP client should be built from the configured pool settings."""
+    mocker.patch("app.openai_client.OPENAI_MAX_CONNECTIONS", 7)
+    mocker.patch("app.openai_client.OPENAI_MAX_KEEPALIVE_CONNECTIONS", 3)
+    mocker.patch("app.openai_client.OPENAI_TIMEOUT", 42.0)
+    http_client = openai_client.create_http_client()
+    pool = http_client._transport.transport._pool  # pylint: disable=protected-access
+    assert pool._max_connections == 7  # pylint: disable=protected-access
+    assert pool._max_keepalive_connections == 3  # pylint: disable=protected-access
+    assert http_client.timeout.read == 42.0
+
+
+def distinct_documents(count: int) -> list:
+    """Number copies of the test document, so no uploads are coalesced."""
+    documents = []
+    for number in range(count):
+        document = Document("tests/test_document.docx")
+        document.add_paragraph(f"Minnisblað númer {number}")
+        buffer = io.BytesIO()
+        document.save(buffer)
+        documents.append(buffer.getvalue())
+    return documents
+
+
+@pytest.mark.asyncio
+async def test_parallel_uploads_do_not_block_each_other(mocker):
+    """N parallel uploads should make N calls in about one call's latency."""
+
+    async def slow_completion(**request):
+        await asyncio.sleep(LATENCY)
+        schema = request["response_format"]["json_schema"]["schema"]
+        completion = mocker.Mock()
+        completion.choices = [mocker.Mock()]
+        completion.usage = None
+        completion.choices[0].finish_reason = "stop"
+        completion.choices[0].message.content = json.dumps(fake_instance(schema))
+        return completion
+
+    create = mocker.patch(
+        "app.utils.client.chat.completions.create", side_effect=slow_completion
+    )
+
+    async def upload(http_client, content):
+        return await http_client.post(
+            "/minnisblad-adstod/upload/",
+            files={
+                "file": (
+                    "test_document.docx",
+                    content,
+                    "application/vnd.openxmlformats-officedocument.wordprocessingml.document",
+                )
+            },
+            headers={"Authorization": f"Bearer {BEARER_TOKEN}"},
+        )
+
+    documents = distinct_documents(PARALLEL_UPLOADS)
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as c:
+        start = time.perf_counter()
+        responses = await asyncio.gather(*(upload(c, content) for content in documents))
+        elapsed = time.perf_counter() - start
+
+    assert all(response.status_code == 200 for response in responses)
+    assert create.call_count == PARALLEL_UPLOADS
+    assert elapsed < LATENCY * 2
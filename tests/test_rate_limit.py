@@ -0,0 +1,199 @@
+"""Test the rate limiter and the retries of upstream requests."""
+
+import asyncio
+import json
+import time
+import httpx
+import pytest
+from fastapi.testclient import TestClient
+from openai import AsyncOpenAI
+from app.main import app
+from app.rate_limit import (
+    RateLimitedTransport,
+    RateLimiter,
+    RateLimitTimeout,
+    request_tokens,
+)
+from app.upstream import deadline
+from tests.utils import upload_file_with_mocked_openai
+
+COMPLETION = {
+    "id": "chatcmpl-1",
+    "object": "chat.completion",
+    "created": 0,
+    "model": "gpt-4o",
+    "choices": [
+        {
+            "index": 0,
+            "finish_reason": "stop",
+            "message": {"role": "assistant", "content": '{"malfar": "Gott"}'},
+        }
+    ],
+}
+
+
+def upstream(*responses):
+    """Return a mock transport answering with the responses in turn."""
+    calls = []
+
+    def handler(request):
+        calls.append(request)
+        response = responses[min(len(calls), len(responses)) - 1]
+        return response() if callable(response) else response
+
+    return httpx.MockTransport(handler), calls
+
+
+def rate_limited(retry_after_ms: str = "10") -> httpx.Response:
+    """Return a 429 response asking for a short wait."""
+    return httpx.Response(429, headers={"retry-after-ms": retry_after_ms}, json={})
+
+
+@pytest.mark.asyncio
+async def test_requests_queue_in_order_when_the_bucket_is_empty():
+    """Excess requests should wait for the refill instead of failing."""
+    limiter = RateLimiter(requests_per_minute=600, tokens_per_minute=10**6, headroom=1)
+    limiter.requests.level = 0
+    finished = []
+
+    async def request(number):
+        await limiter.acquire(0, time.monotonic() + 5)
+        finished.append((number, time.monotonic()))
+
+    start = time.monotonic()
+    await asyncio.gather(*(request(number) for number in range(3)))
+    assert [number for number, _ in finished] == [0, 1, 2]
+    assert finished[-1][1] - start == pytest.approx(0.3, abs=0.1)
+
+
+@pytest.mark.asyncio
+async def test_tokens_are_limited_per_minute():
+    """A request should wait until there are tokens enough for it."""
+    limiter = RateLimiter(requests_per_minute=600, tokens_per_minute=6000, headroom=1)
+    limiter.tokens.level = 0
+    start = time.monotonic()
+    await limiter.acquire(10, time.monotonic() + 5)
+    assert time.monotonic() - start == pytest.approx(0.1, abs=0.05)
+
+
+@pytest.mark.asyncio
+async def test_queue_longer_than_deadline_raises():
+    """A request that can't be sent before its deadline should fail at once."""
+    limiter = RateLimiter(requests_per_minute=60, tokens_per_minute=10**6, headroom=1)
+    limiter.requests.level = 0
+    with pytest.raises(RateLimitTimeout):
+        await limiter.acquire(0, time.monotonic() + 0.5)
+
+
+def test_limiter_adapts_to_rate_limit_headers():
+    """The buckets should follow the limits and remaining counts reported."""
+    limiter = RateLimiter(requests_per_minute=500, tokens_per_minute=30000, headroom=0.9)
+    limiter.update(
+        httpx.Headers(
+            {
+                "x-ratelimit-limit-requests": "100",
+                "x-ratelimit-remaining-requests": "50",
+                "x-ratelimit-limit-tokens": "20000",
+                "x-ratelimit-remaining-tokens": "19000",
+            }
+        )
+    )
+    stats = limiter.stats()
+    assert stats["requests_per_minute"] == pytest.approx(90)
+    assert stats["requests_available"] == pytest.approx(40, abs=0.1)
+    assert stats["tokens_per_minute"] == pytest.approx(18000)
+    assert stats["tokens_available"] == pytest.approx(17000, abs=1)
+
+
+def test_request_tokens_counts_prompt_and_completion_limit():
+    """Completions should count their prompt estimate and max_tokens."""
+    body = {"messages": [{"role": "user", "content": "x" * 300}], "max_tokens": 1000}
+    request = httpx.Request("POST", "https://api.test/v1/chat/completions", json=body)
+    assert 1100 <= request_tokens(request) <= 1120
+    assert request_tokens(httpx.Request("GET", "https://api.test/v1/models")) == 0
+
+
+@pytest.mark.asyncio
+async def test_rate_limited_request_is_retried():
+    """A 429 should pause the limiter and the request be sent again."""
+    transport, calls = upstream(rate_limited(), httpx.Response(200, json=COMPLETION))
+    limiter = RateLimiter()
+    async with httpx.AsyncClient(
+        transport=RateLimitedTransport(transport, limiter, deadline=5)
+    ) as http_client:
+        response = await http_client.post("https://api.test/v1/chat/completions", json={})
+    assert response.status_code == 200
+    assert len(calls) == 2
+    assert limiter.stats()["throttled"] == 1
+    assert limiter.stats()["retries"] == 1
+
+
+@pytest.mark.asyncio
+async def test_connection_errors_are_retried():
+    """A failed connection should be retried within the deadline."""
+
+    def refuse():
+        raise httpx.ConnectError("Connection refused")
+
+    transport, calls = upstream(refuse, httpx.Response(200, json=COMPLETION))
+    async with httpx.AsyncClient(
+        transport=RateLimitedTransport(transport, RateLimiter(), deadline=5)
+    ) as http_client:
+        response = await http_client.get("https://api.test/v1/models")
+    assert response.status_code == 200
+    assert len(calls) == 2
+
+
+@pytest.mark.asyncio
+async def test_server_errors_are_retried_until_the_deadline(mocker):
+    """The last error should be returned when the deadline runs out."""
+    mocker.patch("app.rate_limit.random.uniform", return_value=0.05)
+    transport, calls = upstream(httpx.Response(500, json={}))
+    async with httpx.AsyncClient(
+        transport=RateLimitedTransport(transport, RateLimiter(), deadline=0.3)
+    ) as http_client:
+        response = await http_client.get("https://api.test/v1/models")
+    assert response.status_code == 500
+    assert len(calls) > 1
+
+
+@pytest.mark.asyncio
+async def test_requests_wait_as_long_as_their_request_deadline(monkeypatch):
+    """A request with its own deadline should queue past OPENAI_RETRY_DEADLINE."""
+    monkeypatch.setattr("app.rate_limit.OPENAI_RETRY_DEADLINE", 0.05)
+    limiter = RateLimiter(requests_per_minute=600, tokens_per_minute=10**6, headroom=1)
+    limiter.requests.level = -1
+    transport, calls = upstream(httpx.Response(200, json=COMPLETION))
+    async with httpx.AsyncClient(
+        transport=RateLimitedTransport(transport, limiter)
+    ) as http_client:
+        with pytest.raises(RateLimitTimeout):
+            await http_client.get("https://api.test/v1/models")
+        limiter.requests.level = -1
+        with deadline(5):
+            response = await http_client.get("https://api.test/v1/models")
+    assert response.status_code == 200
+    assert len(calls) == 1
+
+
+def test_rate_limit_past_deadline_returns_service_busy(mocker):
+    """An upload that stays rate limited should get a 503, not a 500."""
+    transport, _ = upstream(rate_limited("2000"))
+    http_client = httpx.AsyncClient(
+        transport=RateLimitedTransport(transport, RateLimiter(), deadline=0.5)
+    )
+    mocker.patch(
+        "app.utils.client",
+        AsyncOpenAI(
+            api_key="test",
+            base_url="https://api.test/v1",
+            http_client=http_client,
+            max_retries=0,
+        ),
+    )
+    response = upload_file_with_mocked_openai("/minnisblad-adstod/upload/", TestClient(app))
+    assert response.status_code == 503
+    assert response.headers["retry-after"] == "30"
+    assert json.loads(response.text) == {
+        "detail": "The service is busy, please try again shortly."
+    }
@@ -0,0 +1,87 @@
+"""Test the frozen response formats."""
+
+import copy
+import json
+import pickle
+import pytest
+from fastapi.testclient import TestClient
+from app.main import app
+from app.response_format import ResponseFormat, check_response
+from app.routes.minnisblad import create_response_format
+from app.routes.minnisblad_adstod import create_minnisblad_adstod_response_format
+from tests.utils import upload_file_with_mocked_openai
+
+client = TestClient(app)
+
+
+def test_response_format_is_frozen():
+    """The shared response format should not be changeable."""
+    response_format = create_response_format(["inngangur"])
+    with pytest.raises(TypeError):
+        response_format["type"] = "text"
+    with pytest.raises(TypeError):
+        response_format["json_schema"]["schema"]["properties"]["extra"] = {}
+    with pytest.raises(AttributeError):
+        response_format["json_schema"]["schema"]["required"].append("extra")
+
+
+def test_response_format_is_built_once_per_chapter_set():
+    """The same chapter set in any order should give the same object."""
+    first = create_response_format(["samantekt", "inngangur"])
+    assert create_response_format(["inngangur", "samantekt"]) is first
+    assert create_response_format(["inngangur"]) is not first
+    assert create_minnisblad_adstod_response_format() is (
+        create_minnisblad_adstod_response_format()
+    )
+
+
+def test_digest_is_stable_and_distinct():
+    """Each chapter set should have its own stable hash."""
+    digests = {
+        create_response_format(chapters).digest
+        for chapters in ([], ["inngangur"], ["markmid"], ["inngangur", "markmid"])
+    }
+    assert len(digests) == 4
+    response_format = create_response_format(["aaetlun"])
+    assert ResponseFormat(response_format).digest == response_format.digest
+
+
+def test_response_format_can_be_copied_and_pickled():
+    """Copies should be equal and keep the same hash."""
+    response_format = create_response_format(["markmid"])
+    for clone in (copy.deepcopy(response_format), pickle.loads(pickle.dumps(response_format))):
+        assert clone == response_format
+        assert clone.digest == response_format.digest
+
+
+def test_unknown_chapters_are_rejected():
+    """Unknown chapter names should raise instead of being dropped."""
+    with pytest.raises(ValueError):
+        create_response_format(["inngangur", "eftirmali"])
+
+
+def test_upload_with_unknown_chapter_returns_400():
+    """An upload with an unknown chapter should be rejected."""
+    response = upload_file_with_mocked_openai(
+        "/minnisblad/upload/", client, data={"chapters": '["inngangur", "eftirmali"]'}
+    )
+    assert response.status_code == 400
+    assert response.json() == {
+        "detail": "Chapters must be a list of: inngangur, markmid, aaetlun, samantekt."
+    }
+
+
+def test_responses_are_checked_against_the_schema():
+    """A response missing a required field or of the wrong type should fail."""
+    response_format = create_response_format(["inngangur"])
+    valid = {"titill": "T", "kaflar": [{"chapter_title": "A", "content": "a"}], "inngangur": ""}
+    check_response(json.dumps(valid), response_format)
+    for invalid in (
+        {**valid, "inngangur": None},
+        {"titill": "T", "kaflar": []},
+        {**valid, "kaflar": [{"chapter_title": "A"}]},
+    ):
+        with pytest.raises(ValueError):
+            check_response(json.dumps(invalid), response_format)
+    with pytest.raises(ValueError):
+        check_response('{"titill": "T"', response_format)
@@ -0,0 +1,84 @@
+"""Test the choice of model for each LLM call."""
+
+import pytest
+from prometheus_client import REGISTRY
+from app import routing
+from app.fanout import OUTLINE_FORMAT, section_format
+from app.memo import CHAPTERS
+from app.routes.minnisblad import create_response_format
+from app.routes.minnisblad_adstod import create_minnisblad_adstod_response_format
+from app.utils import send_text_to_openai
+
+review_format = create_minnisblad_adstod_response_format()
+
+
+def escalations(route: str) -> float:
+    """Return how many calls on a route were escalated."""
+    return REGISTRY.get_sample_value("llm_escalations_total", {"route": route}) or 0
+
+
+def test_short_reviews_and_sections_go_to_the_small_model():
+    """The default routes should send small tasks to the small model."""
+    assert routing.choose_route(review_format, 1000).name == "review_short"
+    assert routing.choose_route(review_format, 1000).model == routing.OPENAI_SMALL_MODEL
+    assert routing.choose_route(section_format(CHAPTERS[0]), 9000).name == "memo_section"
+
+
+def test_long_reviews_and_memos_go_to_the_default_model():
+    """Calls that match no route should use OPENAI_MODEL."""
+    assert routing.choose_route(review_format, 5000) == routing.DEFAULT_ROUTE
+    assert routing.choose_route(create_response_format(["inngangur"]), 10) == (
+        routing.DEFAULT_ROUTE
+    )
+    assert routing.choose_route(OUTLINE_FORMAT, 10).model == routing.OPENAI_MODEL
+
+
+def test_routes_match_on_the_chapter_set():
+    """A route with chapters should only match memos within that set."""
+    routes = routing.load_routes(
+        '[{"name": "short_memo", "formats": ["minnisblad"],'
+        ' "chapters": ["inngangur", "samantekt"], "model": "small"}]'
+    )
+    assert routes[0].max_tokens is None
+    short = routing.choose_route(create_response_format(["samantekt"]), 10, routes)
+    assert short.name == "short_memo" and short.model == "small"
+    full = create_response_format(["samantekt", "markmid"])
+    assert routing.choose_route(full, 10, routes) == routing.DEFAULT_ROUTE
+
+
+def test_routes_default_without_setting():
+    """An empty MODEL_ROUTES should give the default routes."""
+    assert routing.load_routes("") == routing.DEFAULT_ROUTES
+
+
+@pytest.mark.asyncio
+async def test_invalid_output_is_escalated(mocker, fake_client, fake_state):
+    """Output from the small model that doesn't fit the schema should be redone."""
+    mocker.patch("app.utils.client", fake_client)
+    fake_state.invalid_models = {routing.OPENAI_SMALL_MODEL}
+    before = escalations("review_short")
+    response = await send_text_to_openai("Stutt skjal til yfirlestrar.", review_format)
+    assert set(response["properties"]) == {"malfar", "stafsetning", "radleggingar"}
+    assert [usage["model"] for usage in fake_state.usage] == [
+        routing.OPENAI_SMALL_MODEL,
+        routing.OPENAI_MODEL,
+    ]
+    assert escalations("review_short") == before + 1
+
+
+@pytest.mark.asyncio
+async def test_valid_output_is_not_escalated(mocker, fake_client, fake_state):
+    """Valid output from the small model should be used as it is."""
+    mocker.patch("app.utils.client", fake_client)
+    await send_text_to_openai("Stutt skjal til yfirlestrar.", review_format)
+    assert [usage["model"] for usage in fake_state.usage] == [routing.OPENAI_SMALL_MODEL]
+
+
+@pytest.mark.asyncio
+async def test_escalation_can_be_turned_off(mocker, fake_client, fake_state):
+    """Without escalation the small model's output should be returned."""
+    mocker.patch("app.utils.client", fake_client)
+    mocker.patch("app.routing.MODEL_ESCALATION", False)
+    fake_state.invalid_models = {routing.OPENAI_SMALL_MODEL}
+    assert await send_text_to_openai("Stutt skjal.", review_format) == {}
+    assert len(fake_state.usage) == 1
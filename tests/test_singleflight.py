@@ -0,0 +1,102 @@
+"""Test that identical requests in flight share one upstream call."""
+
+import asyncio
+import os
+import httpx
+import pytest
+from app.main import app
+from app.singleflight import SingleFlight
+from app.utils import DOCX_CONTENT_TYPE, in_flight_requests
+
+BEARER_TOKEN = os.getenv("BEARER_TOKEN")
+
+with open("tests/test_document.docx", "rb") as document_file:
+    DOCUMENT = document_file.read()
+
+
+@pytest.mark.asyncio
+async def test_identical_concurrent_uploads_make_one_call(mocker, fake_client, fake_state):
+    """50 identical uploads at once should reach the backend once."""
+    mocker.patch("app.utils.client", fake_client)
+    fake_state.latency = 0.2
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+        responses = await asyncio.gather(
+            *(
+                client.post(
+                    "/minnisblad-adstod/upload/",
+                    files={"file": ("skjal.docx", DOCUMENT, DOCX_CONTENT_TYPE)},
+                    headers={"Authorization": f"Bearer {BEARER_TOKEN}"},
+                )
+                for _ in range(50)
+            )
+        )
+    assert [response.status_code for response in responses] == [200] * 50
+    assert len({response.text for response in responses}) == 1
+    assert len(fake_state.chat_requests) == 1
+    assert len(in_flight_requests) == 0
+
+
+@pytest.mark.asyncio
+async def test_failure_reaches_every_waiter():
+    """A failed call should raise in every waiter and not be remembered."""
+    flights = SingleFlight()
+    calls = []
+
+    async def fail():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        raise ValueError("Upstream failed")
+
+    results = await asyncio.gather(
+        *(flights.run("key", fail) for _ in range(5)), return_exceptions=True
+    )
+    assert len(calls) == 1
+    assert all(isinstance(result, ValueError) for result in results)
+    assert len(flights) == 0
+    with pytest.raises(ValueError):
+        await flights.run("key", fail)
+    assert len(calls) == 2
+
+
+@pytest.mark.asyncio
+async def test_cancelled_waiter_does_not_cancel_the_others():
+    """One waiter going away should leave the call running for the rest."""
+    flights = SingleFlight()
+    release = asyncio.Event()
+
+    async def call():
+        await release.wait()
+        return "result"
+
+    first = asyncio.create_task(flights.run("key", call))
+    second = asyncio.create_task(flights.run("key", call))
+    await asyncio.sleep(0)
+    first.cancel()
+    await asyncio.sleep(0)
+    release.set()
+    assert await second == "result"
+    assert first.cancelled()
+    assert flights.stats() == {"in_flight": 0, "calls": 1, "coalesced": 1}
+
+
+@pytest.mark.asyncio
+async def test_call_is_cancelled_when_every_waiter_is_gone():
+    """The upstream call should stop when nobody waits for it any more."""
+    flights = SingleFlight()
+    started = asyncio.Event()
+    cancelled = asyncio.Event()
+
+    async def call():
+        started.set()
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            cancelled.set()
+            raise
+
+    waiter = asyncio.create_task(flights.run("key", call))
+    await started.wait()
+    waiter.cancel()
+    await asyncio.wait_for(cancelled.wait(), timeout=1)
+    assert len(flights) == 0
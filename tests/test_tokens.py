@@ -0,0 +1,101 @@
+"""Test token counting and the output budgets."""
+
+import json
+import pytest
+from fastapi.testclient import TestClient
+from app import tokens
+from app.fanout import OUTLINE_FORMAT, section_format
+from app.main import app
+from app.memo import CHAPTERS
+from app.routes.minnisblad_adstod import create_minnisblad_adstod_response_format
+from app.utils import build_chat_request, send_text_to_openai
+from tests.utils import upload_file_with_mocked_openai
+
+client = TestClient(app)
+review_format = create_minnisblad_adstod_response_format()
+# The tests count tokens with the estimate, see conftest.py.
+load_encoding = tokens.get_encoding
+
+
+class FakeEncoding:  # pylint: disable=too-few-public-methods
+    """An encoding with one token per word."""
+
+    def encode(self, text, disallowed_special=()):
+        """Split the text on whitespace."""
+        assert disallowed_special == ()
+        return text.split()
+
+
+def test_tokens_are_counted_with_the_encoding(monkeypatch):
+    """The count should come from the encoding when it is available."""
+    monkeypatch.setattr(tokens, "get_encoding", FakeEncoding)
+    assert tokens.count_tokens("Þetta eru fjögur orð") == 4
+
+
+def test_tokens_are_estimated_without_tiktoken(monkeypatch):
+    """A failure to load the encoding should fall back to the estimate."""
+
+    def fail(name):
+        raise ValueError(f"Could not download {name}.")
+
+    monkeypatch.setattr("tiktoken.get_encoding", fail)
+    load_encoding.cache_clear()
+    try:
+        assert load_encoding() is None
+    finally:
+        load_encoding.cache_clear()
+    assert tokens.count_tokens("x" * 30) == 10
+
+
+def test_prompt_tokens_count_messages_and_schema():
+    """The prompt should count every message, its overhead and the schema."""
+    messages = [
+        {"role": "system", "content": [{"type": "text", "text": "x" * 30}]},
+        {"role": "user", "content": "y" * 60},
+    ]
+    without_schema = tokens.count_prompt_tokens(messages)
+    assert without_schema == 3 + (3 + 2 + 10) + (3 + 2 + 20)
+    assert tokens.count_prompt_tokens(messages, OUTLINE_FORMAT) > without_schema + 50
+
+
+def test_output_budget_grows_with_input_up_to_its_cap():
+    """A longer input should get a larger budget, but never over the cap."""
+    small = tokens.output_budget(review_format, 1000)
+    large = tokens.output_budget(review_format, 8000)
+    assert small < large < tokens.output_cap(review_format)
+    assert tokens.output_budget(review_format, 10**6) == tokens.output_cap(review_format)
+
+
+def test_sections_get_a_small_budget():
+    """A single memo section should not reserve a whole memo's budget."""
+    section = section_format(CHAPTERS[0])
+    assert tokens.budget_for(section) == tokens.SECTION_BUDGET
+    assert tokens.budget_for({"type": "json_object"}) == tokens.DEFAULT_BUDGET
+
+
+def test_chat_request_max_tokens_follows_document_size():
+    """A short document should ask for fewer output tokens than a long one."""
+    short = build_chat_request("Stutt skjal.", review_format)
+    long = build_chat_request("Langt skjal. " * 5000, review_format)
+    assert short["max_tokens"] < long["max_tokens"] <= 4000
+
+
+@pytest.mark.asyncio
+async def test_truncated_response_is_retried_at_the_cap(mocker, fake_client, fake_state):
+    """A response cut off at its budget should be asked for again at the cap."""
+    mocker.patch("app.utils.client", fake_client)
+    mocker.patch.dict(tokens.OUTPUT_BUDGETS, {"minnisblad_efnisyfirlit": (5, 0, 1000)})
+    response = await send_text_to_openai("Texti um reglugerð.", OUTLINE_FORMAT)
+    assert "titill" in response
+    assert [request["max_tokens"] for request in fake_state.chat_requests] == [5, 1000]
+    assert [usage["max_tokens"] for usage in fake_state.usage] == [5, 1000]
+
+
+def test_document_over_the_token_budget_is_rejected(monkeypatch, mocker):
+    """An upload with more tokens than MAX_DOCUMENT_TOKENS should be rejected."""
+    monkeypatch.setattr("app.utils.MAX_DOCUMENT_TOKENS", 10)
+    send = mocker.patch("app.routes.minnisblad_adstod.send_text_to_openai")
+    response = upload_file_with_mocked_openai("/minnisblad-adstod/upload/", client)
+    assert response.status_code == 400
+    assert "10 tokens" in json.loads(response.content)["detail"]
+    send.assert_not_called()
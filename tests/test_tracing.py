@@ -0,0 +1,119 @@
+"""Test the request tracing."""
+
+import json
+import pytest
+from fastapi.testclient import TestClient
+from app.main import app
+from app.tracing import Trace, TraceSink, span
+from tests.utils import upload_file_with_mocked_openai
+
+client = TestClient(app)
+
+MEMO = {
+    "titill": "Minnisblað",
+    "kaflar": [{"chapter_title": "Kafli", "content": "Efni kaflans"}],
+    **{chapter: "Texti" for chapter in ("inngangur", "samantekt", "aaetlun", "markmid")},
+}
+
+@pytest.fixture(autouse=True)
+def mock_openai_response(mocker):
+    """Mock the response from the OpenAI API."""
+    completion = mocker.Mock()
+    completion.choices = [mocker.Mock()]
+    completion.choices[0].message.content = json.dumps(MEMO)
+    completion.usage = None
+    mocker.patch(
+        "app.utils.client.chat.completions.create",
+        new_callable=mocker.AsyncMock,
+        return_value=completion,
+    )
+
+
+def read_spans(sink: TraceSink) -> list:
+    """Return the spans written to the trace file."""
+    sink.close()
+    with open(sink.path, encoding="utf-8") as file:
+        lines = file.read().splitlines()
+    return [
+        spans
+        for line in lines
+        for spans in json.loads(line)["resourceSpans"][0]["scopeSpans"][0]["spans"]
+    ]
+
+
+def test_upload_returns_server_timing():
+    """The stages of an upload should be timed in the Server-Timing header."""
+    response = upload_file_with_mocked_openai("/minnisblad/upload/", client)
+    assert response.status_code == 200
+    timing = dict(
+        entry.split(";dur=") for entry in response.headers["server-timing"].split(", ")
+    )
+    for name in (
+        "process_uploaded_file",
+        "docx_parse",
+        "send_text_to_openai",
+        "llm_call",
+        "docx_build",
+        "total",
+    ):
+        assert float(timing[name]) >= 0
+    assert len(response.headers["x-request-id"]) == 32
+
+
+def test_upload_trace_is_written(trace_sink):
+    """The full trace should be written as OTLP JSON with nested spans."""
+    response = upload_file_with_mocked_openai("/minnisblad/upload/", client)
+    spans = {item["name"]: item for item in read_spans(trace_sink)}
+    root = spans["request"]
+    assert root["traceId"] == response.headers["x-request-id"]
+    assert root["kind"] == 2
+    assert "parentSpanId" not in root
+    assert {"key": "http.route", "value": {"stringValue": "/minnisblad/upload/"}} in root[
+        "attributes"
+    ]
+    assert spans["send_text_to_openai"]["parentSpanId"] == root["spanId"]
+    assert spans["llm_call"]["parentSpanId"] == spans["send_text_to_openai"]["spanId"]
+    assert int(root["endTimeUnixNano"]) >= int(spans["llm_call"]["endTimeUnixNano"])
+
+
+def test_incoming_ids_are_continued(trace_sink):
+    """A valid request id and traceparent from the caller should be kept."""
+    trace_id = "4bf92f3577b34da6a3ce929d0e0e4736"
+    response = client.get(
+        "/adstod/stats",
+        headers={
+            "X-Request-ID": "support-ticket-42",
+            "traceparent": f"00-{trace_id}-00f067aa0ba902b7-01",
+        },
+    )
+    assert response.headers["x-request-id"] == "support-ticket-42"
+    (root,) = read_spans(trace_sink)
+    assert root["traceId"] == trace_id
+    assert root["parentSpanId"] == "00f067aa0ba902b7"
+    assert root["status"] == {"code": 1}
+
+
+def test_invalid_request_id_is_replaced():
+    """A request id that is not a safe token should be replaced."""
+    response = client.get("/adstod/stats", headers={"X-Request-ID": "bad id\t!"})
+    assert response.headers["x-request-id"] != "bad id\t!"
+    assert len(response.headers["x-request-id"]) == 32
+
+
+def test_span_outside_a_request_is_ignored():
+    """Work outside a request, such as background jobs, is not traced."""
+    with span("job") as item:
+        assert item is None
+
+
+def test_trace_file_is_rotated(tmp_path):
+    """The trace file should be rotated once it grows over its limit."""
+    sink = TraceSink(str(tmp_path / "rotated.jsonl"), max_bytes=500, backups=2)
+    for _ in range(10):
+        sink.write(Trace())
+    sink.close()
+    assert sorted(path.name for path in tmp_path.iterdir()) == [
+        "rotated.jsonl",
+        "rotated.jsonl.1",
+        "rotated.jsonl.2",
+    ]
@@ -0,0 +1,243 @@
+"""Test the deadlines, hedging and circuit breaker of the upstream calls."""
+
+import asyncio
+import time
+import httpx
+import pytest
+from openai import APIConnectionError, APITimeoutError, AsyncOpenAI
+from app import upstream
+from app.rate_limit import RateLimitedTransport, RateLimiter
+from app.routes.minnisblad_adstod import create_minnisblad_adstod_response_format
+from app.upstream import CircuitBreaker, CircuitOpenError, DeadlineExceeded, deadline
+from app.utils import DOCX_CONTENT_TYPE, send_text_to_openai
+from tests.fake_openai import FakeOpenAI, create_app
+from tests.utils import BEARER_TOKEN
+
+review_format = create_minnisblad_adstod_response_format()
+# The route and model of a short review, see app/routing.py.
+REVIEW_KEY = "review_short/gpt-4o-mini"
+
+
+class Clock:  # pylint: disable=too-few-public-methods
+    """A clock that only moves when told to."""
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+async def upload_review(app_client):
+    """Upload the test document for review."""
+    with open("tests/test_document.docx", "rb") as file:
+        return await app_client.post(
+            "/minnisblad-adstod/upload/",
+            files={"file": ("test_document.docx", file.read(), DOCX_CONTENT_TYPE)},
+            headers={"Authorization": f"Bearer {BEARER_TOKEN}"},
+        )
+
+
+def test_breaker_opens_and_lets_one_trial_through():
+    """The circuit should open after the failures and close after a trial."""
+    clock = Clock()
+    breaker = CircuitBreaker(failures=2, reset=10, clock=clock)
+    for _ in range(2):
+        breaker.check()
+        breaker.record(False)
+    with pytest.raises(CircuitOpenError) as error:
+        breaker.check()
+    assert error.value.retry_after == 10
+    clock.now = 10
+    breaker.check()
+    with pytest.raises(CircuitOpenError):
+        breaker.check()
+    breaker.record(True)
+    assert breaker.state == upstream.CLOSED
+    breaker.check()
+
+
+def test_failed_trial_opens_the_circuit_again():
+    """A failed trial should open the circuit for another reset period."""
+    clock = Clock()
+    breaker = CircuitBreaker(failures=1, reset=10, clock=clock)
+    breaker.record(False)
+    clock.now = 11
+    breaker.check()
+    breaker.record(False)
+    with pytest.raises(CircuitOpenError) as error:
+        breaker.check()
+    assert error.value.retry_after == 10
+
+
+@pytest.mark.asyncio
+async def test_slow_call_is_cancelled_at_the_deadline(mocker, fake_client, fake_state):
+    """A call that takes longer than the deadline should fail at the deadline."""
+    mocker.patch("app.utils.client", fake_client)
+    fake_state.latency = 5
+    start = time.perf_counter()
+    with pytest.raises(DeadlineExceeded), deadline(0.1):
+        await send_text_to_openai("Texti sem tekur of langan tíma.", review_format)
+    assert time.perf_counter() - start < 1
+    assert upstream.circuit_breaker.failures == 0
+
+
+@pytest.mark.asyncio
+async def test_request_deadline_does_not_open_the_circuit(mocker, fake_client, fake_state):
+    """Calls cut off by their request's deadline should not count as failures."""
+    mocker.patch("app.utils.client", fake_client)
+    mocker.patch.object(upstream.circuit_breaker, "threshold", 2)
+    fake_state.latency = 5
+    with pytest.raises(DeadlineExceeded), deadline(0.1):
+        await asyncio.gather(
+            *(send_text_to_openai(f"Hluti {i}.", review_format) for i in range(6))
+        )
+    assert upstream.circuit_breaker.state == upstream.CLOSED
+
+
+@pytest.mark.asyncio
+async def test_provider_timeout_is_a_failure(monkeypatch):
+    """A call that runs past LLM_DEADLINE should count as a provider failure."""
+    monkeypatch.setattr(upstream, "LLM_DEADLINE", 0.05)
+    with pytest.raises(DeadlineExceeded):
+        await upstream.call_upstream(lambda: asyncio.sleep(1), "chat")
+    assert upstream.circuit_breaker.failures == 1
+
+
+@pytest.mark.asyncio
+async def test_rate_limit_queue_overflow_does_not_open_the_circuit(mocker, fake_state):
+    """Requests that can't leave the local queue in time didn't reach the provider."""
+    mocker.patch.object(upstream.circuit_breaker, "threshold", 2)
+    limiter = RateLimiter(requests_per_minute=6, headroom=1)
+    limiter.requests.level = 0
+    transport = RateLimitedTransport(httpx.ASGITransport(app=create_app(fake_state)), limiter)
+    async with httpx.AsyncClient(transport=transport) as http_client:
+        mocker.patch(
+            "app.utils.client",
+            AsyncOpenAI(
+                api_key="test",
+                base_url="http://fake/v1",
+                http_client=http_client,
+                max_retries=0,
+            ),
+        )
+
+        async def review(number):
+            with deadline(2):
+                return await send_text_to_openai(f"Skjal númer {number}.", review_format)
+
+        results = await asyncio.gather(*(review(i) for i in range(10)), return_exceptions=True)
+    assert all(isinstance(result, APITimeoutError) for result in results)
+    assert upstream.circuit_breaker.failures == 0
+    assert upstream.circuit_breaker.state == upstream.CLOSED
+
+
+@pytest.mark.asyncio
+async def test_failing_request_counts_once(mocker):
+    """A request whose concurrent calls all fail should count as one failure."""
+    request = httpx.Request("POST", "http://fake/v1/chat/completions")
+
+    async def fail():
+        raise APIConnectionError(request=request)
+
+    mocker.patch.object(upstream.circuit_breaker, "threshold", 2)
+    with deadline(10):
+        results = await asyncio.gather(
+            *(upstream.call_upstream(fail, "chat") for _ in range(5)),
+            return_exceptions=True,
+        )
+    assert all(isinstance(result, APIConnectionError) for result in results)
+    assert upstream.circuit_breaker.failures == 1
+    assert upstream.circuit_breaker.state == upstream.CLOSED
+
+
+@pytest.mark.asyncio
+async def test_missed_deadline_returns_504(monkeypatch, fake_state, app_client):
+    """An upload whose review runs past its deadline should get a 504."""
+    monkeypatch.setattr("app.routes.minnisblad_adstod.DEADLINE_MINNISBLAD_ADSTOD", 0.1)
+    fake_state.latency = 5
+    response = await upload_review(app_client)
+    assert response.status_code == 504
+    assert response.json() == {"detail": "The language model did not answer in time."}
+
+
+@pytest.mark.asyncio
+async def test_slow_call_is_hedged(mocker, fake_client, fake_state):
+    """A call slower than the recent percentile should be raced by a second one."""
+    mocker.patch("app.utils.client", fake_client)
+    mocker.patch("app.upstream.HEDGE_REQUESTS", True)
+    for _ in range(upstream.HEDGE_MIN_SAMPLES):
+        upstream.latency_window.observe(REVIEW_KEY, 0.05)
+    latencies = iter([5, 0.01])
+    fake_state.chat_latency = lambda model: next(latencies)
+    start = time.perf_counter()
+    response = await send_text_to_openai("Texti með hægu svari.", review_format)
+    assert time.perf_counter() - start < 1
+    assert "properties" in response
+    assert len(fake_state.chat_requests) == 2
+
+
+@pytest.mark.asyncio
+async def test_fast_call_is_not_hedged(mocker, fake_client, fake_state):
+    """A call within the percentile should be sent once."""
+    mocker.patch("app.utils.client", fake_client)
+    mocker.patch("app.upstream.HEDGE_REQUESTS", True)
+    for _ in range(upstream.HEDGE_MIN_SAMPLES):
+        upstream.latency_window.observe(REVIEW_KEY, 0.5)
+    await send_text_to_openai("Texti með hröðu svari.", review_format)
+    assert len(fake_state.chat_requests) == 1
+
+
+@pytest.mark.asyncio
+async def test_loser_of_a_hedge_is_cancelled():
+    """The slower of two hedged calls should be cancelled."""
+    delays = iter([5, 0.01])
+    cancelled = []
+
+    async def call():
+        try:
+            await asyncio.sleep(next(delays))
+        except asyncio.CancelledError:
+            cancelled.append(True)
+            raise
+        return "svar"
+
+    assert await upstream.hedged(call, 0.01, "chat") == "svar"
+    await asyncio.sleep(0)
+    assert cancelled == [True]
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("fake_state", [FakeOpenAI(error_rate=1.0, error_status=500)])
+async def test_open_circuit_fails_fast_with_503(
+    monkeypatch, fake_state, fake_client, app_client
+):
+    """Once the provider keeps failing, uploads should get a 503 without a call."""
+    monkeypatch.setattr(fake_client, "max_retries", 0)
+    monkeypatch.setattr(upstream, "circuit_breaker", CircuitBreaker(failures=2, reset=30))
+    for _ in range(2):
+        assert (await upload_review(app_client)).status_code == 500
+    calls = len(fake_state.chat_requests)
+    response = await upload_review(app_client)
+    assert response.status_code == 503
+    assert response.json()["detail"].startswith("The language model service is unavailable")
+    assert 0 < int(response.headers["retry-after"]) <= 30
+    assert len(fake_state.chat_requests) == calls
+
+
+@pytest.mark.asyncio
+async def test_assistant_run_has_a_deadline(monkeypatch, fake_state, app_client):
+    """An assistant run that doesn't finish in time should get a 504."""
+    monkeypatch.setattr("app.routes.adstod.DEADLINE_ADSTOD", 0.1)
+    monkeypatch.setattr("app.routes.adstod.RUN_POLL_INITIAL_INTERVAL", 0.01)
+    fake_state.run_latency = 5
+    response = await app_client.post("/adstod/start", json={"message": "Hæ"})
+    assert response.status_code == 504
+    assert response.json() == {"error": "The language model did not answer in time."}
+    (run, _), = fake_state.runs.values()
+    assert run["status"] == "cancelled"
+    fake_state.run_latency = 0
+    response = await app_client.post(
+        "/adstod/start", json={"message": "Aftur", "thread_id": run["thread_id"]}
+    )
+    assert response.status_code == 200
@@ -70,15 +70,17 @@ def upload_wrong_file_type(url: str, client: TestClient, data: dict = None) -> d
     return response
 
 
-def upload_file_with_mocked_openai(url, client):
+def upload_file_with_mocked_openai(url, client, data: dict = None):
     """
     Test the upload_file route with a mocked OpenAI response.
 
     Args:
         url (str): The endpoint URL.
         client: The test client to send requests.
-        mocker: The pytest-mock mocker object for mocking dependencies.
+        data (dict): The form data, all chapters are selected by default.
     """
+    if data is None:
+        data = {"chapters": '["inngangur", "samantekt", "aaetlun", "markmid"]'}
     with open("tests/test_document.docx", "rb") as file:
         token = BEARER_TOKEN
         response = client.post(
@@ -90,7 +92,7 @@ def upload_file_with_mocked_openai(url, client):
                     "application/vnd.openxmlformats-officedocument.wordprocessingml.document",
                 )
             },
-            data={"chapters": '["inngangur", "samantekt", "aaetlun", "markmid"]'},
+            data=data,
             headers={"Authorization": f"Bearer {token}"},
         )
     return response